@@ -2,40 +2,87 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 import os
 from flask_bcrypt import Bcrypt
+from sqlalchemy import event
+from app.startup import startup
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
-def create_app():
+def _configure_sqlite(dbapi_connection, connection_record):
+    """WAL 模式下读写互不阻塞，多个 worker 进程可以安全地并发写入捕获记录"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+@startup.step('schema')
+def _create_schema(app):
+    """确保数据库表存在，并补齐旧版本数据库缺少的列和索引"""
+    from app.models import upgrade_schema
+    from app.rollups import merge_duplicates
+    db.create_all()
+    # 汇总表的分组唯一索引要求先合并旧数据中的重复行
+    merge_duplicates()
+    upgrade_schema()
+
+@startup.step('admin')
+def _ensure_admin(app):
+    """检查是否已有管理员账号，没有时创建默认账号"""
+    from app.models import AdminUser
+    if not AdminUser.query.filter_by(username='admin').first():
+        admin = AdminUser(
+            username='admin',
+            password_hash=bcrypt.generate_password_hash('admin').decode('utf-8'),
+            force_change=True
+        )
+        db.session.add(admin)
+        db.session.commit()
+
+def create_app(config=None):
     app = Flask(__name__)
     
     # 配置
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(os.path.abspath(os.path.dirname(__file__)), '../data.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # 多进程写入时等待写锁而不是立即报 database is locked
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
     app.secret_key = 'your_secret_key_here'
+    # 按天或按周把捕获记录写入独立的分区文件（day/week），未设置时写入 data.db
+    app.config['CAPTURE_PARTITION'] = os.environ.get('AI_HOOK_PARTITION') or None
+    app.config['CAPTURE_PARTITION_DIR'] = os.environ.get('AI_HOOK_PARTITION_DIR') or \
+        os.path.join(os.path.abspath(os.path.dirname(__file__)), '../partitions')
+    # 允许调用方覆盖配置（如基准测试使用临时数据库）
+    if config:
+        app.config.update(config)
     
     # 初始化数据库
     db.init_app(app)
     bcrypt.init_app(app)
     
-    # 这里再导入 models，避免循环引用
-    from app.models import AdminUser
+    # 这里再导入 routes（会导入 models），避免循环引用
     # 注册蓝图
     from app.routes import main_bp, proxy_bp
     app.register_blueprint(main_bp)
     app.register_blueprint(proxy_bp)
     
-    # 确保数据库存在
-    with app.app_context():
-        db.create_all()
-        # 检查是否已有管理员账号
-        if not AdminUser.query.filter_by(username='admin').first():
-            admin = AdminUser(
-                username='admin',
-                password_hash=bcrypt.generate_password_hash('admin').decode('utf-8'),
-                force_change=True
-            )
-            db.session.add(admin)
-            db.session.commit()
+    from app.partitions import store
+    store.configure(app.config['CAPTURE_PARTITION'], app.config['CAPTURE_PARTITION_DIR'])
+    
+    # 注册命令行工具
+    from app.cli import register_commands
+    register_commands(app)
+    
+    # 统计进行中的请求，优雅退出时等待流式响应转发完毕
+    from app.lifecycle import InflightTracker
+    app.inflight = InflightTracker(app.wsgi_app)
+    app.wsgi_app = app.inflight
+    
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        with app.app_context():
+            # 只登记连接回调，不会打开数据库
+            event.listen(db.engine, 'connect', _configure_sqlite)
+    
+    # 建表、默认管理员和配置加载推迟到首个请求或命令之前执行，导入和创建应用时不做 I/O
+    app.before_request(lambda: startup.ensure(app))
     
     return app 
\ No newline at end of file
@@ -0,0 +1,109 @@
+import os
+import zlib
+import queue
+import threading
+
+from requests.utils import get_encoding_from_headers
+
+from app import db, lifecycle
+from app import metrics
+
+try:
+    import brotli
+except ImportError:  # 未安装 brotli 时 br 编码的响应体按原始字节保存
+    brotli = None
+
+# 待写入的捕获记录超过该数量时，在请求线程中直接写入，避免内存无限增长
+MAX_QUEUE_SIZE = int(os.environ.get('AI_HOOK_CAPTURE_QUEUE_SIZE', 1000))
+
+
+def decode_body(raw, headers, content_encoding=None):
+    """
+    把上游原始响应字节解压并解码为文本，仅用于保存捕获记录
+    :param raw: 上游返回的原始字节（可能是压缩过的）
+    :param headers: 上游响应头，用于确定字符集
+    :param content_encoding: 原始字节的压缩方式，None 表示未压缩
+    """
+    if not raw:
+        return ''
+    for encoding in reversed([e.strip().lower() for e in (content_encoding or '').split(',') if e.strip()]):
+        try:
+            if encoding in ('gzip', 'x-gzip'):
+                raw = zlib.decompress(raw, 16 + zlib.MAX_WBITS)
+            elif encoding == 'deflate':
+                try:
+                    raw = zlib.decompress(raw)
+                except zlib.error:
+                    raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+            elif encoding == 'br' and brotli is not None:
+                raw = brotli.decompress(raw)
+            elif encoding != 'identity':
+                print(f"不支持的响应压缩方式 {encoding}，按原始字节保存")
+                break
+        except Exception as e:
+            print(f"解压响应体失败({encoding}): {str(e)}")
+            break
+    charset = get_encoding_from_headers({k.lower(): v for k, v in (headers or {}).items()}) or 'utf-8'
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+class CaptureWriter:
+    """
+    后台写入捕获记录的线程：请求线程只负责入队，解压、解析用量和写库都在这里完成
+    每个进程一个写入线程，fork 之后在首次提交时重新启动
+    """
+
+    def __init__(self, maxsize=MAX_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='capture-writer', daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, app, func, *args, **kwargs):
+        """提交一次写入；队列已满时在当前线程同步执行"""
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((app, func, args, kwargs))
+        except queue.Full:
+            print("捕获记录写入队列已满，在请求线程中直接写入")
+            self._execute(app, func, args, kwargs)
+            return
+        metrics.registry.set('aihook_capture_queue_depth', (), self._queue.qsize())
+
+    def _execute(self, app, func, args, kwargs):
+        with app.app_context():
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                db.session.rollback()
+                print(f"写入捕获记录失败: {str(e)}")
+
+    def _run(self):
+        while True:
+            app, func, args, kwargs = self._queue.get()
+            try:
+                self._execute(app, func, args, kwargs)
+            finally:
+                self._queue.task_done()
+                metrics.registry.set('aihook_capture_queue_depth', (), self._queue.qsize())
+
+    def drain(self):
+        """等待队列中的捕获记录全部写入，进程退出前调用"""
+        if self._pid != os.getpid():
+            return
+        self._queue.join()
+
+
+writer = CaptureWriter()
+lifecycle.on_shutdown(writer.drain)
@@ -0,0 +1,183 @@
+import json
+import random
+
+MODES = ('full', 'metadata', 'headers')
+RULE_KEYS = ('method', 'path', 'model', 'status', 'sample_rate', 'mode')
+
+
+def _parse_status(value):
+    """状态码条件，支持精确值（429）和类别（5xx），返回 (下限, 上限)"""
+    value = str(value).strip().lower()
+    if len(value) == 3 and value.endswith('xx') and value[0].isdigit():
+        low = int(value[0]) * 100
+        return low, low + 99
+    code = int(value)
+    return code, code
+
+
+def _rate(value, where):
+    rate = float(value)
+    if not 0 <= rate <= 1:
+        raise ValueError(f'{where} 的 sample_rate 必须在 0 到 1 之间')
+    return rate
+
+
+def _mode(value, where):
+    if value not in MODES:
+        raise ValueError(f'{where} 的 mode 只支持: {", ".join(MODES)}')
+    return value
+
+
+class _Rule:
+    """一条采样规则，未设置的条件视为匹配任意值；path 以 * 结尾时按前缀匹配"""
+
+    def __init__(self, config, index):
+        where = f'第 {index + 1} 条规则'
+        unknown = set(config) - set(RULE_KEYS)
+        if unknown:
+            raise ValueError(f'{where} 包含未知字段: {", ".join(sorted(unknown))}')
+        self.method = config['method'].upper() if config.get('method') else None
+        path = config.get('path') or None
+        self.path_prefix = path[:-1] if path and path.endswith('*') else None
+        self.path = None if self.path_prefix is not None else path
+        self.model = config.get('model') or None
+        self.status = _parse_status(config['status']) if config.get('status') else None
+        self.sample_rate = _rate(config.get('sample_rate', 1), where)
+        self.mode = _mode(config['mode'], where) if config.get('mode') else None
+        self.config = dict(config)
+
+    def matches(self, method, path, model):
+        if self.method is not None and self.method != method:
+            return False
+        if self.path is not None and self.path != path:
+            return False
+        if self.path_prefix is not None and not (path or '').startswith(self.path_prefix):
+            return False
+        return self.model is None or self.model == model
+
+
+class CapturePlan:
+    """一次调用的捕获决定：请求阶段按路径和模型采样，未采中的调用在响应阶段再按状态码、错误和慢调用补采"""
+    __slots__ = ('policy', 'method', 'path', 'model', 'mode', 'sampled')
+
+    def __init__(self, policy, method, path, model, mode, sampled):
+        self.policy = policy
+        self.method = method
+        self.path = path
+        self.model = model
+        self.mode = mode
+        self.sampled = sampled
+
+    def final_mode(self, status_code, time_taken):
+        """响应阶段的最终决定，返回捕获模式，不保存时返回 None"""
+        if self.sampled:
+            return self.mode
+        return self.policy.resample(self, status_code, time_taken)
+
+
+def _truncate_utf8(text, limit):
+    """
+    按 UTF-8 字节数截断文本，不会切断多字节字符
+    :return: (截断后的文本, 原文字节数)，未超过上限时返回 None
+    """
+    # 每个字符最多 4 个字节，字符数不超过上限的四分之一时无需编码
+    if len(text) <= limit // 4:
+        return None
+    data = text.encode('utf-8')
+    if len(data) <= limit:
+        return None
+    return data[:limit].decode('utf-8', 'ignore'), len(data)
+
+
+class CapturePolicy:
+    """
+    捕获策略，配置示例：
+      {
+        "mode": "full",                   full 完整保存 / headers 只保存请求头和响应头 / metadata 只保存元数据
+        "sample_rate": 1.0,               默认采样率
+        "rules": [{"method": "GET", "path": "/models", "sample_rate": 0},
+                  {"path": "/embeddings", "mode": "metadata"},
+                  {"status": "429", "sample_rate": 1}],
+        "always_capture_errors": true,    状态码 >= 400 或转发失败的调用总是保存
+        "slow_threshold": 30,             耗时超过该秒数的调用总是保存，0 表示不启用
+        "max_body_bytes": 1048576         请求体和响应体超过该字节数（UTF-8）时截断，0 表示不限制
+      }
+    规则按顺序匹配，第一条匹配的规则决定采样率和模式；带 status 的规则在响应阶段对未采中的调用生效
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        if not isinstance(config, dict):
+            raise ValueError('捕获策略必须是 JSON 对象')
+        self.mode = _mode(config.get('mode') or 'full', '捕获策略')
+        self.sample_rate = _rate(config.get('sample_rate', 1), '捕获策略')
+        rules = config.get('rules') or []
+        if not isinstance(rules, list):
+            raise ValueError('rules 必须是列表')
+        rules = [_Rule(rule, i) for i, rule in enumerate(rules)]
+        self.request_rules = [rule for rule in rules if rule.status is None]
+        self.status_rules = [rule for rule in rules if rule.status is not None]
+        self.always_capture_errors = bool(config.get('always_capture_errors', True))
+        self.slow_threshold = float(config.get('slow_threshold') or 0)
+        self.max_body_bytes = int(config.get('max_body_bytes') or 0)
+        self._rules = rules
+
+    def to_dict(self):
+        return {
+            'mode': self.mode,
+            'sample_rate': self.sample_rate,
+            'rules': [rule.config for rule in self._rules],
+            'always_capture_errors': self.always_capture_errors,
+            'slow_threshold': self.slow_threshold,
+            'max_body_bytes': self.max_body_bytes,
+        }
+
+    def plan(self, method, path, model):
+        """请求阶段按路径、方法和模型决定是否采样"""
+        rate, mode = self.sample_rate, self.mode
+        for rule in self.request_rules:
+            if rule.matches(method, path, model):
+                rate, mode = rule.sample_rate, rule.mode or self.mode
+                break
+        sampled = rate >= 1 or (rate > 0 and random.random() < rate)
+        return CapturePlan(self, method, path, model, mode, sampled)
+
+    def resample(self, plan, status_code, time_taken):
+        for rule in self.status_rules:
+            if rule.matches(plan.method, plan.path, plan.model) and rule.status[0] <= status_code <= rule.status[1]:
+                if rule.sample_rate >= 1 or random.random() < rule.sample_rate:
+                    return rule.mode or plan.mode
+                break
+        if self.always_capture_errors and status_code >= 400:
+            return plan.mode
+        if self.slow_threshold and time_taken is not None and time_taken >= self.slow_threshold:
+            return plan.mode
+        return None
+
+    def apply_to_request(self, db_request, mode):
+        """按捕获模式去掉请求记录中不保存的内容，请求体超过上限时只保留开头部分"""
+        if mode == 'metadata':
+            db_request.headers = None
+        if mode in ('metadata', 'headers'):
+            db_request.body = None
+        elif self.max_body_bytes and db_request.body:
+            truncated = _truncate_utf8(db_request.body, self.max_body_bytes)
+            if truncated is not None:
+                # 截断后的内容不再是合法 JSON，改存一个说明对象，页面和导出仍能正常解析；size 为原文字节数
+                preview, size = truncated
+                db_request.body = json.dumps({'truncated': True, 'size': size, 'preview': preview}, ensure_ascii=False)
+
+    def apply_to_response(self, db_response, mode):
+        if mode == 'metadata':
+            db_response.headers = None
+        if mode in ('metadata', 'headers'):
+            db_response.body = None
+        elif self.max_body_bytes and db_response.body:
+            truncated = _truncate_utf8(db_response.body, self.max_body_bytes)
+            if truncated is not None:
+                preview, size = truncated
+                db_response.body = preview + f'\n…[已截断，共 {size} 字节]'
+
+
+# 租户关闭捕获时使用：不采样，错误和慢调用也不保存
+DISABLED = CapturePolicy({'sample_rate': 0, 'always_capture_errors': False})
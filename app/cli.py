@@ -0,0 +1,98 @@
+import gzip
+import time
+
+import click
+
+from app.startup import startup
+
+
+def register_commands(app):
+    """注册 flask 命令行工具，使用方式: flask --app run <命令>"""
+
+    @app.cli.command('backfill-rollups')
+    @click.option('--batch-size', default=1000, show_default=True, help='每批处理的响应数')
+    @click.option('--rebuild', is_flag=True, help='删除当前小时之前的全部汇总后按捕获记录重建')
+    def backfill_rollups_command(batch_size, rebuild):
+        """用已有捕获记录补齐用量汇总表中缺失的小时"""
+        startup.ensure(app)
+        from app import rollups
+        if rebuild:
+            print("警告: 重建会丢失没有保存捕获记录的调用（采样未采中、租户关闭捕获）的统计")
+        rollups.backfill(batch_size=batch_size, rebuild=rebuild)
+
+    @app.cli.command('export-captures')
+    @click.option('--output', '-o', required=True, help='输出文件，以 .gz 结尾时 gzip 压缩')
+    @click.option('--start', help='起始时间（ISO 格式或 -7d 这样的相对天数）')
+    @click.option('--end', help='结束时间')
+    @click.option('--model', help='请求中的模型')
+    @click.option('--api-service', help='API 服务名称')
+    @click.option('--tenant', help='租户名称')
+    @click.option('--status', help='响应状态码，如 200 或 5xx')
+    @click.option('--batch-size', default=1000, show_default=True, help='每批读取的请求数')
+    def export_captures_command(output, start, end, model, api_service, tenant, status, batch_size):
+        """把捕获记录导出为 NDJSON（每行一个请求及其响应）"""
+        startup.ensure(app)
+        from app import export
+        try:
+            filters = export.parse_filters({'start': start, 'end': end, 'model': model,
+                                            'api_service': api_service, 'tenant': tenant, 'status': status})
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+
+        if output.endswith('.gz'):
+            f = gzip.open(output, 'wb')
+        else:
+            f = open(output, 'wb')
+        began = time.time()
+        count = 0
+        with f:
+            for chunk in export.iter_ndjson(batch_size=batch_size, **filters):
+                f.write(chunk)
+                count += chunk.count(b'\n')
+        print(f"导出完成: {count} 条记录, 耗时 {time.time() - began:.1f} 秒")
+
+    @app.cli.command('import-captures')
+    @click.argument('files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option('--batch-size', default=5000, show_default=True, help='每个事务写入的记录数')
+    @click.option('--workers', type=int, help='解析进程数，默认为 CPU 核数，1 表示不使用子进程')
+    @click.option('--checkpoint', default='.import-checkpoint.json', show_default=True, help='断点续传记录文件')
+    @click.option('--restart', is_flag=True, help='忽略断点记录，从头导入（重复记录仍会按内容摘要跳过）')
+    @click.option('--keep-indexes', is_flag=True, help='导入期间不删除索引（服务同时在运行时使用）')
+    def import_captures_command(files, batch_size, workers, checkpoint, restart, keep_indexes):
+        """批量导入 NDJSON 流量转储或其它实例导出的捕获记录（支持 .gz）"""
+        startup.ensure(app)
+        import os
+        from app import importer
+        from app.partitions import store
+        if restart and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        if store.enabled:
+            print("导入的记录会写入 data.db，导入完成后可执行 flask --app run migrate-partitions 迁移到分区文件")
+        try:
+            importer.import_files(list(files), batch_size=batch_size, workers=workers, checkpoint_path=checkpoint,
+                                  defer_indexes=not keep_indexes)
+        except importer.ImportReadError as e:
+            raise click.ClickException(f'{e}，已提交的记录保留，修复文件后再次执行会从断点继续')
+        print("如需把导入的记录计入用量统计，请执行: flask --app run backfill-rollups")
+
+    @app.cli.command('migrate-partitions')
+    @click.option('--batch-size', default=1000, show_default=True, help='每批迁移的请求数')
+    def migrate_partitions_command(batch_size):
+        """把 data.db 中的捕获记录迁移到分区文件（需设置 AI_HOOK_PARTITION，建议停止服务后执行）"""
+        startup.ensure(app)
+        from app.partitions import store
+        if not store.enabled:
+            raise click.UsageError('未启用分区存储，请先设置环境变量 AI_HOOK_PARTITION=day 或 week')
+        store.migrate_from_main(batch_size=batch_size)
+
+    @app.cli.command('prune-partitions')
+    @click.option('--older-than', type=int, required=True, help='删除结束时间早于多少天之前的分区')
+    def prune_partitions_command(older_than):
+        """删除过期的分区文件（用量汇总数据保留）"""
+        startup.ensure(app)
+        from datetime import datetime, timedelta
+        from app.partitions import store
+        if not store.enabled:
+            raise click.UsageError('未启用分区存储，请先设置环境变量 AI_HOOK_PARTITION=day 或 week')
+        removed = store.prune(datetime.utcnow() - timedelta(days=older_than))
+        print(f"已删除 {len(removed)} 个分区: {', '.join(key.isoformat() for key in removed) or '无'}")
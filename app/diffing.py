@@ -0,0 +1,61 @@
+import json
+
+# 单个差异值超过该长度（JSON 字符数）时截断，避免新增一整段 messages 时差异本身过大
+MAX_VALUE_CHARS = 2000
+
+
+def _clip(value):
+    if isinstance(value, (dict, list)):
+        text = json.dumps(value, ensure_ascii=False)
+        if len(text) > MAX_VALUE_CHARS:
+            return {'truncated': True, 'preview': text[:MAX_VALUE_CHARS], 'length': len(text)}
+    elif isinstance(value, str) and len(value) > MAX_VALUE_CHARS:
+        return {'truncated': True, 'preview': value[:MAX_VALUE_CHARS], 'length': len(value)}
+    return value
+
+
+def diff_values(old, new, path=()):
+    """
+    递归比较两个 JSON 值，返回变更列表
+    每项为 {'path': [键或下标, ...], 'op': 'added' | 'removed' | 'changed', 'old': 原值, 'new': 新值}
+    """
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in old:
+            if key not in new:
+                changes.append({'path': list(path) + [key], 'op': 'removed', 'old': _clip(old[key]), 'new': None})
+            else:
+                changes.extend(diff_values(old[key], new[key], path + (key,)))
+        for key in new:
+            if key not in old:
+                changes.append({'path': list(path) + [key], 'op': 'added', 'old': None, 'new': _clip(new[key])})
+        return changes
+    if isinstance(old, list) and isinstance(new, list):
+        changes = []
+        for i in range(max(len(old), len(new))):
+            if i >= len(new):
+                changes.append({'path': list(path) + [i], 'op': 'removed', 'old': _clip(old[i]), 'new': None})
+            elif i >= len(old):
+                changes.append({'path': list(path) + [i], 'op': 'added', 'old': None, 'new': _clip(new[i])})
+            else:
+                changes.extend(diff_values(old[i], new[i], path + (i,)))
+        return changes
+    return [{'path': list(path), 'op': 'changed', 'old': _clip(old), 'new': _clip(new)}]
+
+
+def _side(value, name):
+    return value.get(name) if isinstance(value, dict) else None
+
+
+def capture_diff(headers, body):
+    """
+    计算一条捕获记录原始请求与转发请求的差异
+    :param headers: 请求记录的 {'original': ..., 'modified': ...} 请求头
+    :param body: 请求记录的 {'original': ..., 'modified': ...} 请求体，没有请求体时为空
+    """
+    return {
+        'headers': diff_values(_side(headers, 'original') or {}, _side(headers, 'modified') or {}),
+        'body': diff_values(_side(body, 'original'), _side(body, 'modified')),
+    }
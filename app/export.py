@@ -0,0 +1,172 @@
+import json
+import zlib
+
+from sqlalchemy import select, exists
+
+from app import db, rollups
+from app.models import Request as RequestModel, Response as ResponseModel
+from app.timing import unpack_gaps
+from app.partitions import store as partition_store
+
+# 每批读取的请求数，导出时内存占用只和批大小有关
+EXPORT_BATCH_SIZE = 1000
+
+REQUEST_COLUMNS = (
+    RequestModel.id, RequestModel.timestamp, RequestModel.method, RequestModel.path, RequestModel.api_service,
+    RequestModel.model, RequestModel.original_url, RequestModel.key_tag, RequestModel.client,
+    RequestModel.tenant, RequestModel.estimated_tokens, RequestModel.cache_breakpoints, RequestModel.headers,
+    RequestModel.body,
+)
+RESPONSE_COLUMNS = (
+    ResponseModel.id, ResponseModel.request_id, ResponseModel.status_code, ResponseModel.headers,
+    ResponseModel.body, ResponseModel.is_stream, ResponseModel.time_taken, ResponseModel.timing,
+    ResponseModel.chunk_gaps, ResponseModel.prompt_tokens, ResponseModel.completion_tokens,
+    ResponseModel.cached_tokens, ResponseModel.cost,
+)
+
+
+def parse_status(value):
+    """解析状态码过滤条件，支持精确值（如 429）和类别（如 5xx），返回 (下限, 上限)"""
+    value = str(value).strip().lower()
+    if len(value) == 3 and value.endswith('xx') and value[0].isdigit():
+        low = int(value[0]) * 100
+        return low, low + 99
+    code = int(value)
+    return code, code
+
+
+def parse_filters(args):
+    """
+    从查询参数解析导出过滤条件，参数无效时抛出 ValueError
+    :param args: 包含 start/end/model/api_service/tenant/status 的映射
+    """
+    return {
+        'start': rollups.parse_time_arg(args.get('start'), None),
+        'end': rollups.parse_time_arg(args.get('end'), None),
+        'model': args.get('model') or None,
+        'api_service': args.get('api_service') or None,
+        'tenant': args.get('tenant') or None,
+        'status': parse_status(args['status']) if args.get('status') else None,
+    }
+
+
+def _load_json(text):
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def _record(req, resp, id_base=0):
+    """组装一条导出记录，格式为 {"request": {...}, "response": {...}}，分区模式下 id 加上分区偏移"""
+    record = {
+        'request': {
+            'id': id_base + req.id,
+            'timestamp': req.timestamp.isoformat() if req.timestamp else None,
+            'method': req.method,
+            'path': req.path,
+            'api_service': req.api_service,
+            'model': req.model,
+            'original_url': req.original_url,
+            'key_tag': req.key_tag,
+            'client': req.client,
+            'tenant': req.tenant,
+            'estimated_tokens': req.estimated_tokens,
+            'cache_breakpoints': req.cache_breakpoints,
+            'headers': _load_json(req.headers),
+            'body': _load_json(req.body),
+        },
+        'response': None,
+    }
+    if resp is not None:
+        record['response'] = {
+            'id': id_base + resp.id,
+            'status_code': resp.status_code,
+            'headers': _load_json(resp.headers),
+            'body': resp.body,
+            'is_stream': resp.is_stream,
+            'time_taken': resp.time_taken,
+            'timing': _load_json(resp.timing),
+            'chunk_gaps': unpack_gaps(resp.chunk_gaps),
+            'prompt_tokens': resp.prompt_tokens,
+            'completion_tokens': resp.completion_tokens,
+            'cached_tokens': resp.cached_tokens,
+            'cost': resp.cost,
+        }
+    return record
+
+
+def iter_batches(start=None, end=None, model=None, api_service=None, tenant=None, status=None,
+                 batch_size=EXPORT_BATCH_SIZE):
+    """
+    按请求 id 分批读取捕获记录（keyset 分页），每批返回一个记录列表
+    每批读完立即结束读事务，导出大量数据时不会长时间占用数据库快照，也不影响代理写入
+    分区模式下只打开时间范围内的分区文件，按时间顺序逐个导出
+    """
+    filters = dict(start=start, end=end, model=model, api_service=api_service, tenant=tenant, status=status,
+                   batch_size=batch_size)
+    if not partition_store.enabled:
+        yield from _iter_session_batches(db.session, **filters)
+        return
+    for key in partition_store.existing(start, end):
+        with partition_store.session(key) as capture_session:
+            yield from _iter_session_batches(capture_session, id_base=partition_store.base_of(key), **filters)
+
+
+def filter_conditions(start=None, end=None, model=None, api_service=None, tenant=None, status=None):
+    """把 parse_filters 的过滤条件转换为请求表上的 SQL 条件列表"""
+    conditions = []
+    if start is not None:
+        conditions.append(RequestModel.timestamp >= start)
+    if end is not None:
+        conditions.append(RequestModel.timestamp < end)
+    if model:
+        conditions.append(RequestModel.model == model)
+    if api_service:
+        conditions.append(RequestModel.api_service == api_service)
+    if tenant:
+        conditions.append(RequestModel.tenant == tenant)
+    if status:
+        conditions.append(exists().where(ResponseModel.request_id == RequestModel.id,
+                                         ResponseModel.status_code.between(*status)))
+    return conditions
+
+
+def _iter_session_batches(session, start, end, model, api_service, tenant, status, batch_size, id_base=0):
+    conditions = filter_conditions(start, end, model, api_service, tenant, status)
+
+    last_id = 0
+    while True:
+        rows = session.execute(
+            select(*REQUEST_COLUMNS).where(RequestModel.id > last_id, *conditions)
+            .order_by(RequestModel.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        responses = {}
+        for resp in session.execute(
+                select(*RESPONSE_COLUMNS).where(ResponseModel.request_id.in_([row.id for row in rows]))
+                .order_by(ResponseModel.id)):
+            # 一个请求只会捕获一个响应，如有多个以最后一个为准
+            responses[resp.request_id] = resp
+        session.rollback()
+        last_id = rows[-1].id
+        yield [_record(row, responses.get(row.id), id_base) for row in rows]
+
+
+def iter_ndjson(**filters):
+    """逐批生成 NDJSON 字节串，每批一个 chunk"""
+    for records in iter_batches(**filters):
+        yield ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+
+
+def gzip_stream(chunks):
+    """把字节串流压缩为 gzip 格式的字节串流"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from app import metrics
+from app.timing import unpack_gaps
+from app.diffing import capture_diff
+
+# 最多缓存的请求数和总字节数，任一为 0 时不启用
+MAX_ENTRIES = int(os.environ.get('AI_HOOK_HOTCACHE_ENTRIES', 500))
+MAX_BYTES = int(os.environ.get('AI_HOOK_HOTCACHE_BYTES', 64 * 1024 * 1024))
+# 多 worker 部署时其它进程的捕获不会进入本进程的缓存，此时不启用
+MULTIPROCESS = os.environ.get('AI_HOOK_MULTIPROCESS') == '1'
+# 总数由缓存自行维护，定期用数据库校正一次（命令行导入、清理分区等不经过缓存）
+TOTAL_REFRESH_INTERVAL = 60
+# 每条记录除字符串以外的固定开销估算
+ENTRY_OVERHEAD = 512
+
+
+def _size(*values):
+    return sum(len(value) for value in values if isinstance(value, (str, bytes)))
+
+
+class _Entry:
+    """一条请求的紧凑表示：列表字段直接保存，请求头、请求体和响应保持数据库中的原始字符串，读取详情时才解码"""
+    __slots__ = ('id', 'timestamp', 'method', 'path', 'headers', 'body', 'api_service', 'model', 'original_url',
+                 'tenant', 'estimated_tokens', 'cache_breakpoints', 'thread_id', 'parent_id', 'diff', 'responses', 'size')
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'timestamp': self.timestamp.isoformat(),
+            'method': self.method,
+            'path': self.path,
+            'has_response': len(self.responses) > 0
+        }
+
+    def detail(self, responses):
+        """组装详情字典，responses 为调用方在持有缓存锁时复制的响应列表，解码在锁外进行"""
+        return {
+            'id': self.id,
+            'timestamp': self.timestamp.isoformat(),
+            'method': self.method,
+            'path': self.path,
+            'headers': json.loads(self.headers) if self.headers else {},
+            'body': json.loads(self.body) if self.body else {},
+            'api_service': self.api_service,
+            'model': self.model,
+            'original_url': self.original_url,
+            'tenant': self.tenant,
+            'estimated_tokens': self.estimated_tokens,
+            'cache_breakpoints': self.cache_breakpoints,
+            'thread_id': self.thread_id,
+            'parent_id': self.parent_id,
+            'responses': [{
+                'id': response_id,
+                'status_code': status_code,
+                'headers': json.loads(headers) if headers else {},
+                'body': body,
+                'is_stream': is_stream,
+                'time_taken': time_taken,
+                'timing': json.loads(timing) if timing else {},
+                'chunk_gaps': unpack_gaps(chunk_gaps),
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'cached_tokens': cached_tokens
+            } for (response_id, status_code, headers, body, is_stream, time_taken, timing, chunk_gaps,
+                   prompt_tokens, completion_tokens, cached_tokens) in responses]
+        }
+
+
+def response_fields(db_response):
+    """在提交前取出响应记录需要缓存的列，提交后 ORM 对象可能已过期"""
+    return (db_response.id, db_response.status_code, db_response.headers,
+            db_response.body, db_response.is_stream, db_response.time_taken, db_response.timing,
+            db_response.chunk_gaps, db_response.prompt_tokens, db_response.completion_tokens,
+            db_response.cached_tokens)
+
+
+class HotCache:
+    """
+    最近捕获记录的进程内环形缓冲，按条数和字节数淘汰最旧的记录
+    由代理捕获路径直接写入，仪表盘的第一页列表和最近记录的详情无需访问数据库
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.enabled = max_entries > 0 and max_bytes > 0 and not MULTIPROCESS
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._total = None
+        self._total_at = 0.0
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+        metrics.registry.set('aihook_hotcache_entries', (), len(self._entries))
+        metrics.registry.set('aihook_hotcache_bytes', (), self._bytes)
+
+    def _hit(self, kind, hit):
+        metrics.registry.inc('aihook_hotcache_reads_total', (('kind', kind), ('result', 'hit' if hit else 'miss')))
+
+    def put_request(self, request_id, db_request):
+        """请求记录提交后调用，request_id 为对外使用的 id"""
+        if not self.enabled:
+            return
+        entry = _Entry()
+        entry.id = request_id
+        entry.timestamp = db_request.timestamp
+        entry.method = db_request.method
+        entry.path = db_request.path
+        entry.headers = db_request.headers
+        entry.body = db_request.body
+        entry.api_service = db_request.api_service
+        entry.model = db_request.model
+        entry.original_url = db_request.original_url
+        entry.tenant = db_request.tenant
+        entry.estimated_tokens = db_request.estimated_tokens
+        entry.cache_breakpoints = db_request.cache_breakpoints
+        entry.thread_id = db_request.thread_id
+        entry.parent_id = db_request.parent_id
+        entry.diff = None
+        entry.responses = []
+        entry.size = ENTRY_OVERHEAD + _size(entry.headers, entry.body, entry.path, entry.original_url)
+        with self._lock:
+            self._entries[request_id] = entry
+            self._bytes += entry.size
+            if self._total is not None:
+                self._total += 1
+            self._evict()
+
+    def put_response(self, request_id, fields):
+        """响应记录提交后调用，fields 由 response_fields 取得；请求已被淘汰时忽略"""
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is None:
+                return
+            entry.responses.append(fields)
+            size = ENTRY_OVERHEAD + _size(*fields)
+            entry.size += size
+            self._bytes += size
+            self._evict()
+
+    def evict(self, request_id):
+        self.evict_many((request_id,))
+
+    def evict_many(self, request_ids):
+        with self._lock:
+            for request_id in request_ids:
+                entry = self._entries.pop(request_id, None)
+                if entry is not None:
+                    self._bytes -= entry.size
+            self._total = None
+            self._evict()
+
+    def evict_range(self, low, high):
+        """移除 id 在 [low, high) 之间的记录（分区文件被整体删除时使用）"""
+        with self._lock:
+            request_ids = [request_id for request_id in self._entries if low <= request_id < high]
+        self.evict_many(request_ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._total = None
+            self._evict()
+
+    def get_detail(self, request_id):
+        """返回请求详情字典，未缓存时返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(request_id)
+            # 写入线程可能同时追加响应，在锁内复制列表
+            responses = list(entry.responses) if entry is not None else None
+        self._hit('detail', entry is not None)
+        return entry.detail(responses) if entry is not None else None
+
+    def get_diff(self, request_id):
+        """返回请求的原始与转发内容差异，首次读取时计算后保存在缓存中，未缓存时返回 None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(request_id)
+        self._hit('diff', entry is not None)
+        if entry is None:
+            return None
+        if entry.diff is None:
+            entry.diff = capture_diff(json.loads(entry.headers) if entry.headers else {},
+                                      json.loads(entry.body) if entry.body else {})
+        return entry.diff
+
+    def list_first_page(self, per_page, count_total):
+        """
+        缓存中的记录都比数据库中其它记录新，条数足够时直接返回第一页和总数，否则返回 None
+        :param count_total: 从数据库统计总数的函数，只在总数未知或需要校正时调用
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            enough = 0 < per_page <= len(self._entries)
+            if enough:
+                newest = sorted(list(self._entries.values())[-per_page * 2:],
+                                key=lambda entry: entry.timestamp, reverse=True)[:per_page]
+                items = [entry.summary() for entry in newest]
+            total = self._total if time.time() - self._total_at < TOTAL_REFRESH_INTERVAL else None
+        self._hit('list', enough)
+        if not enough:
+            return None
+        if total is None:
+            total = count_total()
+            with self._lock:
+                self._total = total
+                self._total_at = time.time()
+        return items, total
+
+
+cache = HotCache()
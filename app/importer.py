@@ -0,0 +1,319 @@
+import os
+import gzip
+import json
+import time
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from app import db
+from app.models import Request as RequestModel, Response as ResponseModel, content_hash
+from app.timing import pack_gaps, gaps_from_ms
+from app.usage import extract_usage
+
+# 每个事务写入的记录数，同时也是交给解析进程的一块行数
+IMPORT_BATCH_SIZE = 5000
+# 导入期间保留的索引：去重查询需要用到
+KEEP_INDEXES = {'ix_request_content_hash'}
+
+REQUEST_FIELDS = ('id', 'timestamp', 'method', 'path', 'headers', 'body', 'api_service', 'model', 'original_url',
+                  'key_tag', 'client', 'tenant', 'estimated_tokens', 'cache_breakpoints',
+                  'content_hash')
+RESPONSE_FIELDS = ('id', 'request_id', 'status_code', 'headers', 'body', 'is_stream', 'time_taken', 'timing',
+                   'chunk_gaps', 'prompt_tokens', 'completion_tokens', 'cached_tokens', 'cost')
+
+
+def _open_lines(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _dumps(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', ''))
+    except ValueError:
+        return None
+
+
+def _to_sql_time(value):
+    # 与 SQLAlchemy 在 SQLite 中保存 DateTime 的格式一致
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f') if value else None
+
+
+def _parse_record(record):
+    """
+    把一条导出记录转换为 (内容摘要, 请求列值, 响应列值或 None)，id 列留空，写库时再分配
+    支持 /api/export 的 {"request": ..., "response": ...} 格式，也支持每行只有一个请求体的流量转储
+    """
+    if not isinstance(record, dict):
+        return None
+    req = record.get('request')
+    resp = record.get('response')
+    if not isinstance(req, dict):
+        if not isinstance(record.get('messages'), list):
+            return None
+        # 只有请求体的转储：按 chat completions 请求保存
+        req = {'method': 'POST', 'path': '/chat/completions', 'model': record.get('model'),
+               'body': {'original': record, 'modified': record}}
+        resp = None
+
+    timestamp = _parse_time(req.get('timestamp'))
+    body = _dumps(req.get('body'))
+    method = req.get('method') or 'POST'
+    path = req.get('path')
+    model = req.get('model')
+    if model is None and isinstance(req.get('body'), dict):
+        original = req['body'].get('original')
+        model = original.get('model') if isinstance(original, dict) else req['body'].get('model')
+    digest = content_hash(method, path, timestamp.isoformat() if timestamp else None, body)
+    request_row = [None, _to_sql_time(timestamp or datetime.utcnow()), method, path, _dumps(req.get('headers')), body,
+                   req.get('api_service'), model, req.get('original_url'), req.get('key_tag'), req.get('client'),
+                   req.get('tenant'), req.get('estimated_tokens'),
+                   req.get('cache_breakpoints'), digest]
+
+    response_row = None
+    if isinstance(resp, dict):
+        response_body = resp.get('body')
+        if response_body is not None and not isinstance(response_body, str):
+            response_body = json.dumps(response_body, ensure_ascii=False)
+        is_stream = bool(resp.get('is_stream'))
+        prompt_tokens = resp.get('prompt_tokens')
+        completion_tokens = resp.get('completion_tokens')
+        cached_tokens = resp.get('cached_tokens')
+        if prompt_tokens is None:
+            usage = extract_usage(response_body, is_stream=is_stream) or {}
+            prompt_tokens = usage.get('prompt_tokens')
+            completion_tokens = usage.get('completion_tokens')
+            cached_tokens = usage.get('cached_tokens')
+        gaps = resp.get('chunk_gaps')
+        response_row = [None, None, resp.get('status_code'), _dumps(resp.get('headers')), response_body, is_stream,
+                        resp.get('time_taken'), _dumps(resp.get('timing')),
+                        pack_gaps(gaps_from_ms(gaps)) if isinstance(gaps, list) else None,
+                        prompt_tokens, completion_tokens, cached_tokens, resp.get('cost')]
+    return digest, request_row, response_row
+
+
+def parse_block(lines):
+    """在解析进程中执行：解析一块 NDJSON 行，返回 (记录列表, 无效行数)"""
+    records = []
+    invalid = 0
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            parsed = _parse_record(json.loads(line))
+        except (ValueError, TypeError):
+            parsed = None
+        if parsed is None:
+            invalid += 1
+        else:
+            records.append(parsed)
+    return records, invalid
+
+
+class Checkpoint:
+    """记录每个输入文件已提交的行数，中断后重新执行时从该位置继续"""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def done_lines(self, source):
+        return self.state.get(os.path.abspath(source), 0)
+
+    def update(self, source, lines):
+        if not self.path:
+            return
+        self.state[os.path.abspath(source)] = lines
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+class ImportReadError(Exception):
+    """读取或解压导入文件失败（如 gzip 文件被截断），由读取线程交给主线程抛出"""
+
+
+def _read_blocks(sources, checkpoint, batch_size, out):
+    """
+    读取线程：逐个文件读取（解压）并按块放入队列，跳过检查点之前已提交的行
+    出错时把 ImportReadError 放入队列，由主线程抛出，不会被当作正常读完
+    """
+    source = None
+    try:
+        for source in sources:
+            skip = checkpoint.done_lines(source)
+            if skip:
+                print(f"{source}: 从第 {skip + 1} 行继续导入")
+            line_no = 0
+            block = []
+            with _open_lines(source) as f:
+                for line in f:
+                    line_no += 1
+                    if line_no <= skip:
+                        continue
+                    block.append(line)
+                    if len(block) >= batch_size:
+                        out.put((source, line_no, block))
+                        block = []
+            if block:
+                out.put((source, line_no, block))
+    except Exception as e:
+        error = ImportReadError(f'读取 {source} 失败: {str(e)}')
+        error.__cause__ = e
+        out.put(error)
+    finally:
+        out.put(None)
+
+
+def _existing_hashes(cursor, hashes):
+    found = set()
+    hashes = list(hashes)
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        cursor.execute(f"SELECT content_hash FROM request WHERE content_hash IN ({','.join('?' * len(chunk))})",
+                       chunk)
+        found.update(row[0] for row in cursor.fetchall())
+    return found
+
+
+def _deferred_indexes():
+    return [index for table in (RequestModel.__table__, ResponseModel.__table__)
+            for index in table.indexes if index.name not in KEEP_INDEXES]
+
+
+def _fill_missing_hashes(connection, batch_size):
+    """为没有内容摘要的历史请求补算摘要，保证导入本实例的导出文件时也能去重"""
+    cursor = connection.cursor()
+    filled = 0
+    last_id = 0
+    while True:
+        cursor.execute("SELECT id, method, path, timestamp, body FROM request "
+                       "WHERE id > ? AND content_hash IS NULL ORDER BY id LIMIT ?", (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        updates = []
+        for row_id, method, path, timestamp, body in rows:
+            parsed = _parse_time(timestamp)
+            updates.append((content_hash(method, path, parsed.isoformat() if parsed else None, body), row_id))
+        cursor.executemany("UPDATE request SET content_hash = ? WHERE id = ?", updates)
+        connection.commit()
+        filled += len(rows)
+        last_id = rows[-1][0]
+    if filled:
+        print(f"已为 {filled} 条历史请求补算内容摘要")
+
+
+def import_files(sources, batch_size=IMPORT_BATCH_SIZE, workers=None, checkpoint_path=None, defer_indexes=True):
+    """
+    批量导入 NDJSON（支持 .gz）流量转储
+    读取线程负责读取和解压，解析进程池负责 JSON 解析和摘要计算，主线程按原始顺序以
+    executemany 批量写入，每块一个事务并显式分配 id；导入期间暂时删除非必要索引，结束后重建
+    :return: (新增记录数, 重复跳过数, 无效行数)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    checkpoint = Checkpoint(checkpoint_path)
+    deferred = _deferred_indexes() if defer_indexes else []
+
+    raw = db.engine.raw_connection()
+    connection = raw.driver_connection
+    cursor = connection.cursor()
+    _fill_missing_hashes(connection, batch_size)
+    for index in deferred:
+        cursor.execute(f'DROP INDEX IF EXISTS "{index.name}"')
+    connection.commit()
+
+    blocks = queue.Queue(maxsize=max(workers, 1) * 2)
+    threading.Thread(target=_read_blocks, args=(sources, checkpoint, batch_size, blocks),
+                     name='import-reader', daemon=True).start()
+    # 读取线程已在运行，使用 spawn 启动解析进程，避免在多线程进程中 fork
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+        if workers > 1 else None
+
+    inserted = duplicates = invalid = 0
+    started = time.time()
+    pending = deque()
+    reading = True
+    try:
+        while reading or pending:
+            # 保持解析进程忙碌，同时按提交顺序写库，检查点才能准确记录已完成的行
+            while reading and len(pending) < max(workers, 1) * 2:
+                item = blocks.get()
+                if item is None:
+                    reading = False
+                    break
+                if isinstance(item, ImportReadError):
+                    # 尚未写入的块全部放弃，检查点停在最后一个已提交的块，再次执行时从那里继续
+                    raise item
+                source, line_no, lines = item
+                future = executor.submit(parse_block, lines) if executor else None
+                pending.append((source, line_no, future if future else parse_block(lines)))
+            if not pending:
+                break
+            source, line_no, result = pending.popleft()
+            records, bad = result.result() if executor else result
+            invalid += bad
+
+            cursor.execute('BEGIN IMMEDIATE')
+            seen = _existing_hashes(cursor, {digest for digest, _, _ in records})
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM request')
+            next_request_id = cursor.fetchone()[0] + 1
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM response')
+            next_response_id = cursor.fetchone()[0] + 1
+            request_rows = []
+            response_rows = []
+            for digest, request_row, response_row in records:
+                if digest in seen:
+                    duplicates += 1
+                    continue
+                seen.add(digest)
+                request_row[0] = next_request_id
+                request_rows.append(request_row)
+                if response_row is not None:
+                    response_row[0] = next_response_id
+                    response_row[1] = next_request_id
+                    response_rows.append(response_row)
+                    next_response_id += 1
+                next_request_id += 1
+            cursor.executemany(f"INSERT INTO request ({', '.join(REQUEST_FIELDS)}) "
+                               f"VALUES ({', '.join('?' * len(REQUEST_FIELDS))})", request_rows)
+            cursor.executemany(f"INSERT INTO response ({', '.join(RESPONSE_FIELDS)}) "
+                               f"VALUES ({', '.join('?' * len(RESPONSE_FIELDS))})", response_rows)
+            connection.commit()
+            checkpoint.update(source, line_no)
+
+            inserted += len(request_rows)
+            elapsed = max(time.time() - started, 1e-6)
+            print(f"导入进度: 新增 {inserted} 条, 重复 {duplicates} 条, 无效 {invalid} 行, {inserted / elapsed:.0f} 条/秒")
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if connection.in_transaction:
+            connection.rollback()
+        raw.close()
+        if deferred:
+            print(f"重建索引: {', '.join(index.name for index in deferred)}")
+            for index in deferred:
+                index.create(bind=db.engine, checkfirst=True)
+
+    print(f"导入完成: 新增 {inserted} 条, 重复 {duplicates} 条, 无效 {invalid} 行, 耗时 {time.time() - started:.1f} 秒")
+    return inserted, duplicates, invalid
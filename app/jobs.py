@@ -0,0 +1,237 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from datetime import datetime, time as dt_time
+
+from sqlalchemy import select, func
+
+from app import db, export
+from app.models import Request as RequestModel, Response as ResponseModel
+from app.partitions import store as partition_store
+from app.hotcache import cache as hot_cache
+
+# 每个事务删除的请求数，每次只短暂占用写锁
+DELETE_CHUNK_SIZE = 500
+# 两个事务之间的间隔（秒），让代理的捕获写入有机会拿到写锁
+CHUNK_PAUSE = 0.05
+# 最多保留的已结束任务数
+MAX_FINISHED_JOBS = 100
+
+REQUEST_TABLE = RequestModel.__table__
+RESPONSE_TABLE = ResponseModel.__table__
+
+
+class JobCancelled(Exception):
+    """任务被取消"""
+
+
+class Job:
+    """一个后台任务的状态和进度，status 为 pending/running/done/failed/cancelled"""
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.params = params
+        self.status = 'pending'
+        self.total = None  # 开始执行后统计的待处理请求数
+        self.done = 0
+        self.deleted_responses = 0
+        self.error = None
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def check_cancelled(self):
+        if self.cancel_requested:
+            raise JobCancelled()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'deleted_responses': self.deleted_responses,
+            'progress': round(self.done / self.total, 4) if self.total else (1.0 if self.status == 'done' else 0.0),
+            'error': self.error,
+            'created_at': datetime.utcfromtimestamp(self.created_at).isoformat(),
+            'started_at': datetime.utcfromtimestamp(self.started_at).isoformat() if self.started_at else None,
+            'finished_at': datetime.utcfromtimestamp(self.finished_at).isoformat() if self.finished_at else None,
+        }
+
+
+class JobRunner:
+    """
+    后台任务：每个任务一个线程，同一时间只执行一个任务，后提交的任务排队等待
+    任务状态只保存在本进程内，多 worker 部署时需要向提交任务的 worker 查询进度
+    """
+
+    def __init__(self):
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    def submit(self, app, kind, params, func):
+        """提交任务，func(job) 在应用上下文中执行，返回 Job"""
+        job = Job(kind, params)
+        with self._lock:
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, item in self._jobs.items() if item.finished]
+            for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+                del self._jobs[job_id]
+        threading.Thread(target=self._run, args=(app, job, func), name=f'job-{job.id}', daemon=True).start()
+        return job
+
+    def _run(self, app, job, func):
+        with self._run_lock:
+            job.started_at = time.time()
+            job.status = 'running'
+            with app.app_context():
+                try:
+                    job.check_cancelled()
+                    func(job)
+                    job.status = 'done'
+                except JobCancelled:
+                    job.status = 'cancelled'
+                except Exception as e:
+                    db.session.rollback()
+                    job.status = 'failed'
+                    job.error = str(e)
+                    print(f"后台任务 {job.kind} ({job.id}) 失败: {str(e)}")
+            job.finished_at = time.time()
+            print(f"后台任务 {job.kind} ({job.id}) 结束: {job.status}, 已处理 {job.done} 条, "
+                  f"耗时 {job.finished_at - job.started_at:.1f} 秒")
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def cancel(self, job_id):
+        """请求取消任务，正在执行的任务在当前批次提交后停止；返回任务，不存在时返回 None"""
+        job = self._jobs.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel_requested = True
+        return job
+
+
+runner = JobRunner()
+
+
+# 批量删除
+
+def parse_delete_filter(data):
+    """
+    解析批量删除的过滤条件，参数无效时抛出 ValueError
+    :param data: {"ids": [...], "start", "end", "model", "api_service", "tenant", "status"}，至少需要一个条件
+    """
+    filters = export.parse_filters(data)
+    ids = data.get('ids')
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(value, int) and not isinstance(value, bool) for value in ids):
+            raise ValueError('ids 必须是整数列表')
+        filters['ids'] = sorted(set(ids))
+    else:
+        filters['ids'] = None
+    if not any(value is not None for value in filters.values()):
+        raise ValueError('至少需要一个过滤条件，清空所有记录请使用 DELETE /api/requests')
+    return filters
+
+
+def _chunks(session, conditions, ids, chunk_size):
+    """逐批选出要删除的请求 id：指定 id 列表时按列表分批，否则按 id 顺序分批（keyset）"""
+    if ids is not None:
+        for i in range(0, len(ids), chunk_size):
+            chunk = session.execute(select(REQUEST_TABLE.c.id)
+                                    .where(REQUEST_TABLE.c.id.in_(ids[i:i + chunk_size]), *conditions)).scalars().all()
+            if chunk:
+                yield chunk
+        return
+    last_id = 0
+    while True:
+        chunk = session.execute(select(REQUEST_TABLE.c.id).where(REQUEST_TABLE.c.id > last_id, *conditions)
+                                .order_by(REQUEST_TABLE.c.id).limit(chunk_size)).scalars().all()
+        if not chunk:
+            return
+        last_id = chunk[-1]
+        yield chunk
+
+
+def _delete_in_session(job, session, conditions, ids, chunk_size, pause, id_base=0):
+    """在一个数据库中分批删除，每批一个短事务：先删响应再删请求，提交后从最近捕获缓存中移除"""
+    for chunk in _chunks(session, conditions, ids, chunk_size):
+        job.check_cancelled()
+        result = session.execute(RESPONSE_TABLE.delete().where(RESPONSE_TABLE.c.request_id.in_(chunk)))
+        job.deleted_responses += result.rowcount
+        session.execute(REQUEST_TABLE.delete().where(REQUEST_TABLE.c.id.in_(chunk)))
+        session.commit()
+        hot_cache.evict_many([id_base + local_id for local_id in chunk])
+        job.done += len(chunk)
+        if pause:
+            time.sleep(pause)
+
+
+def _count(session, conditions, ids):
+    query = select(func.count()).select_from(REQUEST_TABLE).where(*conditions)
+    if ids is None:
+        return session.execute(query).scalar()
+    return sum(session.execute(query.where(REQUEST_TABLE.c.id.in_(ids[i:i + DELETE_CHUNK_SIZE]))).scalar()
+               for i in range(0, len(ids), DELETE_CHUNK_SIZE))
+
+
+def bulk_delete(job, ids=None, chunk_size=DELETE_CHUNK_SIZE, pause=CHUNK_PAUSE, **filters):
+    """
+    按过滤条件批量删除捕获记录，ids 为对外使用的请求 id
+    分区模式下只处理时间范围和 id 所在的分区；只按时间过滤且完全覆盖一个已关闭的分区时直接删除分区文件
+    """
+    conditions = export.filter_conditions(**filters)
+    if not partition_store.enabled:
+        job.total = _count(db.session, conditions, ids)
+        db.session.rollback()
+        _delete_in_session(job, db.session, conditions, ids, chunk_size, pause)
+        return
+
+    start, end = filters.get('start'), filters.get('end')
+    local_ids = None
+    keys = partition_store.existing(start, end)
+    if ids is not None:
+        local_ids = {}
+        for public_id in ids:
+            key, local_id = partition_store.split_id(public_id)
+            if key is not None:
+                local_ids.setdefault(key, []).append(local_id)
+        keys = [key for key in keys if key in local_ids]
+    time_only = ids is None and not any(filters.get(name) for name in ('model', 'api_service', 'tenant', 'status'))
+
+    plan = []
+    for key in keys:
+        whole = time_only and partition_store.closed(key) \
+            and (start is None or start <= datetime.combine(key, dt_time())) \
+            and (end is None or end >= datetime.combine(partition_store.next_key(key), dt_time()))
+        with partition_store.session(key) as capture_session:
+            count = _count(capture_session, conditions, local_ids[key] if local_ids is not None else None)
+        plan.append((key, whole, count))
+    job.total = sum(count for _, _, count in plan)
+
+    for key, whole, count in plan:
+        job.check_cancelled()
+        base = partition_store.base_of(key)
+        if whole:
+            partition_store.drop(key)
+            hot_cache.evict_range(base, partition_store.base_of(partition_store.next_key(key)))
+            job.done += count
+            continue
+        with partition_store.session(key) as capture_session:
+            _delete_in_session(job, capture_session, conditions, local_ids[key] if local_ids is not None else None,
+                               chunk_size, pause, id_base=base)
+        partition_store.invalidate(key)
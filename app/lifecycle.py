@@ -0,0 +1,86 @@
+import threading
+import time
+
+# 进程退出前需要执行的清理函数（如写入未落库的捕获、刷新指标快照）
+_shutdown_hooks = []
+_shutdown_lock = threading.Lock()
+_shutdown_done = False
+
+
+def on_shutdown(func):
+    """注册进程退出前执行的清理函数，可作为装饰器使用"""
+    _shutdown_hooks.append(func)
+    return func
+
+
+def run_shutdown_hooks():
+    """按注册顺序执行清理函数，每个进程只执行一次"""
+    global _shutdown_done
+    with _shutdown_lock:
+        if _shutdown_done:
+            return
+        _shutdown_done = True
+    for func in _shutdown_hooks:
+        try:
+            func()
+        except Exception as e:
+            print(f"执行退出清理 {getattr(func, '__name__', func)} 失败: {str(e)}")
+
+
+class InflightTracker:
+    """
+    WSGI 中间件，统计尚未结束的请求数（流式响应在响应体迭代结束后才算完成）
+    用于优雅退出时等待进行中的 SSE 流转发完毕
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def _finish(self):
+        with self._lock:
+            self.count -= 1
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+        try:
+            iterable = self.wsgi_app(environ, start_response)
+        except Exception:
+            self._finish()
+            raise
+        return _ClosingIterator(iterable, self._finish)
+
+    def wait_idle(self, timeout):
+        """等待所有进行中的请求结束，返回是否在超时前完成"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.count <= 0:
+                return True
+            time.sleep(0.1)
+        return self.count <= 0
+
+
+class _ClosingIterator:
+    def __init__(self, iterable, on_close):
+        self._iterable = iterable
+        self._iterator = iter(iterable)
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._on_close()
@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import glob
+import atexit
+import threading
+from contextlib import contextmanager
+
+from app import lifecycle
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，归档时不加文件锁
+    fcntl = None
+
+# 多进程部署时，每个worker把自己的指标快照写入该目录，/metrics 汇总所有文件
+METRICS_DIR = os.environ.get('AI_HOOK_METRICS_DIR')
+FLUSH_INTERVAL = 5.0
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+DB_WRITE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# 指标定义: 名称 -> (类型, 说明, 分桶)
+METRICS = {
+    'aihook_requests_total': ('counter', '代理请求数', None),
+    'aihook_request_duration_seconds': ('histogram', '代理请求总耗时', LATENCY_BUCKETS),
+    'aihook_ttft_seconds': ('histogram', '流式请求首个内容token耗时', TTFT_BUCKETS),
+    'aihook_inflight_streams': ('gauge', '正在转发的流式请求数', None),
+    'aihook_upstream_bytes_total': ('counter', '从上游收到的响应体字节数', None),
+    'aihook_tokens_total': ('counter', '响应 usage 中报告的 token 数', None),
+    'aihook_cost_usd_total': ('counter', '按模型目录价格计算的费用（美元）', None),
+    'aihook_capture_writes_inflight': ('gauge', '正在写入数据库的捕获记录数（进行中的写库操作，不是队列长度）', None),
+    'aihook_db_write_seconds': ('histogram', '捕获记录写入数据库耗时', DB_WRITE_BUCKETS),
+    'aihook_capture_queue_depth': ('gauge', '等待后台线程写入的捕获记录数', None),
+    'aihook_captures_total': ('counter', '按捕获策略处理的调用数，mode 为 skipped 表示未保存', None),
+    'aihook_hotcache_reads_total': ('counter', '最近捕获缓存的读取次数，按是否命中区分', None),
+    'aihook_hotcache_entries': ('gauge', '最近捕获缓存中的请求数', None),
+    'aihook_hotcache_bytes': ('gauge', '最近捕获缓存占用的字节数（估算）', None),
+    'aihook_preflight_total': ('counter', '转发前预检的结果，rejected 为超出上下文长度在本地拒绝', None),
+    'aihook_prompt_cache_total': ('counter', '提示缓存改写的结果，marked 为插入了缓存断点', None),
+}
+
+
+class MetricsRegistry:
+    """进程内指标注册表，每次更新只在锁内做一次字典操作"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # (name, labels) -> 数值；直方图为 [各桶计数..., sum, count]
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self._lock:
+            self._values[(name, labels)] = value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        """导出可JSON序列化的快照: [[name, labels, value], ...]"""
+        with self._lock:
+            items = list(self._values.items())
+        return [[name, [list(pair) for pair in labels], list(value) if isinstance(value, list) else value]
+                for (name, labels), value in items]
+
+
+registry = MetricsRegistry()
+_flusher_started = False
+_flusher_lock = threading.Lock()
+_process_token = None  # (pid, 启动时间戳)，fork 后按新 pid 重新生成
+
+ARCHIVE_FILE = 'metrics_archived.json'
+
+
+def _labels(**kwargs):
+    return tuple(sorted((k, '' if v is None else str(v)) for k, v in kwargs.items()))
+
+
+def _snapshot_path():
+    """快照文件名带上进程启动时间，pid 被复用时不会覆盖已退出进程的数据"""
+    global _process_token
+    pid = os.getpid()
+    if _process_token is None or _process_token[0] != pid:
+        _process_token = (pid, int(time.time() * 1000))
+    return os.path.join(METRICS_DIR, f'metrics_{pid}_{_process_token[1]}.json')
+
+
+def flush_snapshot():
+    """把当前进程的指标写入共享目录（原子替换）"""
+    if not METRICS_DIR:
+        return
+    path = _snapshot_path()
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"写入指标快照失败: {str(e)}")
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush_snapshot()
+
+
+def _ensure_flusher():
+    global _flusher_started
+    if _flusher_started or not METRICS_DIR:
+        return
+    with _flusher_lock:
+        if _flusher_started:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        threading.Thread(target=_flush_loop, name='metrics-flusher', daemon=True).start()
+        atexit.register(flush_snapshot)
+        lifecycle.on_shutdown(flush_snapshot)
+        _flusher_started = True
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge_entries(merged, entries, include_gauges=True):
+    for name, labels, value in entries:
+        if name not in METRICS:
+            continue
+        if METRICS[name][0] == 'gauge' and not include_gauges:
+            continue
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if isinstance(value, list):
+            current = merged.get(key)
+            merged[key] = [a + b for a, b in zip(current, value)] if current else list(value)
+        else:
+            merged[key] = merged.get(key, 0) + value
+
+
+def _read_entries(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return []
+
+
+def _archive_dead(path):
+    """
+    把已退出进程的计数器和直方图并入归档文件后删除其快照，gauge 直接丢弃
+    先改名认领文件，多个 worker 同时汇总时只有一个会处理它
+    """
+    claimed = f'{path}.archiving.{os.getpid()}'
+    try:
+        os.rename(path, claimed)
+    except OSError:
+        return
+    archive_path = os.path.join(METRICS_DIR, ARCHIVE_FILE)
+    with open(os.path.join(METRICS_DIR, 'metrics_archive.lock'), 'a') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        merged = {}
+        _merge_entries(merged, _read_entries(archive_path))
+        _merge_entries(merged, _read_entries(claimed), include_gauges=False)
+        tmp_path = archive_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([[name, [list(pair) for pair in labels], value] for (name, labels), value in merged.items()], f)
+        os.replace(tmp_path, archive_path)
+        os.remove(claimed)
+
+
+def _collect():
+    """汇总所有进程的指标；已退出进程的快照归档后删除，计数器和直方图保留在归档中"""
+    if not METRICS_DIR:
+        return registry.snapshot()
+
+    flush_snapshot()
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics_*_*.json')):
+        try:
+            pid = int(os.path.basename(path).split('_')[1])
+        except (ValueError, IndexError):
+            continue
+        if not _pid_alive(pid):
+            try:
+                _archive_dead(path)
+            except OSError as e:
+                print(f"归档指标快照失败: {str(e)}")
+
+    merged = {}
+    _merge_entries(merged, _read_entries(os.path.join(METRICS_DIR, ARCHIVE_FILE)))
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics_*_*.json')):
+        _merge_entries(merged, _read_entries(path))
+    return [[name, labels, value] for (name, labels), value in merged.items()]
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = []
+    for k, v in pairs:
+        v = str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{k}="{v}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_metrics():
+    """按 Prometheus 文本格式输出所有指标"""
+    series = {}
+    for name, labels, value in _collect():
+        series.setdefault(name, []).append((tuple(tuple(pair) for pair in labels), value))
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in sorted(series.get(name, []), key=lambda item: item[0]):
+            if metric_type == 'histogram':
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, ("le", bound))} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, ("le", "+Inf"))} {value[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def stream_started(api_service):
+    _ensure_flusher()
+    registry.inc('aihook_inflight_streams', _labels(api_service=api_service), 1)
+
+
+def stream_finished(api_service):
+    registry.inc('aihook_inflight_streams', _labels(api_service=api_service), -1)
+
+
+def record_call(api_service, model, status_code, timing=None, usage=None, upstream_bytes=0, cost=None):
+    """一次代理调用结束后更新相关指标"""
+    _ensure_flusher()
+    registry.inc('aihook_requests_total', _labels(api_service=api_service, model=model, status=status_code))
+    series_labels = _labels(api_service=api_service, model=model)
+    timing = timing or {}
+    if timing.get('total') is not None:
+        registry.observe('aihook_request_duration_seconds', series_labels, timing['total'])
+    if timing.get('ttft') is not None:
+        registry.observe('aihook_ttft_seconds', series_labels, timing['ttft'])
+    if upstream_bytes:
+        registry.inc('aihook_upstream_bytes_total', series_labels, upstream_bytes)
+    if cost:
+        registry.inc('aihook_cost_usd_total', series_labels, cost)
+    if usage:
+        for token_type in ('prompt', 'completion', 'cached'):
+            count = usage.get(f'{token_type}_tokens')
+            if count:
+                registry.inc('aihook_tokens_total', _labels(api_service=api_service, model=model, type=token_type), count)
+
+
+@contextmanager
+def db_write(operation):
+    """统计捕获记录写库耗时，同时维护待写入数量"""
+    labels = _labels(operation=operation)
+    registry.inc('aihook_capture_writes_inflight', (), 1)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('aihook_db_write_seconds', labels, time.perf_counter() - start)
+        registry.inc('aihook_capture_writes_inflight', (), -1)
@@ -0,0 +1,132 @@
+import time
+import threading
+
+import requests
+
+# 模型目录缓存时长（秒），过期后在后台线程刷新，不阻塞请求
+REFRESH_INTERVAL = 3600
+# 刷新失败后的重试间隔（秒）
+RETRY_INTERVAL = 60
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _UpstreamCatalog:
+    """一个上游地址的模型目录"""
+
+    def __init__(self):
+        self.models = {}
+        self.updated_at = 0.0
+        self.refreshing = False
+
+
+class ModelCatalog:
+    """
+    模型目录的内存索引，数据来自上游的 /models 接口（OpenRouter 格式）
+    保存每个模型的单 token 价格和上下文长度，供计费、预检等功能快速查询
+    按上游地址分别保存：多租户转发到不同上游时，同名模型的价格和上下文长度以实际转发的上游为准
+    """
+
+    def __init__(self):
+        self._catalogs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(base_url):
+        return (base_url or '').rstrip('/')
+
+    def _catalog(self, base_url):
+        key = self._key(base_url)
+        upstream = self._catalogs.get(key)
+        if upstream is None:
+            with self._lock:
+                upstream = self._catalogs.setdefault(key, _UpstreamCatalog())
+        return upstream
+
+    def update(self, base_url, models):
+        """用上游 /models 返回的 data 列表重建该上游的索引，整体替换保证读取无需加锁"""
+        index = {}
+        for item in models or []:
+            if not isinstance(item, dict) or not item.get('id'):
+                continue
+            pricing = item.get('pricing') or {}
+            index[item['id']] = {
+                'prompt': _to_float(pricing.get('prompt')),
+                'completion': _to_float(pricing.get('completion')),
+                'cache_read': _to_float(pricing.get('input_cache_read')),
+                'request': _to_float(pricing.get('request')),
+                'context_length': item.get('context_length') or (item.get('top_provider') or {}).get('context_length'),
+            }
+        upstream = self._catalog(base_url)
+        upstream.models = index
+        upstream.updated_at = time.time()
+        print(f"模型目录已更新: {self._key(base_url)} {len(index)} 个模型")
+
+    def get(self, base_url, model):
+        upstream = self._catalogs.get(self._key(base_url))
+        return upstream.models.get(model) if upstream is not None and model else None
+
+    def __len__(self):
+        return sum(len(upstream.models) for upstream in list(self._catalogs.values()))
+
+    def is_stale(self, base_url):
+        return time.time() - self._catalog(base_url).updated_at > REFRESH_INTERVAL
+
+    def refresh(self, base_url, api_key, timeout=15):
+        """同步拉取模型目录，失败时保留旧索引并在 RETRY_INTERVAL 秒后再重试"""
+        headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+        try:
+            response = requests.get(f"{self._key(base_url)}/models", headers=headers, timeout=timeout)
+            if response.status_code == 200:
+                self.update(base_url, response.json().get('data', []))
+                return True
+            print(f"刷新模型目录失败: {response.status_code}")
+        except Exception as e:
+            print(f"刷新模型目录异常: {str(e)}")
+        # 失败时把下一次刷新推迟到重试间隔之后，避免每个请求都去重试
+        self._catalog(base_url).updated_at = time.time() - REFRESH_INTERVAL + RETRY_INTERVAL
+        return False
+
+    def refresh_in_background(self, base_url, api_key):
+        """该上游的目录过期时启动一个后台刷新线程，同一上游同一时间只刷新一次"""
+        if not self.is_stale(base_url):
+            return
+        upstream = self._catalog(base_url)
+        with self._lock:
+            if upstream.refreshing:
+                return
+            upstream.refreshing = True
+
+        def run():
+            try:
+                self.refresh(base_url, api_key)
+            finally:
+                with self._lock:
+                    upstream.refreshing = False
+
+        threading.Thread(target=run, name='model-catalog-refresh', daemon=True).start()
+
+    def compute_cost(self, base_url, model, usage):
+        """
+        按转发目标上游的目录价格计算一次调用的费用（美元）
+        命中提示缓存的输入 token 优先按缓存读取价计费
+        :return: 费用，模型不在目录中或没有用量时返回 None
+        """
+        entry = self.get(base_url, model)
+        if not entry or not usage or entry['prompt'] is None or entry['completion'] is None:
+            return None
+        cached = min(usage.get('cached_tokens') or 0, usage.get('prompt_tokens') or 0)
+        cache_price = entry['cache_read'] if entry['cache_read'] is not None else entry['prompt']
+        cost = ((usage.get('prompt_tokens') or 0) - cached) * entry['prompt'] \
+            + cached * cache_price \
+            + (usage.get('completion_tokens') or 0) * entry['completion'] \
+            + (entry['request'] or 0)
+        return round(cost, 8)
+
+
+catalog = ModelCatalog()
@@ -1,7 +1,20 @@
 from app import db
 from datetime import datetime
+import hashlib
 import json
 
+def content_hash(method, path, timestamp, body):
+    """
+    请求内容的摘要，用于导入时去重
+    :param timestamp: ISO 格式的时间字符串
+    :param body: 数据库中保存的请求体 JSON 字符串
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (method, path, timestamp, body):
+        digest.update((part or '').encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
 class Request(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -12,6 +25,17 @@ class Request(db.Model):
     api_service = db.Column(db.String)  # 存储API服务名称
     model = db.Column(db.String)  # 存储模型名称
     original_url = db.Column(db.String)  # 存储原始完整URL
+    key_tag = db.Column(db.String)  # 转发时使用的API Key（脱敏）
+    client = db.Column(db.String)  # 调用方地址
+    content_hash = db.Column(db.String, index=True)  # 请求内容摘要，导入时去重
+    prefix_hash = db.Column(db.String, index=True)  # messages 完整前缀的滚动摘要
+    message_count = db.Column(db.Integer)  # messages 条数
+    parent_id = db.Column(db.Integer)  # 同一对话的上一轮请求
+    thread_id = db.Column(db.Integer, index=True)  # 对话 id，即对话第一轮请求的 id
+    tenant = db.Column(db.String, index=True)  # 按租户路由表匹配到的租户
+    diff = db.Column(db.Text)  # 原始请求与转发请求的差异，首次查看时计算并存储为JSON字符串
+    estimated_tokens = db.Column(db.Integer)  # 转发前预检估算的输入 token 数
+    cache_breakpoints = db.Column(db.Integer)  # 代理插入的提示缓存断点数，未启用时为空
     responses = db.relationship('Response', backref='request', lazy=True)
     
     def set_headers(self, headers_dict):
@@ -25,24 +49,98 @@ class Request(db.Model):
         
     def get_body(self):
         return json.loads(self.body) if self.body else {}
+    
+    def update_content_hash(self):
+        self.content_hash = content_hash(self.method, self.path,
+                                         self.timestamp.isoformat() if self.timestamp else None, self.body)
 
 class Response(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    request_id = db.Column(db.Integer, db.ForeignKey('request.id'))
+    request_id = db.Column(db.Integer, db.ForeignKey('request.id'), index=True)
     status_code = db.Column(db.Integer)
     headers = db.Column(db.Text)  # 存储为JSON字符串
     body = db.Column(db.Text)
     is_stream = db.Column(db.Boolean, default=False)
     time_taken = db.Column(db.Float)  # 以秒为单位
+    timing = db.Column(db.Text)  # 各阶段耗时，存储为JSON字符串
+    chunk_gaps = db.Column(db.LargeBinary)  # 相邻chunk间隔（微秒），版本字节 + 小端uint32数组，见 timing.pack_gaps
+    prompt_tokens = db.Column(db.Integer)  # 响应 usage 中的输入 token 数
+    completion_tokens = db.Column(db.Integer)  # 响应 usage 中的输出 token 数
+    cached_tokens = db.Column(db.Integer)  # 命中提示缓存的输入 token 数
+    cost = db.Column(db.Float)  # 按模型目录价格计算的费用（美元）
     
     def set_headers(self, headers_dict):
         self.headers = json.dumps(dict(headers_dict))
         
     def get_headers(self):
         return json.loads(self.headers) if self.headers else {}
+    
+    def set_timing(self, timing_dict):
+        self.timing = json.dumps(timing_dict)
+        
+    def get_timing(self):
+        return json.loads(self.timing) if self.timing else {}
+
+class UsageRollup(db.Model):
+    """按小时、模型、服务、Key和调用方汇总的用量、费用与延迟，捕获时增量更新"""
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime)  # 小时桶起点（UTC）
+    model = db.Column(db.String)  # 实际转发的模型
+    api_service = db.Column(db.String)
+    key_tag = db.Column(db.String)
+    client = db.Column(db.String)
+    request_count = db.Column(db.Integer, default=0)
+    error_count = db.Column(db.Integer, default=0)
+    stream_count = db.Column(db.Integer, default=0)
+    prompt_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    cached_tokens = db.Column(db.Integer, default=0)
+    cost_sum = db.Column(db.Float, default=0.0)
+    latency_sum = db.Column(db.Float, default=0.0)
+    latency_sketch = db.Column(db.Text)  # LatencySketch 序列化
+    ttft_sketch = db.Column(db.Text)  # LatencySketch 序列化
+
+    __table_args__ = (
+        db.Index('ix_usage_rollup_key', 'bucket_start', 'model', 'api_service'),
+        # 每个分组只有一行；分组字段可能为空，SQLite 唯一索引中 NULL 互不相等，按空字符串比较
+        db.Index('ux_usage_rollup_group', 'bucket_start', db.text("ifnull(model, '')"),
+                 db.text("ifnull(api_service, '')"), db.text("ifnull(key_tag, '')"), db.text("ifnull(client, '')"),
+                 unique=True),
+    )
 
 class AdminUser(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
-    force_change = db.Column(db.Boolean, default=True)  # 首次登录后强制改密 
\ No newline at end of file
+    force_change = db.Column(db.Boolean, default=True)  # 首次登录后强制改密 
+
+def index_names(engine, table_name):
+    """表上已有的索引名；直接查询 sqlite_master，反射接口会跳过表达式索引"""
+    with engine.connect() as conn:
+        return set(conn.execute(db.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name"),
+                                {'name': table_name}).scalars())
+
+def upgrade_schema(bind=None, tables=None):
+    """
+    为已存在的旧表补充模型中新增的列和索引（db.create_all 不会修改已有的表）
+    :param bind: 要升级的数据库引擎，默认为主数据库
+    :param tables: 要升级的表，默认为全部
+    """
+    engine = bind or db.engine
+    inspector = db.inspect(engine)
+    for table in tables or db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+            print(f"数据表升级: {table.name} 新增列 {column.name} ({column_type})")
+        existing_indexes = index_names(engine, table.name)
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+                print(f"数据表升级: {table.name} 新增索引 {index.name}")
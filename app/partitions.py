@@ -0,0 +1,365 @@
+import os
+import glob
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+
+from sqlalchemy import create_engine, event, select, delete, func
+from sqlalchemy.orm import Session
+
+from app import db, _configure_sqlite
+from app.models import Request as RequestModel, Response as ResponseModel, upgrade_schema
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，删除分区时不加文件锁
+    fcntl = None
+
+PERIODS = ('day', 'week')
+# 分区模式下对外使用的全局 id = 分区起始日期序号 * ID_STRIDE + 分区内 id，由 id 可直接定位分区文件
+ID_STRIDE = 10 ** 9
+# SQLite 默认最多同时 ATTACH 10 个数据库，超过时分组查询
+MAX_ATTACHED = 10
+FILE_PREFIX = 'captures-'
+# 删除分区文件时持有的跨进程文件锁，打开（新建）分区时持有共享锁
+LOCK_FILE = '.partitions.lock'
+# 分区结束后仍可能收到跨越边界的长请求的响应，超过该时间才视为已关闭、允许删除文件
+CLOSE_GRACE = timedelta(hours=1)
+CAPTURE_TABLES = (RequestModel.__table__, ResponseModel.__table__)
+
+
+def _file_id(path):
+    """分区文件的 inode，文件不存在时为 None；其它进程删除并重建分区后 inode 会变化"""
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
+
+
+def _file_version(path):
+    """分区文件及其 WAL 的修改时间，用于判断缓存的记录数是否仍然有效（包括其它进程的写入）"""
+    version = []
+    for suffix in ('', '-wal'):
+        try:
+            stat = os.stat(path + suffix)
+            version.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def _parse_time(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+class PartitionStore:
+    """
+    按天或按周把捕获记录（request/response 表）写入独立的 SQLite 分区文件
+    汇总表、管理员等其它数据仍在主数据库；删除旧数据只需删除已关闭的分区文件
+    多 worker 及命令行进程各自缓存分区引擎，使用前检查文件是否已被其它进程删除
+    """
+
+    def __init__(self):
+        self.period = None
+        self.directory = None
+        self._engines = {}  # 分区起始日期 -> (引擎, 打开时的文件 inode)
+        self._counts = {}  # 已结束分区的 (文件版本, 记录数) 缓存
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.period is not None
+
+    def configure(self, period, directory):
+        if period and period not in PERIODS:
+            raise ValueError(f'分区周期只支持: {", ".join(PERIODS)}')
+        self.dispose()
+        self.period = period or None
+        self.directory = directory
+
+    def dispose(self, close=True):
+        """释放所有分区的连接池，fork 之后以 close=False 调用"""
+        with self._lock:
+            for engine, _ in self._engines.values():
+                engine.dispose(close=close)
+            self._engines = {}
+
+    # 分区与 id 的换算
+
+    def key_for(self, timestamp):
+        """时间所在分区的起始日期"""
+        day = (timestamp or datetime.utcnow()).date()
+        if self.period == 'week':
+            day -= timedelta(days=day.weekday())
+        return day
+
+    def next_key(self, key):
+        return key + timedelta(days=7 if self.period == 'week' else 1)
+
+    def closed(self, key):
+        """分区是否已结束足够久，不会再有新的请求或迟到的响应写入"""
+        return datetime.combine(self.next_key(key), dt_time()) + CLOSE_GRACE <= datetime.utcnow()
+
+    def base_of(self, key):
+        return key.toordinal() * ID_STRIDE
+
+    def global_id(self, key, local_id):
+        return None if local_id is None else self.base_of(key) + local_id
+
+    def split_id(self, global_id):
+        """把全局 id 拆分为 (分区起始日期, 分区内 id)，不是分区 id 时返回 (None, None)"""
+        ordinal, local_id = divmod(global_id, ID_STRIDE)
+        if ordinal <= 0 or local_id <= 0:
+            return None, None
+        return date.fromordinal(ordinal), local_id
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f'{FILE_PREFIX}{key:%Y%m%d}.db')
+
+    def existing(self, start=None, end=None):
+        """按时间升序返回与 [start, end) 有交集的已存在分区"""
+        keys = []
+        for path in glob.glob(os.path.join(self.directory, f'{FILE_PREFIX}*.db')):
+            try:
+                key = datetime.strptime(os.path.basename(path)[len(FILE_PREFIX):-3], '%Y%m%d').date()
+            except ValueError:
+                continue
+            if end is not None and datetime.combine(key, dt_time()) >= end:
+                continue
+            if start is not None and datetime.combine(self.next_key(key), dt_time()) <= start:
+                continue
+            keys.append(key)
+        return sorted(keys)
+
+    # 读写
+
+    @contextmanager
+    def _file_lock(self, exclusive):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def engine(self, key, create=True):
+        """
+        分区的数据库引擎，首次使用时建表并升级表结构；create=False 时分区不存在返回 None
+        缓存的引擎对应的文件已被其它进程删除时释放旧引擎，按需重新打开
+        """
+        path = self.path_for(key)
+        with self._lock:
+            cached = self._engines.get(key)
+            if cached is not None:
+                engine, file_id = cached
+                if _file_id(path) == file_id:
+                    return engine
+                engine.dispose()
+                del self._engines[key]
+                self._counts.pop(key, None)
+            if not create and not os.path.exists(path):
+                return None
+            with self._file_lock(exclusive=False):
+                engine = create_engine('sqlite:///' + path, connect_args={'timeout': 30})
+                event.listen(engine, 'connect', _configure_sqlite)
+                db.metadata.create_all(engine, tables=CAPTURE_TABLES)
+                upgrade_schema(bind=engine, tables=CAPTURE_TABLES)
+                file_id = _file_id(path)
+            self._engines[key] = (engine, file_id)
+            return engine
+
+    def session(self, key, create=True):
+        """分区的 ORM 会话，提交后对象不过期，调用方负责关闭；分区不存在且 create=False 时返回 None"""
+        engine = self.engine(key, create=create)
+        return Session(bind=engine, expire_on_commit=False) if engine is not None else None
+
+    def drop(self, key):
+        """
+        删除一个已关闭的分区文件，未关闭的分区（当前分区或刚结束不久）仍可能有写入，抛出 ValueError
+        持有跨进程文件锁，其它进程下次使用该分区时发现文件已删除，自动释放各自的引擎
+        """
+        if not self.closed(key):
+            raise ValueError(f'分区 {key.isoformat()} 尚未关闭，不能删除分区文件')
+        path = self.path_for(key)
+        with self._lock, self._file_lock(exclusive=True):
+            cached = self._engines.pop(key, None)
+            if cached is not None:
+                cached[0].dispose()
+            self._counts.pop(key, None)
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def clear(self, key):
+        """删除分区内的全部记录但保留文件，用于仍可能有写入的未关闭分区"""
+        engine = self.engine(key, create=False)
+        if engine is None:
+            return
+        request_table, response_table = CAPTURE_TABLES
+        with engine.begin() as conn:
+            conn.execute(delete(response_table))
+            conn.execute(delete(request_table))
+        self.invalidate(key)
+
+    def invalidate(self, key):
+        self._counts.pop(key, None)
+
+    def count(self, key):
+        """分区内的请求数，已结束的分区在文件未变化（包括其它进程的写入和删除）时只统计一次"""
+        path = self.path_for(key)
+        version = _file_version(path)
+        cached = self._counts.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with self.engine(key).connect() as conn:
+            count = conn.execute(select(func.count()).select_from(RequestModel.__table__)).scalar()
+        if key < self.key_for(datetime.utcnow()):
+            self._counts[key] = (version, count)
+        return count
+
+    @contextmanager
+    def attached(self, keys):
+        """把若干分区 ATTACH 到一个临时连接上，返回 (连接, [(别名, 分区起始日期), ...])"""
+        conn = sqlite3.connect(':memory:', timeout=30)
+        try:
+            aliases = []
+            for i, key in enumerate(keys):
+                alias = f'p{i}'
+                conn.execute(f'ATTACH DATABASE ? AS {alias}', (self.path_for(key),))
+                aliases.append((alias, key))
+            yield conn, aliases
+        finally:
+            conn.close()
+
+    def union_query(self, keys, part_sql, params=(), tail_sql='', tail_params=()):
+        """
+        对多个分区执行 UNION ALL 查询，part_sql 中用 {db} 表示分区别名、{base} 表示该分区的 id 偏移
+        分区数超过 MAX_ATTACHED 时按组分别查询后拼接结果
+        """
+        rows = []
+        for i in range(0, len(keys), MAX_ATTACHED):
+            with self.attached(keys[i:i + MAX_ATTACHED]) as (conn, aliases):
+                sql = ' UNION ALL '.join(part_sql.format(db=alias, base=self.base_of(key)) for alias, key in aliases)
+                rows.extend(conn.execute(sql + tail_sql, tuple(params) * len(aliases) + tuple(tail_params)).fetchall())
+        return rows
+
+    def total(self):
+        """所有分区的请求总数"""
+        return sum(self.count(key) for key in self.existing())
+
+    def list_requests(self, page, per_page):
+        """按时间倒序分页列出请求，只 ATTACH 当前页涉及的分区，返回 (记录列表, 总数)"""
+        counts = [(key, self.count(key)) for key in reversed(self.existing())]
+        total = sum(count for _, count in counts)
+        offset = max(page - 1, 0) * per_page
+        needed = []
+        first_offset = None
+        remaining = per_page
+        for key, count in counts:
+            if first_offset is None:
+                if offset >= count:
+                    offset -= count
+                    continue
+                first_offset = offset
+                remaining -= count - offset
+            else:
+                remaining -= count
+            needed.append(key)
+            if remaining <= 0:
+                break
+
+        items = []
+        part_sql = ('SELECT {base} + q.id, q.timestamp, q.method, q.path, '
+                    'EXISTS(SELECT 1 FROM {db}.response r WHERE r.request_id = q.id) FROM {db}.request q')
+        for i in range(0, len(needed), MAX_ATTACHED):
+            # 分区按时间划分，组内按时间排序即为整体顺序，只有第一组需要跳过前面的记录
+            group = needed[i:i + MAX_ATTACHED]
+            rows = self.union_query(group, part_sql, tail_sql=' ORDER BY 2 DESC LIMIT ? OFFSET ?',
+                                    tail_params=(per_page - len(items), first_offset if i == 0 else 0))
+            for row_id, timestamp, method, path, has_response in rows:
+                items.append({
+                    'id': row_id,
+                    'timestamp': _parse_time(timestamp).isoformat() if timestamp else None,
+                    'method': method,
+                    'path': path,
+                    'has_response': bool(has_response),
+                })
+        return items, total
+
+    def migrate_from_main(self, batch_size=1000):
+        """
+        把主数据库中的捕获记录按时间迁移到分区文件，迁移完的记录从主数据库删除，中断后可重新执行
+        请在服务停止时执行；对话的 parent_id/thread_id 会换算为新的全局 id
+        """
+        id_map = {}
+        moved = 0
+        started = time.time()
+        request_table, response_table = CAPTURE_TABLES
+        while True:
+            rows = db.session.execute(select(request_table).order_by(request_table.c.id).limit(batch_size)).mappings().all()
+            if not rows:
+                break
+            ids = [row['id'] for row in rows]
+            responses = {}
+            for resp in db.session.execute(select(response_table).where(response_table.c.request_id.in_(ids))
+                                           .order_by(response_table.c.id)).mappings():
+                responses.setdefault(resp['request_id'], []).append(dict(resp))
+
+            batches = {}
+            next_ids = {}
+            for row in rows:
+                key = self.key_for(row['timestamp'])
+                if key not in next_ids:
+                    with self.engine(key).connect() as conn:
+                        next_ids[key] = [
+                            (conn.execute(select(func.max(request_table.c.id))).scalar() or 0) + 1,
+                            (conn.execute(select(func.max(response_table.c.id))).scalar() or 0) + 1,
+                        ]
+                local_id = next_ids[key][0]
+                next_ids[key][0] += 1
+                new_id = self.global_id(key, local_id)
+                id_map[row['id']] = new_id
+
+                new_row = dict(row)
+                new_row['id'] = local_id
+                new_row['parent_id'] = id_map.get(row['parent_id'])
+                if row['thread_id'] is not None:
+                    # 中断后续跑时，之前迁移的对话无法换算，从这一轮起作为新对话
+                    new_row['thread_id'] = id_map.get(row['thread_id'], new_id)
+                request_rows, response_rows = batches.setdefault(key, ([], []))
+                request_rows.append(new_row)
+                for resp in responses.get(row['id'], []):
+                    resp['id'] = next_ids[key][1]
+                    resp['request_id'] = local_id
+                    next_ids[key][1] += 1
+                    response_rows.append(resp)
+
+            for key, (request_rows, response_rows) in batches.items():
+                with self.engine(key).begin() as conn:
+                    conn.execute(request_table.insert(), request_rows)
+                    if response_rows:
+                        conn.execute(response_table.insert(), response_rows)
+                self.invalidate(key)
+            db.session.execute(delete(response_table).where(response_table.c.request_id.in_(ids)))
+            db.session.execute(delete(request_table).where(request_table.c.id.in_(ids)))
+            db.session.commit()
+            moved += len(rows)
+            elapsed = max(time.time() - started, 1e-6)
+            print(f"分区迁移进度: {moved} 条请求, {moved / elapsed:.0f} 条/秒")
+        print(f"分区迁移完成: {moved} 条请求，可执行 sqlite3 data.db VACUUM 回收主数据库空间")
+        return moved
+
+    def prune(self, before):
+        """删除结束时间早于 before 的已关闭分区文件，返回删除的分区列表"""
+        removed = []
+        for key in self.existing(end=before):
+            if datetime.combine(self.next_key(key), dt_time()) <= before and self.closed(key):
+                self.drop(key)
+                removed.append(key)
+        return removed
+
+
+store = PartitionStore()
@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 每条消息的固定开销（角色、分隔符等）
+MESSAGE_OVERHEAD = 4
+# 图片按固定 token 数估算，不解码图片数据
+IMAGE_TOKENS = 765
+# 按消息摘要缓存估算结果的条数，多轮对话每次都会重发之前的消息
+MEMO_ENTRIES = int(os.environ.get('AI_HOOK_PREFLIGHT_MEMO', 50000))
+# 参与估算的字段：messages（OpenAI/Anthropic）、system（Anthropic）、tools、prompt（旧版补全接口）
+EXTRA_FIELDS = ('system', 'tools', 'functions', 'prompt')
+
+
+def estimate_text(text):
+    """
+    粗略估算文本的 token 数：ASCII 约 4 个字符一个 token，其它字符（中文等）约一个字符一个 token
+    只用 len 和 encode 计算，不逐字符遍历
+    """
+    length = len(text)
+    if not length:
+        return 0
+    # UTF-8 中非 ASCII 字符多为 2~3 个字节，按 3 字节估算非 ASCII 字符数
+    non_ascii = (len(text.encode('utf-8')) - length + 1) // 2
+    return (length - non_ascii + 3) // 4 + non_ascii
+
+
+def _estimate_value(value):
+    if isinstance(value, str):
+        return estimate_text(value)
+    if isinstance(value, dict):
+        part_type = value.get('type')
+        if part_type in ('image_url', 'image', 'input_image'):
+            return IMAGE_TOKENS
+        return sum(_estimate_value(item) for key, item in value.items() if key != 'cache_control')
+    if isinstance(value, list):
+        return sum(_estimate_value(item) for item in value)
+    return 0
+
+
+class _Memo:
+    """按消息摘要缓存估算结果，超过 MEMO_ENTRIES 时淘汰最久未用的"""
+
+    def __init__(self, max_entries=MEMO_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def estimate(self, message):
+        if self.max_entries <= 0:
+            return MESSAGE_OVERHEAD + _estimate_value(message)
+        key = hashlib.blake2b(json.dumps(message, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+                              .encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            tokens = self._entries.get(key)
+            if tokens is not None:
+                self._entries.move_to_end(key)
+                return tokens
+        tokens = MESSAGE_OVERHEAD + _estimate_value(message)
+        with self._lock:
+            self._entries[key] = tokens
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return tokens
+
+
+_memo = _Memo()
+
+
+def estimate_prompt_tokens(body):
+    """估算请求的输入 token 数，请求体中没有可估算的内容时返回 None"""
+    if not isinstance(body, dict):
+        return None
+    messages = body.get('messages')
+    fields = [field for field in EXTRA_FIELDS if body.get(field)]
+    if not isinstance(messages, list) and not fields:
+        return None
+    tokens = sum(_memo.estimate(message) for message in messages) if isinstance(messages, list) else 0
+    for field in fields:
+        tokens += _estimate_value(body[field])
+    return tokens
+
+
+def requested_output_tokens(body):
+    """请求声明的最大输出 token 数，未声明时返回 0"""
+    for field in ('max_completion_tokens', 'max_tokens', 'max_output_tokens'):
+        value = body.get(field)
+        if isinstance(value, int) and value > 0:
+            return value
+    return 0
+
+
+class Preflight:
+    """
+    转发前的预检，配置示例：
+      {
+        "enabled": false,     是否启用预检
+        "tolerance": 0.1      估算值允许的误差比例，估算值打折后仍超出上下文长度才拒绝
+      }
+    启用后估算输入 token 数并记录在捕获中；估算值加上 max_tokens 超过目标模型的上下文长度（来自模型目录）时
+    直接在本地返回 400，不再把请求上传给上游；模型不在目录中时只记录估算值
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        if not isinstance(config, dict):
+            raise ValueError('预检配置必须是 JSON 对象')
+        self.enabled = bool(config.get('enabled', False))
+        self.tolerance = float(config.get('tolerance', 0.1))
+        if not 0 <= self.tolerance < 1:
+            raise ValueError('tolerance 必须在 0 到 1 之间')
+
+    def to_dict(self):
+        return {'enabled': self.enabled, 'tolerance': self.tolerance}
+
+    def check(self, body, context_length):
+        """
+        :param context_length: 目标模型的上下文长度，未知时为 None
+        :return: (估算的输入 token 数, 拒绝原因)，不拒绝时原因为 None
+        """
+        estimate = estimate_prompt_tokens(body)
+        if estimate is None or not context_length:
+            return estimate, None
+        output_tokens = requested_output_tokens(body)
+        if estimate * (1 - self.tolerance) + output_tokens <= context_length:
+            return estimate, None
+        return estimate, (f'请求超出模型上下文长度: 估算输入约 {estimate} 个 token，'
+                          f'加上 max_tokens {output_tokens}，超过上下文长度 {context_length}')
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+from app.metrics import METRICS_DIR
+
+# 单次采样/内存对比的最长秒数，避免占用 worker 线程过久
+MAX_SECONDS = 60
+DEFAULT_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 10
+# 多 worker 部署时阶段耗时统计的开关和清零写入指标目录下的该文件，各 worker 最多每 SPANS_SYNC_INTERVAL 秒同步一次
+SPANS_STATE_FILE = 'profile_spans.json'
+SPANS_SYNC_INTERVAL = 1.0
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """已有采样或内存对比正在进行"""
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+def sample_stacks(seconds, interval=DEFAULT_INTERVAL):
+    """
+    在 seconds 秒内每隔 interval 秒采集一次本进程所有线程的调用栈（不含采样线程自身）
+    返回折叠格式的计数 {"线程名;最外层函数;...;最内层函数": 次数}，可直接生成火焰图
+    只在调用期间有开销，不采样时没有任何额外成本
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        own = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + min(seconds, MAX_SECONDS)
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                parts = []
+                while frame is not None:
+                    parts.append(_frame_name(frame))
+                    frame = frame.f_back
+                parts.append(names.get(ident, f'thread-{ident}'))
+                stacks[';'.join(reversed(parts))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profile_lock.release()
+
+
+def collapsed_text(stacks):
+    """折叠格式文本，每行 "调用栈 次数"，兼容 flamegraph.pl / speedscope"""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def flame_tree(stacks):
+    """转换为火焰图树形结构 {"name", "value", "children": [...]}（d3-flame-graph 格式）"""
+    root = {'name': 'all', 'value': 0, 'children': {}}
+    for stack, count in stacks.items():
+        root['value'] += count
+        node = root
+        for name in stack.split(';'):
+            child = node['children'].get(name)
+            if child is None:
+                child = node['children'][name] = {'name': name, 'value': 0, 'children': {}}
+            child['value'] += count
+            node = child
+
+    def finish(node):
+        node['children'] = sorted((finish(child) for child in node['children'].values()),
+                                  key=lambda child: child['value'], reverse=True)
+        return node
+    return finish(root)
+
+
+def memory_diff(seconds, limit=30, group_by='lineno'):
+    """
+    间隔 seconds 秒拍两次 tracemalloc 快照，按分配位置返回内存增长最多的 limit 项
+    未开启 tracemalloc 时只在本次对比期间开启，结束后关闭，平时没有额外开销
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    started_here = not tracemalloc.is_tracing()
+    try:
+        if started_here:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        time.sleep(min(seconds, MAX_SECONDS))
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        current, peak = tracemalloc.get_traced_memory()
+        stats = after.compare_to(before, group_by)
+        return {
+            'traced_bytes': current,
+            'peak_bytes': peak,
+            'top': [{
+                'location': [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+                'size_diff': stat.size_diff,
+                'size': stat.size,
+                'count_diff': stat.count_diff,
+                'count': stat.count,
+            } for stat in stats[:limit]],
+        }
+    finally:
+        if started_here:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+
+class SpanRecorder:
+    """
+    代理热路径各阶段的耗时统计，按 (路由模板, 阶段) 汇总次数、总耗时和最大耗时
+    关闭时 begin() 只做一次布尔判断并返回 None，end() 遇到 None 立即返回
+    设置了指标目录（AI_HOOK_METRICS_DIR）时开关和清零通过共享文件同步到所有 worker，统计数据仍按进程分别保存
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started_at = None
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._state = {'enabled': False, 'started_at': None, 'reset_at': None}  # 已应用的共享状态
+        self._state_mtime = None
+        self._next_sync = 0.0
+
+    def begin(self):
+        return time.perf_counter() if self.enabled else None
+
+    def end(self, route, name, started):
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        key = (route, name)
+        with self._lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                self._stats[key] = [1, elapsed, elapsed]
+            else:
+                stat[0] += 1
+                stat[1] += elapsed
+                if elapsed > stat[2]:
+                    stat[2] = elapsed
+
+    def enable(self, enabled=True):
+        state = dict(self._state, enabled=enabled)
+        if enabled and not self.enabled:
+            state['started_at'] = time.time()
+        self._publish(state)
+
+    def reset(self):
+        now = time.time()
+        self._publish(dict(self._state, reset_at=now, started_at=now if self.enabled else None))
+
+    def sync(self, force=False):
+        """每个请求调用一次，间隔到期（或 force）时读取其它 worker 写入的共享状态"""
+        if not METRICS_DIR or (not force and time.monotonic() < self._next_sync):
+            return
+        self._next_sync = time.monotonic() + SPANS_SYNC_INTERVAL
+        path = os.path.join(METRICS_DIR, SPANS_STATE_FILE)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self._state_mtime:
+                return
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._state_mtime = mtime
+        self._apply(state)
+
+    def _publish(self, state):
+        self._apply(state)
+        if not METRICS_DIR:
+            return
+        path = os.path.join(METRICS_DIR, SPANS_STATE_FILE)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"写入阶段耗时统计开关失败: {str(e)}")
+
+    def _apply(self, state):
+        if state.get('reset_at') != self._state.get('reset_at'):
+            with self._lock:
+                self._stats = {}
+        self.enabled = bool(state.get('enabled'))
+        self.started_at = state.get('started_at') if self.enabled else None
+        self._state = state
+
+    def report(self):
+        with self._lock:
+            items = sorted(self._stats.items())
+        return [{
+            'route': route,
+            'span': name,
+            'count': count,
+            'total_seconds': round(total, 6),
+            'avg_seconds': round(total / count, 6),
+            'max_seconds': round(longest, 6),
+        } for (route, name), (count, total, longest) in items]
+
+
+spans = SpanRecorder()
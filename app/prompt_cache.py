@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app import db, metrics
+from app.models import Request as RequestModel
+from app.partitions import store as partition_store
+from app.preflight import estimate_prompt_tokens
+from app.threads import prefix_hashes, MAX_PREFIX_CANDIDATES
+
+# 最近出现过的消息前缀摘要的条数上限
+INDEX_ENTRIES = int(os.environ.get('AI_HOOK_PROMPT_CACHE_INDEX', 200000))
+# 支持显式缓存断点的模型（按前缀匹配）；OpenAI、DeepSeek 等服务自动缓存，不需要标记
+DEFAULT_MODEL_PREFIXES = ('anthropic/', 'claude', 'google/gemini', 'gemini')
+MARKER = {'type': 'ephemeral'}
+
+
+class _PrefixIndex:
+    """本进程最近转发过的请求的前缀摘要及最后出现时间，按最久未出现淘汰"""
+
+    def __init__(self, max_entries=INDEX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def longest_seen(self, hashes, since):
+        """返回 since 之后出现过的最长前缀的下标，没有时返回 None"""
+        with self._lock:
+            for i in range(len(hashes) - 1, -1, -1):
+                seen_at = self._entries.get(hashes[i])
+                if seen_at is not None and seen_at >= since:
+                    return i
+        return None
+
+    def add(self, hashes, now):
+        with self._lock:
+            for value in hashes:
+                self._entries[value] = now
+                self._entries.move_to_end(value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_index = _PrefixIndex()
+
+
+def _longest_in_history(hashes, ttl):
+    """
+    本进程没有见过时查询捕获记录：最近 ttl 秒内保存过的请求中，完整 messages 摘要等于本次某个前缀摘要的最长一条
+    多 worker 部署时同一对话的前几轮可能由其它进程转发
+    """
+    candidates = hashes[-MAX_PREFIX_CANDIDATES:]
+    cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+    query = (select(RequestModel.message_count)
+             .where(RequestModel.prefix_hash.in_(candidates), RequestModel.timestamp >= cutoff)
+             .order_by(RequestModel.message_count.desc())
+             .limit(1))
+    if not partition_store.enabled:
+        count = db.session.execute(query).scalar()
+    else:
+        capture_session = partition_store.session(partition_store.key_for(datetime.utcnow()), create=False)
+        if capture_session is None:
+            return None
+        with capture_session:
+            count = capture_session.execute(query).scalar()
+    if not count or count > len(hashes):
+        return None
+    return count - 1
+
+
+def _has_markers(body):
+    """客户端已自行设置缓存断点时不再改写"""
+    blocks = []
+    for field in ('system', 'tools'):
+        if isinstance(body.get(field), list):
+            blocks.extend(body[field])
+    for message in body['messages']:
+        if isinstance(message, dict) and isinstance(message.get('content'), list):
+            blocks.extend(message['content'])
+    return any(isinstance(block, dict) and 'cache_control' in block for block in blocks)
+
+
+def _mark_content(holder, key):
+    """在 holder[key] 的最后一个内容块上加 cache_control，字符串内容改写为单个文本块；无法标记时返回 False"""
+    content = holder.get(key)
+    if isinstance(content, str) and content:
+        holder[key] = [{'type': 'text', 'text': content, 'cache_control': dict(MARKER)}]
+        return True
+    if isinstance(content, list) and content and isinstance(content[-1], dict):
+        content[-1] = dict(content[-1], cache_control=dict(MARKER))
+        return True
+    return False
+
+
+def _mark_message(messages, index):
+    """从 index 往前找第一条可以标记的消息（跳过没有文本内容的工具调用消息）"""
+    for i in range(index, -1, -1):
+        if isinstance(messages[i], dict) and _mark_content(messages[i], 'content'):
+            return i
+    return None
+
+
+class PromptCache:
+    """
+    为重复出现的消息前缀插入提示缓存断点，配置示例：
+      {
+        "enabled": false,                          是否启用
+        "ttl": 300,                                前缀在多少秒内重复出现才视为可缓存（与服务商缓存有效期一致）
+        "min_tokens": 1024,                        估算的可缓存前缀少于该 token 数时不标记（服务商的最小缓存长度）
+        "model_prefixes": ["anthropic/", ...]      按前缀匹配需要显式标记的模型
+      }
+    每个请求最多插入两个断点：系统提示（连同之前的工具定义）和最近重复出现的最长消息前缀
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        if not isinstance(config, dict):
+            raise ValueError('提示缓存配置必须是 JSON 对象')
+        self.enabled = bool(config.get('enabled', False))
+        self.ttl = float(config.get('ttl', 300))
+        self.min_tokens = int(config.get('min_tokens', 1024))
+        if self.ttl <= 0 or self.min_tokens < 0:
+            raise ValueError('ttl 必须大于 0，min_tokens 不能小于 0')
+        prefixes = config.get('model_prefixes', DEFAULT_MODEL_PREFIXES)
+        if not isinstance(prefixes, (list, tuple)) or not all(isinstance(prefix, str) for prefix in prefixes):
+            raise ValueError('model_prefixes 必须是字符串列表')
+        self.model_prefixes = tuple(prefixes)
+
+    def to_dict(self):
+        return {'enabled': self.enabled, 'ttl': self.ttl, 'min_tokens': self.min_tokens,
+                'model_prefixes': list(self.model_prefixes)}
+
+    def apply(self, body):
+        """
+        在转发的请求体中插入缓存断点（原地修改）
+        :return: 插入的断点数；未启用、模型不需要标记或请求体不适用时返回 None
+        """
+        if not self.enabled or not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+            return None
+        model = body.get('model')
+        if not isinstance(model, str) or not model.startswith(self.model_prefixes) or _has_markers(body):
+            return None
+        hashes = prefix_hashes(body)
+        if not hashes:
+            return None
+        now = time.time()
+        longest = _index.longest_seen(hashes, now - self.ttl)
+        if longest is None:
+            longest = _longest_in_history(hashes, self.ttl)
+        _index.add(hashes, now)
+        if longest is None:
+            return self._count(0, 'no_repeat')
+        messages = body['messages']
+        prefix = dict(body, messages=messages[:longest + 1])
+        if (estimate_prompt_tokens(prefix) or 0) < self.min_tokens:
+            return self._count(0, 'too_short')
+
+        marked = 0
+        # 系统提示：Anthropic 格式在顶层 system，OpenAI 格式是开头的 system 消息
+        system_index = None
+        if body.get('system'):
+            marked += _mark_content(body, 'system')
+        elif isinstance(messages[0], dict) and messages[0].get('role') in ('system', 'developer'):
+            system_index = 0
+            marked += _mark_content(messages[0], 'content')
+        if longest != system_index and _mark_message(messages, longest) not in (None, system_index):
+            marked += 1
+        return self._count(marked, 'marked' if marked else 'no_content')
+
+    @staticmethod
+    def _count(marked, result):
+        metrics.registry.inc('aihook_prompt_cache_total', (('result', result),))
+        return marked
+
@@ -0,0 +1,304 @@
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app import db
+from app.models import UsageRollup, Request as RequestModel, Response as ResponseModel, index_names
+from app.model_catalog import catalog
+from app.partitions import store as partition_store
+from app.sketch import LatencySketch
+from app.usage import extract_usage
+
+GRANULARITIES = ('hour', 'day', 'total')
+GROUP_FIELDS = ('model', 'api_service', 'key_tag', 'client')
+
+
+def hour_bucket(timestamp):
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def apply_usage(db_response, usage):
+    """把解析出的 token 用量写到响应记录上"""
+    if not usage:
+        return
+    db_response.prompt_tokens = usage['prompt_tokens']
+    db_response.completion_tokens = usage['completion_tokens']
+    db_response.cached_tokens = usage['cached_tokens']
+
+
+def key_tag_of(api_key):
+    """API Key 的脱敏标识，与界面上展示的格式一致"""
+    if not api_key:
+        return None
+    if api_key.lower().startswith('bearer '):
+        api_key = api_key[7:]
+    return api_key[:4] + '****' + api_key[-4:]
+
+
+def forwarded_key_tag_of(req):
+    """取请求记录实际转发时使用的 Key 标识"""
+    if req.key_tag:
+        return req.key_tag
+    headers = req.get_headers()
+    if isinstance(headers.get('modified'), dict):
+        headers = headers['modified']
+    for name, value in headers.items():
+        if name.lower() in ('authorization', 'x-api-key'):
+            return key_tag_of(value)
+    return None
+
+
+def forwarded_model_of(req):
+    """取实际转发给上游的模型（改写后的），没有改写记录时退回原始模型"""
+    body = req.get_body()
+    if isinstance(body, dict) and isinstance(body.get('modified'), dict):
+        return body['modified'].get('model') or req.model
+    return req.model
+
+
+def _new_row(bucket, model, api_service, key_tag, client):
+    return UsageRollup(
+        bucket_start=bucket, model=model, api_service=api_service, key_tag=key_tag, client=client,
+        request_count=0, error_count=0, stream_count=0,
+        prompt_tokens=0, completion_tokens=0, cached_tokens=0, cost_sum=0.0, latency_sum=0.0
+    )
+
+
+def _accumulate(row, status_code, time_taken, ttft, usage, is_stream, cost=None, latency_sketch=None, ttft_sketch=None):
+    row.request_count += 1
+    if status_code is None or status_code >= 400:
+        row.error_count += 1
+    if is_stream:
+        row.stream_count += 1
+    if usage:
+        row.prompt_tokens += usage['prompt_tokens']
+        row.completion_tokens += usage['completion_tokens']
+        row.cached_tokens += usage['cached_tokens']
+    if cost:
+        row.cost_sum = (row.cost_sum or 0.0) + cost
+    if time_taken is not None:
+        row.latency_sum += time_taken
+
+    # 传入草图对象时由调用方负责最终序列化（回填时批量累加）
+    if latency_sketch is None:
+        sketch = LatencySketch.loads(row.latency_sketch)
+        sketch.add(time_taken)
+        row.latency_sketch = sketch.dumps()
+    else:
+        latency_sketch.add(time_taken)
+    if ttft is not None:
+        if ttft_sketch is None:
+            sketch = LatencySketch.loads(row.ttft_sketch)
+            sketch.add(ttft)
+            row.ttft_sketch = sketch.dumps()
+        else:
+            ttft_sketch.add(ttft)
+
+
+def record_capture(timestamp, model, api_service, status_code, time_taken, ttft=None, usage=None, is_stream=False,
+                   key_tag=None, client=None, cost=None):
+    """
+    把一次捕获累加到对应的小时汇总行，调用方负责提交事务
+    先用 INSERT ... ON CONFLICT DO NOTHING 确保分组行存在（唯一索引保证每组一行），该语句同时让本事务
+    持有 SQLite 写锁直到提交，之后对计数和延迟草图的读-改-写不会与其它进程交错
+    """
+    bucket = hour_bucket(timestamp or datetime.utcnow())
+    db.session.execute(sqlite_insert(UsageRollup.__table__).values(
+        bucket_start=bucket, model=model, api_service=api_service, key_tag=key_tag, client=client,
+        request_count=0, error_count=0, stream_count=0,
+        prompt_tokens=0, completion_tokens=0, cached_tokens=0, cost_sum=0.0, latency_sum=0.0
+    ).on_conflict_do_nothing())
+    row = UsageRollup.query.filter_by(bucket_start=bucket, model=model, api_service=api_service,
+                                      key_tag=key_tag, client=client).one()
+    _accumulate(row, status_code, time_taken, ttft, usage, is_stream, cost)
+
+
+def merge_duplicates():
+    """
+    合并分组相同的重复汇总行（旧版本并发写入可能产生），之后才能建立分组唯一索引
+    唯一索引已存在时直接返回，返回合并掉的行数
+    """
+    if not db.inspect(db.engine).has_table(UsageRollup.__tablename__) or \
+            'ux_usage_rollup_group' in index_names(db.engine, UsageRollup.__tablename__):
+        return 0
+    groups = {}
+    for row in UsageRollup.query.order_by(UsageRollup.id).all():
+        groups.setdefault((row.bucket_start,) + tuple(getattr(row, field) or '' for field in GROUP_FIELDS), []).append(row)
+    merged = 0
+    for rows in groups.values():
+        if len(rows) < 2:
+            continue
+        keep = rows[0]
+        latency, ttft = LatencySketch.loads(keep.latency_sketch), LatencySketch.loads(keep.ttft_sketch)
+        for row in rows[1:]:
+            for field in ('request_count', 'error_count', 'stream_count', 'prompt_tokens', 'completion_tokens',
+                          'cached_tokens', 'cost_sum', 'latency_sum'):
+                setattr(keep, field, (getattr(keep, field) or 0) + (getattr(row, field) or 0))
+            latency.merge(LatencySketch.loads(row.latency_sketch))
+            ttft.merge(LatencySketch.loads(row.ttft_sketch))
+            db.session.delete(row)
+            merged += 1
+        keep.latency_sketch = latency.dumps()
+        keep.ttft_sketch = ttft.dumps()
+    db.session.commit()
+    if merged:
+        print(f"用量汇总表: 合并了 {merged} 个重复的汇总行")
+    return merged
+
+
+def _truncate(bucket, granularity):
+    if granularity == 'day':
+        return bucket.replace(hour=0)
+    if granularity == 'total':
+        return None
+    return bucket
+
+
+def query_stats(start, end, granularity='day', group_by=('model',)):
+    """
+    从汇总表查询统计数据
+    :param start: 起始时间（含）
+    :param end: 结束时间（不含）
+    :param granularity: hour / day / total
+    :param group_by: 分组字段，取 model、api_service、key_tag、client 的子集
+    :return: 按时间桶排序的统计列表
+    """
+    rows = UsageRollup.query.filter(
+        UsageRollup.bucket_start >= hour_bucket(start),
+        UsageRollup.bucket_start < end
+    ).all()
+
+    groups = {}
+    for row in rows:
+        key = (_truncate(row.bucket_start, granularity),) + tuple(getattr(row, field) for field in group_by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'requests': 0, 'errors': 0, 'streams': 0,
+                'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0, 'cost': 0.0,
+                'latency_sum': 0.0, 'latency': LatencySketch(), 'ttft': LatencySketch()
+            }
+        group['requests'] += row.request_count or 0
+        group['errors'] += row.error_count or 0
+        group['streams'] += row.stream_count or 0
+        group['prompt_tokens'] += row.prompt_tokens or 0
+        group['completion_tokens'] += row.completion_tokens or 0
+        group['cached_tokens'] += row.cached_tokens or 0
+        group['cost'] += row.cost_sum or 0.0
+        group['latency_sum'] += row.latency_sum or 0.0
+        group['latency'].merge(LatencySketch.loads(row.latency_sketch))
+        group['ttft'].merge(LatencySketch.loads(row.ttft_sketch))
+
+    results = []
+    for key in sorted(groups, key=lambda k: tuple('' if v is None else str(v) for v in k)):
+        group = groups[key]
+        latency, ttft = group.pop('latency'), group.pop('ttft')
+        latency_sum = group.pop('latency_sum')
+        item = {'bucket': key[0].isoformat() if key[0] else None}
+        item.update(zip(group_by, key[1:]))
+        group['cost'] = round(group['cost'], 6)
+        item.update(group)
+        item.update({
+            'latency_avg': round(latency_sum / group['requests'], 6) if group['requests'] else None,
+            'latency_p50': latency.quantile(0.5),
+            'latency_p95': latency.quantile(0.95),
+            'latency_p99': latency.quantile(0.99),
+            'ttft_p50': ttft.quantile(0.5),
+            'ttft_p95': ttft.quantile(0.95),
+        })
+        results.append(item)
+    return results
+
+
+def _backfill_session(session, cutoff, batch_size, accumulators, started, processed):
+    """把一个数据库中的捕获记录累加到 accumulators，返回累计处理的响应数"""
+    last_id = 0
+    while True:
+        batch = session.query(ResponseModel, RequestModel).join(
+            RequestModel, ResponseModel.request_id == RequestModel.id
+        ).filter(
+            ResponseModel.id > last_id,
+            RequestModel.timestamp < cutoff
+        ).order_by(ResponseModel.id).limit(batch_size).all()
+        if not batch:
+            break
+
+        for resp, req in batch:
+            last_id = resp.id
+            usage = None
+            if resp.prompt_tokens is None:
+                usage = extract_usage(resp.body, resp.is_stream)
+                apply_usage(resp, usage)
+            else:
+                usage = {
+                    'prompt_tokens': resp.prompt_tokens or 0,
+                    'completion_tokens': resp.completion_tokens or 0,
+                    'cached_tokens': resp.cached_tokens or 0,
+                }
+            model = forwarded_model_of(req)
+            if resp.cost is None:
+                resp.cost = catalog.compute_cost(req.original_url, model, usage)
+            key_tag = forwarded_key_tag_of(req)
+            bucket = hour_bucket(req.timestamp)
+            key = (bucket, model, req.api_service, key_tag, req.client)
+            if key not in accumulators:
+                accumulators[key] = (_new_row(*key), LatencySketch(), LatencySketch())
+            row, latency_sketch, ttft_sketch = accumulators[key]
+            _accumulate(row, resp.status_code, resp.time_taken, resp.get_timing().get('ttft'),
+                        usage, resp.is_stream, resp.cost, latency_sketch, ttft_sketch)
+
+        # 每批提交一次，补写的 token 列不会积压在会话中
+        session.commit()
+        session.expunge_all()
+        processed += len(batch)
+        elapsed = max(time.time() - started, 1e-6)
+        print(f"汇总回填进度: {processed} 条响应, {processed / elapsed:.0f} 条/秒")
+    return processed
+
+
+def backfill(batch_size=1000, rebuild=False):
+    """
+    用已有的捕获记录补齐当前小时之前的汇总数据，缺失的 token 用量和费用会一并补写
+    默认只生成汇总表中还没有任何记录的小时（如升级前的历史或导入的记录），已有的小时保持不变：
+    实时汇总包含采样未采中、租户关闭捕获等没有保存捕获记录的调用，按捕获记录重建会丢掉这些调用
+    rebuild 为 True 时删除当前小时之前的全部汇总后按捕获记录重建
+    当前小时及之后的数据由实时捕获负责，因此回填可以在服务运行时执行，且重复执行结果一致
+    分区模式下依次读取主数据库和所有分区文件
+    """
+    cutoff = hour_bucket(datetime.utcnow())
+    started = time.time()
+    accumulators = {}
+    processed = _backfill_session(db.session, cutoff, batch_size, accumulators, started, 0)
+    if partition_store.enabled:
+        for key in partition_store.existing(end=cutoff):
+            with partition_store.session(key) as capture_session:
+                processed = _backfill_session(capture_session, cutoff, batch_size, accumulators, started, processed)
+
+    if rebuild:
+        UsageRollup.query.filter(UsageRollup.bucket_start < cutoff).delete(synchronize_session=False)
+        existing = set()
+    else:
+        existing = {bucket for (bucket,) in db.session.query(UsageRollup.bucket_start)
+                    .filter(UsageRollup.bucket_start < cutoff).distinct()}
+    created = 0
+    for key, (row, latency_sketch, ttft_sketch) in accumulators.items():
+        if key[0] in existing:
+            continue
+        row.latency_sketch = latency_sketch.dumps()
+        row.ttft_sketch = ttft_sketch.dumps()
+        db.session.add(row)
+        created += 1
+    db.session.commit()
+    print(f"汇总回填完成: {processed} 条响应, 生成 {created} 个汇总行, 跳过已有汇总的 {len(existing)} 个小时, "
+          f"截止 {cutoff.isoformat()}")
+    return processed
+
+
+def parse_time_arg(value, default):
+    """解析查询参数中的时间，支持 ISO 格式或相对天数（如 -7d）"""
+    if not value:
+        return default
+    if value.endswith('d') and value[:-1].lstrip('-').isdigit():
+        return datetime.utcnow() + timedelta(days=int(value[:-1]))
+    return datetime.fromisoformat(value.replace('Z', ''))
@@ -1,11 +1,27 @@
-from flask import Blueprint, render_template, request, Response, jsonify, current_app, stream_with_context, session, redirect, url_for, flash
+from flask import Blueprint, render_template, request, Response, jsonify, current_app, stream_with_context, session, redirect, url_for, flash, abort
 import requests
 import time
 import json
 import os
 from app import db, bcrypt
+from app.startup import startup
 from app.models import Request as RequestModel, Response as ResponseModel, AdminUser
+from app import metrics, rollups, export, threads, profiling, jobs
+from app.partitions import store as partition_store
+from app.capture import writer as capture_writer, decode_body
+from app.hotcache import cache as hot_cache, response_fields
+from app.diffing import capture_diff
+from app.tenants import registry as tenant_registry
+from app.capture_policy import CapturePolicy
+from app.preflight import Preflight
+from app.prompt_cache import PromptCache
+from app.model_catalog import catalog
+from app.usage import extract_usage
+from app.timing import CallTimer, create_upstream_session, reset_connect_time, pop_connect_time, pack_gaps, unpack_gaps
 import copy
+import math
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import sqlite3
 from functools import wraps
 
@@ -24,6 +40,12 @@ AUTO_REPLACE_MODEL = True
 # 替换模式: 'force'表示强制替换，'missing'表示缺了才补全
 KEY_REPLACE_MODE = 'force'
 MODEL_REPLACE_MODE = 'force'
+# 捕获策略：采样、捕获模式和请求体大小上限，默认完整保存所有调用
+CAPTURE_POLICY = CapturePolicy()
+# 转发前预检：估算输入 token 数，超出模型上下文长度时在本地拒绝，默认关闭
+PREFLIGHT = Preflight()
+# 提示缓存：为最近重复出现的消息前缀插入缓存断点，默认关闭
+PROMPT_CACHE = PromptCache()
 
 def save_config_to_file():
     """保存当前配置到配置文件"""
@@ -34,7 +56,10 @@ def save_config_to_file():
         'auto_replace_key': AUTO_REPLACE_KEY,
         'auto_replace_model': AUTO_REPLACE_MODEL,
         'key_replace_mode': KEY_REPLACE_MODE,
-        'model_replace_mode': MODEL_REPLACE_MODE
+        'model_replace_mode': MODEL_REPLACE_MODE,
+        'capture_policy': CAPTURE_POLICY.to_dict(),
+        'preflight': PREFLIGHT.to_dict(),
+        'prompt_cache': PROMPT_CACHE.to_dict()
     }
     
     try:
@@ -46,13 +71,14 @@ def save_config_to_file():
 
 def load_config_from_file():
     """从配置文件加载配置"""
-    global OPENROUTER_BASE_URL, API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE
+    global OPENROUTER_BASE_URL, API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE, CAPTURE_POLICY, PREFLIGHT, PROMPT_CACHE, _config_mtime
     
     if not os.path.exists(CONFIG_FILE):
         print(f"配置文件不存在: {CONFIG_FILE}")
         return False
     
     try:
+        _config_mtime = os.path.getmtime(CONFIG_FILE)
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
             config = json.load(f)
         
@@ -78,6 +104,24 @@ def load_config_from_file():
         if 'model_replace_mode' in config:
             MODEL_REPLACE_MODE = config['model_replace_mode']
         
+        if 'capture_policy' in config:
+            try:
+                CAPTURE_POLICY = CapturePolicy(config['capture_policy'])
+            except (TypeError, ValueError) as e:
+                print(f"捕获策略配置无效，继续使用当前策略: {str(e)}")
+        
+        if 'preflight' in config:
+            try:
+                PREFLIGHT = Preflight(config['preflight'])
+            except (TypeError, ValueError) as e:
+                print(f"预检配置无效，继续使用当前配置: {str(e)}")
+        
+        if 'prompt_cache' in config:
+            try:
+                PROMPT_CACHE = PromptCache(config['prompt_cache'])
+            except (TypeError, ValueError) as e:
+                print(f"提示缓存配置无效，继续使用当前配置: {str(e)}")
+        
         print(f"从文件加载配置成功: {CONFIG_FILE}")
         print(f"  Base URL: {OPENROUTER_BASE_URL}")
         print(f"  API Key: {'已设置' if API_KEY else '未设置'}")
@@ -86,12 +130,35 @@ def load_config_from_file():
         print(f"  Auto Replace Model: {AUTO_REPLACE_MODEL}")
         print(f"  Key Replace Mode: {KEY_REPLACE_MODE}")
         print(f"  Model Replace Mode: {MODEL_REPLACE_MODE}")
+        print(f"  Capture Policy: {json.dumps(CAPTURE_POLICY.to_dict(), ensure_ascii=False)}")
+        print(f"  Preflight: {json.dumps(PREFLIGHT.to_dict(), ensure_ascii=False)}")
+        print(f"  Prompt Cache: {json.dumps(PROMPT_CACHE.to_dict(), ensure_ascii=False)}")
         
         return True
     except Exception as e:
         print(f"从文件加载配置失败: {str(e)}")
         return False
 
+# 多进程部署时，任一 worker 保存设置后其它 worker 通过配置文件的修改时间感知并重新加载
+CONFIG_CHECK_INTERVAL = 1.0
+_config_mtime = None
+_config_checked_at = 0.0
+
+def reload_config_if_changed():
+    """配置文件被修改时重新加载（最多每秒检查一次，开销只有一次 stat）"""
+    global _config_mtime, _config_checked_at
+    now = time.time()
+    if now - _config_checked_at < CONFIG_CHECK_INTERVAL:
+        return
+    _config_checked_at = now
+    try:
+        mtime = os.path.getmtime(CONFIG_FILE)
+    except OSError:
+        return
+    if mtime != _config_mtime:
+        print("检测到配置文件变更，重新加载")
+        load_config_from_file()
+
 # 尝试获取第一个已配置的API设置
 def load_first_config():
     """
@@ -210,10 +277,12 @@ def load_first_config():
     except Exception as e:
         print(f"自动加载配置失败: {str(e)}")
 
-# 尝试在模块加载时先加载之前保存的配置，如果没有再从历史记录查找
-if not load_config_from_file():
-    print("从配置文件加载失败，尝试从历史记录查找配置")
-    load_first_config()
+@startup.step('config')
+def load_startup_config(app):
+    """启动时先加载之前保存的配置，如果没有再从历史记录查找"""
+    if not load_config_from_file():
+        print("从配置文件加载失败，尝试从历史记录查找配置")
+        load_first_config()
 
 # 辅助函数：从请求头和基础URL确定API服务名称
 def getApiServiceName(headers, base_url):
@@ -282,6 +351,24 @@ def getModelName(json_data):
     
     return None
 
+# 逐跳头部只对单个连接有效，不能在客户端和上游之间原样转发
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'}
+
+# 辅助函数：去掉逐跳头部
+def strip_hop_by_hop(headers, extra=()):
+    """
+    去掉逐跳头部以及 Connection 头中列出的头部
+    :param headers: 头部字典
+    :param extra: 额外需要去掉的头部（小写），如重新计算的 Content-Length
+    :return: 新的头部字典
+    """
+    drop = set(HOP_BY_HOP_HEADERS) | set(extra)
+    for k, v in headers.items():
+        if k.lower() == 'connection':
+            drop.update(token.strip().lower() for token in v.split(',') if token.strip())
+    return {k: v for k, v in headers.items() if k.lower() not in drop}
+
 @main_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -345,12 +432,32 @@ def index():
 @main_bp.route('/api/settings', methods=['POST'])
 def save_settings():
     """保存API设置的端点"""
-    global OPENROUTER_BASE_URL, API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE
+    global OPENROUTER_BASE_URL, API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE, CAPTURE_POLICY, PREFLIGHT, PROMPT_CACHE
     
     data = request.get_json()
     if not data:
         return jsonify({'message': '无效的请求数据'}), 400
     
+    # 先校验捕获策略、预检和提示缓存配置，无效时不修改任何设置
+    capture_policy = CAPTURE_POLICY
+    if 'capture_policy' in data:
+        try:
+            capture_policy = CapturePolicy(data['capture_policy'])
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': f'无效的捕获策略: {str(e)}'}), 400
+    preflight = PREFLIGHT
+    if 'preflight' in data:
+        try:
+            preflight = Preflight(data['preflight'])
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': f'无效的预检配置: {str(e)}'}), 400
+    prompt_cache = PROMPT_CACHE
+    if 'prompt_cache' in data:
+        try:
+            prompt_cache = PromptCache(data['prompt_cache'])
+        except (TypeError, ValueError) as e:
+            return jsonify({'message': f'无效的提示缓存配置: {str(e)}'}), 400
+    
     # 更新前的值，用于记录变更
     old_base_url = OPENROUTER_BASE_URL
     old_api_key = API_KEY
@@ -384,6 +491,10 @@ def save_settings():
     if 'model_replace_mode' in data:
         MODEL_REPLACE_MODE = data['model_replace_mode']
     
+    CAPTURE_POLICY = capture_policy
+    PREFLIGHT = preflight
+    PROMPT_CACHE = prompt_cache
+    
     # 记录变更
     print(f"设置已更新:")
     print(f"  Base URL: {old_base_url} -> {OPENROUTER_BASE_URL}")
@@ -411,7 +522,10 @@ def save_settings():
         'key_replace_mode': KEY_REPLACE_MODE,
         'model_replace_mode': MODEL_REPLACE_MODE,
         'key_replace_mode_text': key_mode_text,
-        'model_replace_mode_text': model_mode_text
+        'model_replace_mode_text': model_mode_text,
+        'capture_policy': CAPTURE_POLICY.to_dict(),
+        'preflight': PREFLIGHT.to_dict(),
+        'prompt_cache': PROMPT_CACHE.to_dict()
     })
 
 @main_bp.route('/api/settings', methods=['GET'])
@@ -419,6 +533,8 @@ def get_settings():
     """获取当前API设置的端点"""
     global OPENROUTER_BASE_URL, API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE
     
+    reload_config_if_changed()
+    
     # 打印当前全局变量值以便调试
     print(f"DEBUG - 当前服务器设置:")
     print(f"  OPENROUTER_BASE_URL = {OPENROUTER_BASE_URL}")
@@ -442,7 +558,10 @@ def get_settings():
         'key_replace_mode': KEY_REPLACE_MODE,
         'model_replace_mode': MODEL_REPLACE_MODE,
         'key_replace_mode_text': key_mode_text,
-        'model_replace_mode_text': model_mode_text
+        'model_replace_mode_text': model_mode_text,
+        'capture_policy': CAPTURE_POLICY.to_dict(),
+        'preflight': PREFLIGHT.to_dict(),
+        'prompt_cache': PROMPT_CACHE.to_dict()
     })
 
 @main_bp.route('/api/readme')
@@ -462,6 +581,26 @@ def get_requests():
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
     
+    # 第一页直接由最近捕获的缓存提供
+    cached = hot_cache.list_first_page(per_page, count_requests) if page == 1 else None
+    if cached is not None:
+        items, total = cached
+        return jsonify({
+            'requests': items,
+            'total': total,
+            'pages': math.ceil(total / per_page),
+            'current_page': page
+        })
+    
+    if partition_store.enabled:
+        items, total = partition_store.list_requests(page, per_page)
+        return jsonify({
+            'requests': items,
+            'total': total,
+            'pages': math.ceil(total / per_page) if per_page > 0 else 0,
+            'current_page': page
+        })
+    
     pagination = RequestModel.query.order_by(RequestModel.timestamp.desc()).paginate(
         page=page, per_page=per_page, error_out=False)
     
@@ -482,13 +621,64 @@ def get_requests():
         'current_page': pagination.page
     })
 
+def count_requests():
+    """请求记录总数"""
+    if partition_store.enabled:
+        return partition_store.total()
+    return RequestModel.query.count()
+
+@contextmanager
+def captured_request(request_id):
+    """按对外的请求 id 取出请求记录及其所在的会话，找不到时返回 404；分区模式下 id 中包含分区信息"""
+    if not partition_store.enabled:
+        yield RequestModel.query.get_or_404(request_id), db.session
+        return
+    key, local_id = partition_store.split_id(request_id)
+    capture_session = partition_store.session(key, create=False) if key else None
+    if capture_session is None:
+        abort(404)
+    with capture_session:
+        req = capture_session.get(RequestModel, local_id)
+        if req is None:
+            abort(404)
+        yield req, capture_session
+
 @main_bp.route('/api/requests/<int:request_id>')
 def get_request_detail(request_id):
-    """获取请求详情的API"""
-    req = RequestModel.query.get_or_404(request_id)
-    
+    """获取请求详情的API，compact=1 时省略原始请求体（变更部分通过 /diff 获取）"""
+    detail = hot_cache.get_detail(request_id)
+    if detail is None:
+        with captured_request(request_id) as (req, _):
+            detail = request_detail(request_id, req)
+    if request.args.get('compact') == '1':
+        detail = compact_detail(detail)
+    return jsonify(detail)
+
+def compact_detail(detail):
+    """去掉请求体中的原始版本，只保留转发的请求体；未改写的请求原样返回"""
+    body = detail.get('body')
+    if isinstance(body, dict) and 'original' in body and 'modified' in body:
+        detail = dict(detail, body={'modified': body['modified'], 'original_omitted': True})
+    return detail
+
+@main_bp.route('/api/requests/<int:request_id>/diff')
+def get_request_diff(request_id):
+    """获取原始请求与转发请求的差异（变更的路径及新旧值），首次查看时计算并保存"""
+    diff = hot_cache.get_diff(request_id)
+    if diff is None:
+        with captured_request(request_id) as (req, capture_session):
+            if req.diff:
+                diff = json.loads(req.diff)
+            else:
+                diff = capture_diff(req.get_headers(), req.get_body())
+                req.diff = json.dumps(diff, ensure_ascii=False)
+                capture_session.commit()
+    return jsonify({'id': request_id, 'headers': diff['headers'], 'body': diff['body']})
+
+def request_detail(request_id, req):
+    """组装请求详情，包含所有响应"""
     request_data = {
-        'id': req.id,
+        'id': request_id,
         'timestamp': req.timestamp.isoformat(),
         'method': req.method,
         'path': req.path,
@@ -497,6 +687,11 @@ def get_request_detail(request_id):
         'api_service': req.api_service,
         'model': req.model,
         'original_url': req.original_url,
+        'tenant': req.tenant,
+        'estimated_tokens': req.estimated_tokens,
+        'cache_breakpoints': req.cache_breakpoints,
+        'thread_id': req.thread_id,
+        'parent_id': req.parent_id,
         'responses': []
     }
     
@@ -507,24 +702,106 @@ def get_request_detail(request_id):
             'headers': json.loads(resp.headers) if resp.headers else {},
             'body': resp.body,
             'is_stream': resp.is_stream,
-            'time_taken': resp.time_taken
+            'time_taken': resp.time_taken,
+            'timing': resp.get_timing(),
+            'chunk_gaps': unpack_gaps(resp.chunk_gaps),
+            'prompt_tokens': resp.prompt_tokens,
+            'completion_tokens': resp.completion_tokens,
+            'cached_tokens': resp.cached_tokens
         }
         request_data['responses'].append(response_data)
     
-    return jsonify(request_data)
+    return request_data
+
+@main_bp.route('/api/threads/<int:thread_id>')
+def get_thread(thread_id):
+    """获取一个对话的所有轮次，对话 id 为第一轮请求的 id"""
+    turns = threads.get_thread(thread_id)
+    if not turns:
+        return jsonify({'message': '对话不存在'}), 404
+    return jsonify({'thread_id': thread_id, 'turns': turns})
+
+@main_bp.route('/api/export')
+@admin_login_required
+def export_requests():
+    """以 NDJSON 流式导出捕获记录，每行一个请求及其响应，gzip=1 时压缩输出"""
+    try:
+        filters = export.parse_filters(request.args)
+    except ValueError:
+        return jsonify({'message': '无效的过滤参数'}), 400
+    batch_size = min(max(request.args.get('batch_size', export.EXPORT_BATCH_SIZE, type=int), 1), 10000)
+    
+    chunks = export.iter_ndjson(batch_size=batch_size, **filters)
+    filename = 'captures.ndjson'
+    mimetype = 'application/x-ndjson'
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks = export.gzip_stream(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+@main_bp.route('/api/profile/cpu')
+@admin_login_required
+def profile_cpu():
+    """对本进程所有线程采样 seconds 秒，format=collapsed 返回折叠调用栈文本，format=json 返回火焰图树"""
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), profiling.MAX_SECONDS)
+    interval = max(request.args.get('interval_ms', profiling.DEFAULT_INTERVAL * 1000, type=float), 1) / 1000
+    try:
+        stacks = profiling.sample_stacks(seconds, interval)
+    except profiling.ProfilerBusy:
+        return jsonify({'message': '已有性能分析正在进行'}), 409
+    if request.args.get('format') == 'json':
+        return jsonify({'pid': os.getpid(), 'seconds': seconds, 'flamegraph': profiling.flame_tree(stacks)})
+    return Response(profiling.collapsed_text(stacks), mimetype='text/plain')
+
+@main_bp.route('/api/profile/memory')
+@admin_login_required
+def profile_memory():
+    """对比间隔 seconds 秒的两次内存快照，返回内存增长最多的分配位置，group_by=traceback 时按完整调用栈分组"""
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0), profiling.MAX_SECONDS)
+    limit = min(max(request.args.get('limit', 30, type=int), 1), 500)
+    group_by = 'traceback' if request.args.get('group_by') == 'traceback' else 'lineno'
+    try:
+        result = profiling.memory_diff(seconds, limit, group_by)
+    except profiling.ProfilerBusy:
+        return jsonify({'message': '已有性能分析正在进行'}), 409
+    return jsonify({'pid': os.getpid(), 'seconds': seconds, **result})
+
+@main_bp.route('/api/profile/spans', methods=['GET', 'POST', 'DELETE'])
+@admin_login_required
+def profile_spans():
+    """
+    代理各阶段耗时统计：POST {"enabled": true/false} 开关，GET 查看，DELETE 清零
+    开关和清零对所有 worker 生效（需要指标目录），返回的统计只包含处理本次请求的 worker
+    """
+    profiling.spans.sync(force=True)
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        profiling.spans.enable(bool(data.get('enabled', True)))
+    elif request.method == 'DELETE':
+        profiling.spans.reset()
+    return jsonify({
+        'pid': os.getpid(),
+        'enabled': profiling.spans.enabled,
+        'since': datetime.utcfromtimestamp(profiling.spans.started_at).isoformat() if profiling.spans.started_at else None,
+        'spans': profiling.spans.report(),
+    })
 
 @main_bp.route('/api/requests/<int:request_id>', methods=['DELETE'])
 def delete_request(request_id):
     """删除单个请求记录的API"""
-    req = RequestModel.query.get_or_404(request_id)
-    
-    # 先删除关联的响应记录
-    for resp in req.responses:
-        db.session.delete(resp)
-    
-    # 再删除请求记录
-    db.session.delete(req)
-    db.session.commit()
+    with captured_request(request_id) as (req, capture_session):
+        # 先删除关联的响应记录
+        for resp in req.responses:
+            capture_session.delete(resp)
+        
+        # 再删除请求记录
+        capture_session.delete(req)
+        capture_session.commit()
+    if partition_store.enabled:
+        partition_store.invalidate(partition_store.split_id(request_id)[0])
+    hot_cache.evict(request_id)
     
     return jsonify({'message': '请求记录已成功删除'})
 
@@ -539,8 +816,51 @@ def delete_all_requests():
     
     db.session.commit()
     
+    # 分区模式下直接删除已关闭的分区文件，仍可能有写入的分区只删除记录
+    if partition_store.enabled:
+        for key in partition_store.existing():
+            if partition_store.closed(key):
+                partition_store.drop(key)
+            else:
+                partition_store.clear(key)
+    hot_cache.clear()
+    
     return jsonify({'message': '所有请求记录已成功清空'})
 
+@main_bp.route('/api/requests/bulk_delete', methods=['POST'])
+@admin_login_required
+def bulk_delete_requests():
+    """
+    按过滤条件批量删除请求记录，在后台任务中分批执行，立即返回任务信息
+    请求体: {"ids": [...], "start", "end", "model", "api_service", "tenant", "status", "chunk_size"}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'message': '无效的请求数据'}), 400
+    try:
+        filters = jobs.parse_delete_filter(data)
+        chunk_size = min(max(int(data.get('chunk_size') or jobs.DELETE_CHUNK_SIZE), 1), 5000)
+    except (TypeError, ValueError) as e:
+        return jsonify({'message': f'无效的过滤条件: {str(e)}'}), 400
+    job = jobs.runner.submit(current_app._get_current_object(), 'bulk_delete', data,
+                             lambda job: jobs.bulk_delete(job, chunk_size=chunk_size, **filters))
+    return jsonify({'message': '批量删除任务已提交', 'job': job.to_dict()}), 202
+
+@main_bp.route('/api/jobs')
+@admin_login_required
+def list_jobs():
+    """本进程内的后台任务列表，最新的在前"""
+    return jsonify({'jobs': [job.to_dict() for job in jobs.runner.list()]})
+
+@main_bp.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+@admin_login_required
+def job_status(job_id):
+    """查询后台任务进度；DELETE 请求取消任务，已删除的批次不会恢复"""
+    job = jobs.runner.cancel(job_id) if request.method == 'DELETE' else jobs.runner.get(job_id)
+    if job is None:
+        return jsonify({'message': '任务不存在'}), 404
+    return jsonify(job.to_dict())
+
 @main_bp.route('/api/select_model', methods=['POST'])
 def select_current_model():
     """快速切换当前使用的模型的API端点"""
@@ -619,6 +939,36 @@ def select_current_api_key():
         'auto_replace': AUTO_REPLACE_KEY
     })
 
+@main_bp.route('/metrics')
+def get_metrics():
+    """Prometheus 文本格式的指标端点"""
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@main_bp.route('/api/stats')
+def get_stats():
+    """基于汇总表的用量与延迟统计，用于仪表盘图表"""
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in rollups.GRANULARITIES:
+        return jsonify({'message': f'granularity 只支持: {", ".join(rollups.GRANULARITIES)}'}), 400
+    
+    group_by = [field for field in request.args.get('group_by', 'model').split(',') if field]
+    if any(field not in rollups.GROUP_FIELDS for field in group_by):
+        return jsonify({'message': f'group_by 只支持: {", ".join(rollups.GROUP_FIELDS)}'}), 400
+    
+    try:
+        end = rollups.parse_time_arg(request.args.get('end'), datetime.utcnow())
+        start = rollups.parse_time_arg(request.args.get('start'), end - timedelta(days=7))
+    except ValueError:
+        return jsonify({'message': '无效的时间参数'}), 400
+    
+    return jsonify({
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'granularity': granularity,
+        'group_by': group_by,
+        'stats': rollups.query_stats(start, end, granularity, tuple(group_by))
+    })
+
 # 模型列表路由
 @main_bp.route('/api/models')
 def get_models():
@@ -659,6 +1009,8 @@ def get_models():
         if response.status_code == 200:
             # 直接返回OpenRouter的完整响应
             models_data = response.json()
+            # 顺便更新计费用的模型目录索引
+            catalog.update(OPENROUTER_BASE_URL, models_data.get("data", []))
             return jsonify({
                 "success": True,
                 "data": models_data.get("data", [])
@@ -693,14 +1045,193 @@ def get_models():
 # 代理服务路由
 proxy_bp = Blueprint('proxy', __name__, url_prefix='/api/v1')
 
-def make_proxy_request(method, path, headers, json_data=None):
+# 转发上游共用的Session，复用连接并记录建连耗时
+upstream_session = create_upstream_session()
+# 非流式响应转发给客户端时每次读取的字节数
+RELAY_CHUNK_SIZE = 64 * 1024
+
+def upstream_settings(tenant):
+    """本次请求使用的 (上游地址, 上游 Key, 默认模型, 是否替换模型, 模型替换模式)，租户未配置的项沿用全局设置"""
+    if tenant is None:
+        return OPENROUTER_BASE_URL, API_KEY, DEFAULT_MODEL, AUTO_REPLACE_MODEL, MODEL_REPLACE_MODE
+    default_model = tenant.default_model or DEFAULT_MODEL
+    return (tenant.base_url or OPENROUTER_BASE_URL, tenant.next_api_key() or API_KEY, default_model,
+            AUTO_REPLACE_MODEL or tenant.default_model is not None,
+            tenant.model_replace_mode if tenant.default_model else MODEL_REPLACE_MODE)
+
+def capture_policy_for(tenant):
+    """租户设置了捕获策略时使用租户的策略，否则使用全局策略"""
+    if tenant is not None and tenant.capture_policy is not None:
+        return tenant.capture_policy
+    return CAPTURE_POLICY
+
+def run_preflight(db_request, json_data, model, base_url):
+    """转发前预检，估算值记录在请求记录上；返回拒绝原因，未启用或通过时返回 None"""
+    if not PREFLIGHT.enabled or not isinstance(json_data, dict):
+        return None
+    # 上下文长度取自转发目标上游的模型目录
+    entry = catalog.get(base_url, model)
+    context_length = entry['context_length'] if entry else None
+    estimate, error = PREFLIGHT.check(json_data, context_length)
+    db_request.estimated_tokens = estimate
+    if estimate is not None:
+        result = 'rejected' if error else ('passed' if context_length else 'unknown_model')
+        metrics.registry.inc('aihook_preflight_total', (('result', result),))
+    return error
+
+def reject_preflight(db_request, api_service, forwarded_model, timer, start_time, error, plan, json_data):
+    """预检未通过时在本地返回 400，格式与上游的上下文超长错误一致，响应同样按捕获策略保存"""
+    payload = {'error': {'message': error, 'type': 'invalid_request_error', 'code': 'context_length_exceeded'}}
+    timer.mark('done')
+    capture_response(db_request, api_service, forwarded_model, timer, 400,
+                     json.dumps(payload, ensure_ascii=False).encode('utf-8'), time.time() - start_time,
+                     headers={'Content-Type': 'application/json'}, plan=plan, json_data=json_data)
+    print(f"预检未通过，已在本地拒绝: {error}")
+    return jsonify(payload), 400
+
+def store_request_capture(db_request, json_data, mode, policy):
+    """
+    按捕获模式裁剪请求记录，关联同一对话的上一轮后保存，返回对外使用的请求 id
+    :param json_data: 客户端发来的原始请求体，对话关联不受代理插入的提示缓存断点影响
+    """
+    policy.apply_to_request(db_request, mode)
+    db_request.update_content_hash()
+    threads.link_request(db_request, json_data)
+    return save_request_capture(db_request)
+
+def save_request_capture(db_request):
+    """保存请求记录并放入最近捕获缓存，分区模式下写入请求时间所在的分区文件，返回对外使用的请求 id"""
+    if not partition_store.enabled:
+        db.session.add(db_request)
+        if db_request.prefix_hash and db_request.thread_id is None:
+            # 新对话以第一轮请求的 id 作为对话 id
+            db.session.flush()
+            db_request.thread_id = db_request.id
+        db.session.commit()
+        hot_cache.put_request(db_request.id, db_request)
+        return db_request.id
+    key = partition_store.key_for(db_request.timestamp)
+    with partition_store.session(key) as capture_session:
+        capture_session.add(db_request)
+        if db_request.prefix_hash and db_request.thread_id is None:
+            capture_session.flush()
+            db_request.thread_id = partition_store.global_id(key, db_request.id)
+        capture_session.commit()
+    public_id = partition_store.global_id(key, db_request.id)
+    hot_cache.put_request(public_id, db_request)
+    return public_id
+
+def capture_response(db_request, api_service, forwarded_model, timer, status_code, body, time_taken, is_stream=False,
+                     headers=None, content_encoding=None, chunk_gaps=None, plan=None, json_data=None):
+    """
+    把响应交给后台写入线程保存，请求线程不做解压、解码和写库
+    :param body: 上游原始响应字节，或出错时的错误信息文本
+    :param content_encoding: body 的压缩方式，None 表示未压缩
+    :param plan: 请求阶段的捕获决定，请求未采中时由后台线程决定是否补存请求记录
+    """
+    # 请求记录已提交时只取出需要的字段；未保存的请求对象交给后台线程，请求线程之后不再使用它
+    request_info = {
+        'id': db_request.id,  # 请求未保存时为 None
+        'request': db_request if db_request.id is None else None,
+        'json_data': json_data,
+        'plan': plan,
+        'public_id': partition_store.global_id(partition_store.key_for(db_request.timestamp), db_request.id)
+        if partition_store.enabled else db_request.id,
+        'partition': partition_store.key_for(db_request.timestamp) if partition_store.enabled else None,
+        'timestamp': db_request.timestamp,
+        'base_url': db_request.original_url,
+        'key_tag': db_request.key_tag,
+        'client': db_request.client,
+    }
+    capture_writer.submit(current_app._get_current_object(), write_response_capture, request_info, api_service,
+                          forwarded_model, timer, status_code, body, time_taken, is_stream, headers,
+                          content_encoding, chunk_gaps)
+
+def write_response_capture(request_info, api_service, forwarded_model, timer, status_code, body, time_taken,
+                           is_stream, headers, content_encoding, chunk_gaps):
+    """在后台线程中解压一次响应体、解析用量，按捕获策略保存响应记录"""
+    usage = None
+    upstream_bytes = 0
+    if isinstance(body, bytes):
+        upstream_bytes = len(body)
+        body = decode_body(body, headers, content_encoding)
+        usage = extract_usage(body, is_stream=is_stream)
+    plan = request_info['plan']
+    mode = plan.final_mode(status_code, time_taken)
+    if mode is not None and request_info['id'] is None:
+        # 请求阶段未采中，但属于错误、慢调用或按状态码补采的调用，此时才保存请求记录
+        with metrics.db_write('request'):
+            public_id = store_request_capture(request_info['request'], request_info['json_data'], mode, plan.policy)
+        request_info['id'] = request_info['request'].id
+        request_info['public_id'] = public_id
+    metrics.registry.inc('aihook_captures_total', (('mode', mode or 'skipped'),))
+    db_response = ResponseModel(
+        request_id=request_info['id'],
+        status_code=status_code,
+        body=body,
+        time_taken=time_taken,
+        is_stream=is_stream,
+        chunk_gaps=chunk_gaps
+    )
+    if headers is not None:
+        db_response.set_headers(headers)
+    if mode is not None:
+        plan.policy.apply_to_response(db_response, mode)
+    save_response_capture(request_info, db_response, api_service, forwarded_model, timer, usage, upstream_bytes)
+
+def save_response_capture(request_info, db_response, api_service, forwarded_model, timer, usage=None, upstream_bytes=0):
+    """保存响应记录并计算费用，同一事务内更新用量汇总，提交后更新监控指标；请求未保存时只更新汇总和指标"""
+    # 按转发目标上游的目录价格计费（目录在转发时按需后台刷新）
+    rollups.apply_usage(db_response, usage)
+    db_response.cost = catalog.compute_cost(request_info['base_url'], forwarded_model, usage)
+    
+    with metrics.db_write('response'):
+        write_start = time.perf_counter()
+        # 分区模式下响应写入请求所在的分区文件，汇总表仍在主数据库，两边分别提交
+        stored = request_info['id'] is not None
+        capture_session = partition_store.session(request_info['partition']) \
+            if stored and request_info['partition'] else db.session
+        try:
+            if stored:
+                capture_session.add(db_response)
+            rollups.record_capture(request_info['timestamp'], forwarded_model, api_service, db_response.status_code,
+                                   db_response.time_taken, timer.to_dict().get('ttft'), usage, db_response.is_stream,
+                                   key_tag=request_info['key_tag'], client=request_info['client'], cost=db_response.cost)
+            capture_session.flush()
+            # 响应行已在本事务内写入，耗时随同一事务补写到 timing 列
+            timer.add_duration('capture_write_response', time.perf_counter() - write_start)
+            timing = timer.to_dict()
+            db_response.set_timing(timing)
+            cached_fields = response_fields(db_response)
+            if capture_session is not db.session:
+                capture_session.commit()
+            db.session.commit()
+        finally:
+            if capture_session is not db.session:
+                capture_session.close()
+    if stored:
+        hot_cache.put_response(request_info['public_id'], cached_fields)
+    metrics.record_call(api_service, forwarded_model, db_response.status_code, timing, usage, upstream_bytes,
+                        db_response.cost)
+
+def span_route():
+    """阶段耗时按路由模板汇总，不按原始路径，避免路径中的 id 等参数让统计项无限增长"""
+    return request.url_rule.rule if request.url_rule is not None else request.path
+
+def make_proxy_request(method, path, headers, json_data=None, timer=None, tenant=None):
     """处理普通请求的代理函数"""
-    global API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE
+    # 匹配到租户时使用租户的上游和替换规则，未配置的项沿用全局设置
+    base_url, api_key, default_model, auto_replace_model, model_replace_mode = upstream_settings(tenant)
     
-    print(f"请求处理 - 替换模式: Key={KEY_REPLACE_MODE}, Model={MODEL_REPLACE_MODE}")
-    print(f"自动替换: Key={AUTO_REPLACE_KEY}, Model={AUTO_REPLACE_MODEL}")
-    print(f"当前服务器API Key: {API_KEY[:4] + '****' + API_KEY[-4:] if API_KEY else '未设置'}")
-    print(f"当前服务器默认模型: {DEFAULT_MODEL or '未设置'}")
+    print(f"请求处理 - 替换模式: Key={KEY_REPLACE_MODE}, Model={model_replace_mode}")
+    print(f"自动替换: Key={AUTO_REPLACE_KEY}, Model={auto_replace_model}")
+    print(f"当前服务器API Key: {api_key[:4] + '****' + api_key[-4:] if api_key else '未设置'}")
+    print(f"当前服务器默认模型: {default_model or '未设置'}")
+    
+    if timer is None:
+        timer = CallTimer()
+    route = span_route()
+    span_start = profiling.spans.begin()
     
     # 保存原始请求头和主体，用于前端对比显示
     original_headers = dict(headers)
@@ -708,12 +1239,13 @@ def make_proxy_request(method, path, headers, json_data=None):
     
     # 转发请求到配置的API服务
     start_time = time.time()
-    url = f"{OPENROUTER_BASE_URL}{path}"
+    url = f"{base_url}{path}"
     
-    proxied_headers = dict(headers)
-    # 移除可能导致问题的头部
-    if 'Host' in proxied_headers:
-        del proxied_headers['Host']
+    # 移除可能导致问题的头部，以及只对客户端连接有效的逐跳头部
+    proxied_headers = strip_hop_by_hop(headers, extra=('host',) + tenant_registry.internal_headers)
+    # 客户端没有声明可接受的压缩方式时要求上游不压缩，否则 requests 默认的 gzip 会被原样转发给客户端
+    if not any(k.lower() == 'accept-encoding' for k in proxied_headers):
+        proxied_headers['Accept-Encoding'] = 'identity'
         
     print(f"原始请求头: {proxied_headers}")
     
@@ -757,9 +1289,9 @@ def make_proxy_request(method, path, headers, json_data=None):
         del proxied_headers[k]
         
     # 设置新的API Key - 使用标准格式
-    if API_KEY:
-        proxied_headers['Authorization'] = f'Bearer {API_KEY}'
-        print(f"设置新的API Key: Bearer {API_KEY[:4]}...{API_KEY[-4:]}")
+    if api_key:
+        proxied_headers['Authorization'] = f'Bearer {api_key}'
+        print(f"设置新的API Key: Bearer {api_key[:4]}...{api_key[-4:]}")
         print(f"完成API Key设置，API Key被成功替换!")
     
     # 处理模型替换
@@ -768,27 +1300,46 @@ def make_proxy_request(method, path, headers, json_data=None):
         original_model = json_data.get('model')
         print(f"请求是否包含模型: {has_model}, 原始模型: {original_model}")
         
-        if AUTO_REPLACE_MODEL and DEFAULT_MODEL:
-            print(f"模型替换条件: 强制模式={MODEL_REPLACE_MODE=='force'}, 缺失时才替换={MODEL_REPLACE_MODE=='missing' and not has_model}")
+        mapped_model = tenant.map_model(original_model) if tenant is not None else None
+        if mapped_model:
+            json_data['model'] = mapped_model
+            print(f"租户模型映射: {original_model} -> {mapped_model}")
+        elif auto_replace_model and default_model:
+            print(f"模型替换条件: 强制模式={model_replace_mode=='force'}, 缺失时才替换={model_replace_mode=='missing' and not has_model}")
             
-            if MODEL_REPLACE_MODE == 'force' or (MODEL_REPLACE_MODE == 'missing' and not has_model):
-                print(f"执行模型替换: 模式={MODEL_REPLACE_MODE}, 原始模型={'存在: '+original_model if has_model else '不存在'}")
+            if model_replace_mode == 'force' or (model_replace_mode == 'missing' and not has_model):
+                print(f"执行模型替换: 模式={model_replace_mode}, 原始模型={'存在: '+original_model if has_model else '不存在'}")
                 # 强制模式：直接替换；缺失模式：只有在没有模型时才替换
                 old_model = json_data.get('model', '未设置')
-                json_data['model'] = DEFAULT_MODEL
-                print(f"模型替换: {old_model} -> {DEFAULT_MODEL}")
+                json_data['model'] = default_model
+                print(f"模型替换: {old_model} -> {default_model}")
             else:
-                print(f"不执行模型替换: 模式={MODEL_REPLACE_MODE}, 有模型={has_model}")
+                print(f"不执行模型替换: 模式={model_replace_mode}, 有模型={has_model}")
         else:
-            print(f"模型替换未触发: AUTO_REPLACE_MODEL={AUTO_REPLACE_MODEL}, DEFAULT_MODEL是否存在={DEFAULT_MODEL is not None}")
+            print(f"模型替换未触发: auto_replace_model={auto_replace_model}, default_model是否存在={default_model is not None}")
+    
+    # 提示缓存：替换后的模型需要显式标记时，为最近重复出现的消息前缀插入缓存断点
+    cache_breakpoints = PROMPT_CACHE.apply(json_data) if method == 'POST' else None
+    if cache_breakpoints:
+        print(f"插入提示缓存断点: {cache_breakpoints} 个")
+    
+    profiling.spans.end(route, 'rewrite', span_start)
     
     # 在替换后创建新的请求记录
+    span_start = profiling.spans.begin()
+    api_service = getApiServiceName(original_headers, base_url)
+    forwarded_model = json_data.get('model') if isinstance(json_data, dict) else None
     db_request = RequestModel(
         method=method,
         path=path,
-        api_service=getApiServiceName(original_headers, OPENROUTER_BASE_URL),
+        api_service=api_service,
         model=getModelName(original_json_data),
-        original_url=OPENROUTER_BASE_URL
+        original_url=base_url,
+        key_tag=rollups.key_tag_of(proxied_headers.get('Authorization')),
+        client=request.remote_addr,
+        tenant=tenant.name if tenant is not None else None,
+        cache_breakpoints=cache_breakpoints,
+        timestamp=datetime.utcnow()
     )
     # 保存原始请求和修改后的请求以便比较
     db_request.set_headers({
@@ -800,9 +1351,24 @@ def make_proxy_request(method, path, headers, json_data=None):
             'original': original_json_data,
             'modified': json_data
         })
-    
-    db.session.add(db_request)
-    db.session.commit()
+    # 转发目标上游的模型目录过期时在后台刷新，预检和计费按当前已缓存的目录进行
+    catalog.refresh_in_background(base_url, api_key)
+    # 预检：估算输入 token 数并记录在捕获中，超出模型上下文长度时不再上传给上游
+    preflight_error = run_preflight(db_request, json_data, forwarded_model, base_url)
+    # 按捕获策略决定是否在转发前保存请求，未采中的请求在响应阶段按状态码和耗时再决定
+    capture_plan = capture_policy_for(tenant).plan(method, path, db_request.model)
+    
+    profiling.spans.end(route, 'capture_build', span_start)
+    
+    capture_start = time.perf_counter()
+    if capture_plan.sampled:
+        with metrics.db_write('request'):
+            store_request_capture(db_request, original_json_data, capture_plan.mode, capture_plan.policy)
+    timer.add_duration('capture_write', time.perf_counter() - capture_start)
+    profiling.spans.end(route, 'capture_write', capture_start if profiling.spans.enabled else None)
+    if preflight_error is not None:
+        return reject_preflight(db_request, api_service, forwarded_model, timer, start_time, preflight_error,
+                                capture_plan, original_json_data)
                 
     # 打印最终请求信息
     print(f"最终请求URL: {url}")
@@ -812,7 +1378,7 @@ def make_proxy_request(method, path, headers, json_data=None):
     if 'Authorization' in proxied_headers:
         auth_key = proxied_headers['Authorization']
         print(f"实际发送请求的Authorization头: {auth_key}")
-        print(f"已设置的API Key是否生效: {API_KEY and auth_key == f'Bearer {API_KEY}'}")
+        print(f"已设置的API Key是否生效: {api_key and auth_key == f'Bearer {api_key}'}")
     else:
         print(f"警告: 最终请求中没有Authorization头!")
         for header_key in proxied_headers.keys():
@@ -822,65 +1388,89 @@ def make_proxy_request(method, path, headers, json_data=None):
     if method == 'POST' and json_data:
         print(f"最终请求体: {json_data}")
         
+    if method not in ('GET', 'POST', 'DELETE', 'PUT'):
+        return Response('Method not supported', status=405)
+    
+    timer.mark('forward')
+    reset_connect_time()
+    span_start = profiling.spans.begin()
     try:
-        if method == 'GET':
-            resp = requests.get(url, headers=proxied_headers)
-        elif method == 'POST':
-            resp = requests.post(url, headers=proxied_headers, json=json_data)
-        elif method == 'DELETE':
-            resp = requests.delete(url, headers=proxied_headers)
-        elif method == 'PUT':
-            resp = requests.put(url, headers=proxied_headers, json=json_data)
-        else:
-            resp = Response('Method not supported', status=405)
-            
-        time_taken = time.time() - start_time
+        # 以 stream=True 发送，直接转发上游的原始字节（不解压），压缩的响应原样转发给客户端
+        resp = upstream_session.request(method, url, headers=proxied_headers,
+                                        json=json_data if method in ('POST', 'PUT') else None, stream=True)
+        timer.add_duration('upstream_connect', pop_connect_time())
+        timer.mark('headers')
+        profiling.spans.end(route, 'upstream_headers', span_start)
+        upstream_headers = dict(resp.headers)
         
-        # 保存响应
-        db_response = ResponseModel(
-            request_id=db_request.id,
-            status_code=resp.status_code,
-            body=resp.text,
-            time_taken=time_taken,
-            is_stream=False
-        )
-        db_response.set_headers(dict(resp.headers))
-        
-        db.session.add(db_response)
-        db.session.commit()
+        def generate():
+            # 边收边转发，同一份 chunk 同时留给捕获记录，不再整体缓冲后再复制一份
+            chunks = []
+            relay_start = profiling.spans.begin()
+            error = None
+            timer.incomplete = True  # 响应体全部转发完成后置为 False
+            try:
+                for chunk in resp.raw.stream(RELAY_CHUNK_SIZE, decode_content=False):
+                    timer.on_chunk(chunk)
+                    chunks.append(chunk)
+                    yield chunk
+                timer.incomplete = False
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                resp.close()
+                # 客户端提前断开（生成器被关闭）或读取上游失败时同样保存响应，并在阶段耗时中标记响应体不完整
+                time_taken = time.time() - start_time
+                timer.mark('done')
+                profiling.spans.end(route, 'relay', relay_start)
+                
+                # 保存响应，解压留给后台写入线程
+                submit_start = profiling.spans.begin()
+                if error is not None:
+                    print(f"读取上游响应体失败: {str(error)}")
+                    capture_response(db_request, api_service, forwarded_model, timer, 500,
+                                     f'读取上游响应体失败: {str(error)}', time_taken,
+                                     plan=capture_plan, json_data=original_json_data)
+                else:
+                    capture_response(db_request, api_service, forwarded_model, timer, resp.status_code,
+                                     b''.join(chunks), time_taken, headers=upstream_headers,
+                                     content_encoding=upstream_headers.get('Content-Encoding'),
+                                     plan=capture_plan, json_data=original_json_data)
+                profiling.spans.end(route, 'capture_submit', submit_start)
         
-        # 返回响应给客户端
-        response = Response(
-            resp.content,
+        # 转发的字节与上游完全一致，保留上游的 Content-Length，客户端无需分块传输
+        return Response(
+            stream_with_context(generate()),
             status=resp.status_code,
-            headers=dict(resp.headers)
+            headers=strip_hop_by_hop(upstream_headers)
         )
-        return response
         
     except Exception as e:
         time_taken = time.time() - start_time
+        timer.add_duration('upstream_connect', pop_connect_time())
+        timer.mark('done')
         
         # 保存错误响应
-        db_response = ResponseModel(
-            request_id=db_request.id,
-            status_code=500,
-            body=str(e),
-            time_taken=time_taken,
-            is_stream=False
-        )
-        db.session.add(db_response)
-        db.session.commit()
+        capture_response(db_request, api_service, forwarded_model, timer, 500, str(e), time_taken,
+                         plan=capture_plan, json_data=original_json_data)
         
         return jsonify({'error': str(e)}), 500
 
-def make_proxy_stream_request(method, path, headers, json_data=None):
+def make_proxy_stream_request(method, path, headers, json_data=None, timer=None, tenant=None):
     """处理流式请求的代理函数"""
-    global API_KEY, DEFAULT_MODEL, AUTO_REPLACE_KEY, AUTO_REPLACE_MODEL, KEY_REPLACE_MODE, MODEL_REPLACE_MODE
+    # 匹配到租户时使用租户的上游和替换规则，未配置的项沿用全局设置
+    base_url, api_key, default_model, auto_replace_model, model_replace_mode = upstream_settings(tenant)
     
-    print(f"流式请求处理 - 替换模式: Key={KEY_REPLACE_MODE}, Model={MODEL_REPLACE_MODE}")
-    print(f"流式自动替换: Key={AUTO_REPLACE_KEY}, Model={AUTO_REPLACE_MODEL}")
-    print(f"当前服务器API Key: {API_KEY[:4] + '****' + API_KEY[-4:] if API_KEY else '未设置'}")
-    print(f"当前服务器默认模型: {DEFAULT_MODEL or '未设置'}")
+    print(f"流式请求处理 - 替换模式: Key={KEY_REPLACE_MODE}, Model={model_replace_mode}")
+    print(f"流式自动替换: Key={AUTO_REPLACE_KEY}, Model={auto_replace_model}")
+    print(f"当前服务器API Key: {api_key[:4] + '****' + api_key[-4:] if api_key else '未设置'}")
+    print(f"当前服务器默认模型: {default_model or '未设置'}")
+    
+    if timer is None:
+        timer = CallTimer()
+    route = span_route()
+    span_start = profiling.spans.begin()
     
     # 保存原始请求头和主体，用于前端对比显示
     original_headers = dict(headers)
@@ -888,12 +1478,13 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
     
     # 转发请求到配置的API服务
     start_time = time.time()
-    url = f"{OPENROUTER_BASE_URL}{path}"
+    url = f"{base_url}{path}"
     
-    proxied_headers = dict(headers)
-    # 移除可能导致问题的头部
-    if 'Host' in proxied_headers:
-        del proxied_headers['Host']
+    # 移除可能导致问题的头部，以及只对客户端连接有效的逐跳头部
+    proxied_headers = strip_hop_by_hop(headers, extra=('host',) + tenant_registry.internal_headers)
+    # 客户端没有声明可接受的压缩方式时要求上游不压缩，否则 requests 默认的 gzip 会被原样转发给客户端
+    if not any(k.lower() == 'accept-encoding' for k in proxied_headers):
+        proxied_headers['Accept-Encoding'] = 'identity'
         
     print(f"原始流式请求头: {proxied_headers}")
     
@@ -937,9 +1528,9 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
         del proxied_headers[k]
         
     # 设置新的API Key - 使用标准格式
-    if API_KEY:
-        proxied_headers['Authorization'] = f'Bearer {API_KEY}'
-        print(f"设置流式请求新的API Key: Bearer {API_KEY[:4]}...{API_KEY[-4:]}")
+    if api_key:
+        proxied_headers['Authorization'] = f'Bearer {api_key}'
+        print(f"设置流式请求新的API Key: Bearer {api_key[:4]}...{api_key[-4:]}")
         print(f"完成流式请求API Key设置，API Key被成功替换!")
     
     # 处理模型替换
@@ -948,27 +1539,46 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
         original_model = json_data.get('model')
         print(f"流式请求是否包含模型: {has_model}, 原始模型: {original_model}")
         
-        if AUTO_REPLACE_MODEL and DEFAULT_MODEL:
-            print(f"模型替换条件: 强制模式={MODEL_REPLACE_MODE=='force'}, 缺失时才替换={MODEL_REPLACE_MODE=='missing' and not has_model}")
+        mapped_model = tenant.map_model(original_model) if tenant is not None else None
+        if mapped_model:
+            json_data['model'] = mapped_model
+            print(f"租户模型映射: {original_model} -> {mapped_model}")
+        elif auto_replace_model and default_model:
+            print(f"模型替换条件: 强制模式={model_replace_mode=='force'}, 缺失时才替换={model_replace_mode=='missing' and not has_model}")
             
-            if MODEL_REPLACE_MODE == 'force' or (MODEL_REPLACE_MODE == 'missing' and not has_model):
-                print(f"执行流式模型替换: 模式={MODEL_REPLACE_MODE}, 原始模型={'存在: '+original_model if has_model else '不存在'}")
+            if model_replace_mode == 'force' or (model_replace_mode == 'missing' and not has_model):
+                print(f"执行流式模型替换: 模式={model_replace_mode}, 原始模型={'存在: '+original_model if has_model else '不存在'}")
                 # 强制模式：直接替换；缺失模式：只有在没有模型时才替换
                 old_model = json_data.get('model', '未设置')
-                json_data['model'] = DEFAULT_MODEL
-                print(f"流式模型替换: {old_model} -> {DEFAULT_MODEL}")
+                json_data['model'] = default_model
+                print(f"流式模型替换: {old_model} -> {default_model}")
             else:
-                print(f"不执行流式模型替换: 模式={MODEL_REPLACE_MODE}, 有模型={has_model}")
+                print(f"不执行流式模型替换: 模式={model_replace_mode}, 有模型={has_model}")
         else:
-            print(f"流式模型替换未触发: AUTO_REPLACE_MODEL={AUTO_REPLACE_MODEL}, DEFAULT_MODEL是否存在={DEFAULT_MODEL is not None}")
+            print(f"流式模型替换未触发: auto_replace_model={auto_replace_model}, default_model是否存在={default_model is not None}")
+    
+    # 提示缓存：替换后的模型需要显式标记时，为最近重复出现的消息前缀插入缓存断点
+    cache_breakpoints = PROMPT_CACHE.apply(json_data) if method == 'POST' else None
+    if cache_breakpoints:
+        print(f"插入提示缓存断点: {cache_breakpoints} 个")
+    
+    profiling.spans.end(route, 'rewrite', span_start)
     
     # 在替换后创建新的请求记录
+    span_start = profiling.spans.begin()
+    api_service = getApiServiceName(original_headers, base_url)
+    forwarded_model = json_data.get('model') if isinstance(json_data, dict) else None
     db_request = RequestModel(
         method=method,
         path=path,
-        api_service=getApiServiceName(original_headers, OPENROUTER_BASE_URL),
+        api_service=api_service,
         model=getModelName(original_json_data),
-        original_url=OPENROUTER_BASE_URL
+        original_url=base_url,
+        key_tag=rollups.key_tag_of(proxied_headers.get('Authorization')),
+        client=request.remote_addr,
+        tenant=tenant.name if tenant is not None else None,
+        cache_breakpoints=cache_breakpoints,
+        timestamp=datetime.utcnow()
     )
     # 保存原始请求和修改后的请求以便比较
     db_request.set_headers({
@@ -980,9 +1590,24 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
             'original': original_json_data,
             'modified': json_data
         })
-    
-    db.session.add(db_request)
-    db.session.commit()
+    # 转发目标上游的模型目录过期时在后台刷新，预检和计费按当前已缓存的目录进行
+    catalog.refresh_in_background(base_url, api_key)
+    # 预检：估算输入 token 数并记录在捕获中，超出模型上下文长度时不再上传给上游
+    preflight_error = run_preflight(db_request, json_data, forwarded_model, base_url)
+    # 按捕获策略决定是否在转发前保存请求，未采中的请求在响应阶段按状态码和耗时再决定
+    capture_plan = capture_policy_for(tenant).plan(method, path, db_request.model)
+    
+    profiling.spans.end(route, 'capture_build', span_start)
+    
+    capture_start = time.perf_counter()
+    if capture_plan.sampled:
+        with metrics.db_write('request'):
+            store_request_capture(db_request, original_json_data, capture_plan.mode, capture_plan.policy)
+    timer.add_duration('capture_write', time.perf_counter() - capture_start)
+    profiling.spans.end(route, 'capture_write', capture_start if profiling.spans.enabled else None)
+    if preflight_error is not None:
+        return reject_preflight(db_request, api_service, forwarded_model, timer, start_time, preflight_error,
+                                capture_plan, original_json_data)
     
     # 打印最终请求信息
     print(f"最终流式请求URL: {url}")
@@ -992,7 +1617,7 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
     if 'Authorization' in proxied_headers:
         auth_key = proxied_headers['Authorization']
         print(f"实际发送流式请求的Authorization头: {auth_key}")
-        print(f"已设置的API Key是否生效: {API_KEY and auth_key == f'Bearer {API_KEY}'}")
+        print(f"已设置的API Key是否生效: {api_key and auth_key == f'Bearer {api_key}'}")
     else:
         print(f"警告: 最终流式请求中没有Authorization头!")
         for header_key in proxied_headers.keys():
@@ -1002,39 +1627,52 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
     if method == 'POST' and json_data:
         print(f"最终流式请求体: {json_data}")
         
+    timer.mark('forward')
+    reset_connect_time()
+    span_start = profiling.spans.begin()
     try:
         # 使用stream=True发送请求
-        resp = requests.post(url, headers=proxied_headers, json=json_data, stream=True)
+        resp = upstream_session.post(url, headers=proxied_headers, json=json_data, stream=True)
+        timer.add_duration('upstream_connect', pop_connect_time())
+        timer.mark('headers')
+        profiling.spans.end(route, 'upstream_headers', span_start)
         
         # 收集整个响应内容用于日志记录
         complete_content = b''
         
         def generate():
             nonlocal complete_content
-            for chunk in resp.iter_content(chunk_size=1024):
-                complete_content += chunk
-                yield chunk
-            
-            # 在完成流后记录响应
-            time_taken = time.time() - start_time
-            
-            # 保存响应
-            db_response = ResponseModel(
-                request_id=db_request.id,
-                status_code=resp.status_code,
-                body=complete_content.decode('utf-8', errors='replace'),
-                time_taken=time_taken,
-                is_stream=True
-            )
-            db_response.set_headers(dict(resp.headers))
-            
-            db.session.add(db_response)
-            db.session.commit()
+            metrics.stream_started(api_service)
+            relay_start = profiling.spans.begin()
+            error = None
+            timer.incomplete = True  # 响应体全部转发完成后置为 False
+            try:
+                for chunk in resp.iter_content(chunk_size=1024):
+                    timer.on_chunk(chunk, sse=True)
+                    complete_content += chunk
+                    yield chunk
+                timer.incomplete = False
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                metrics.stream_finished(api_service)
+                resp.close()
+                # 流结束、客户端中途断开或读取上游失败时都记录响应（iter_content 已解压，保存时不再解压）
+                time_taken = time.time() - start_time
+                timer.mark('done')
+                profiling.spans.end(route, 'relay', relay_start)
+                submit_start = profiling.spans.begin()
+                if error is not None:
+                    print(f"读取上游流式响应失败: {str(error)}")
+                capture_response(db_request, api_service, forwarded_model, timer,
+                                 500 if error is not None else resp.status_code, complete_content,
+                                 time_taken, is_stream=True, headers=dict(resp.headers),
+                                 chunk_gaps=pack_gaps(timer.gaps), plan=capture_plan, json_data=original_json_data)
+                profiling.spans.end(route, 'capture_submit', submit_start)
         
-        # 创建一个响应头的副本，并确保删除Transfer-Encoding以避免重复
-        response_headers = dict(resp.headers)
-        if 'Transfer-Encoding' in response_headers:
-            del response_headers['Transfer-Encoding']
+        # 转发的是解压后的内容，去掉逐跳头部以及和内容不再对应的 Content-Encoding/Content-Length
+        response_headers = strip_hop_by_hop(dict(resp.headers), extra=('content-encoding', 'content-length'))
         
         return Response(
             stream_with_context(generate()),
@@ -1044,17 +1682,12 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
         
     except Exception as e:
         time_taken = time.time() - start_time
+        timer.add_duration('upstream_connect', pop_connect_time())
+        timer.mark('done')
         
         # 保存错误响应
-        db_response = ResponseModel(
-            request_id=db_request.id,
-            status_code=500,
-            body=str(e),
-            time_taken=time_taken,
-            is_stream=False
-        )
-        db.session.add(db_response)
-        db.session.commit()
+        capture_response(db_request, api_service, forwarded_model, timer, 500, str(e), time_taken,
+                         plan=capture_plan, json_data=original_json_data)
         
         return jsonify({'error': str(e)}), 500
 
@@ -1062,11 +1695,18 @@ def make_proxy_stream_request(method, path, headers, json_data=None):
 @proxy_bp.route('/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def proxy(path):
     """通用代理路由，处理所有OpenRouter API请求"""
+    timer = CallTimer()
+    reload_config_if_changed()
+    profiling.spans.sync()
     # 检查请求是否期望流式响应
     headers = dict(request.headers)
     json_data = request.get_json(silent=True)
     
+    tenant, rejected = tenant_registry.resolve(headers)
+    if rejected:
+        return jsonify({'error': '未知的客户端 Key，请联系管理员分配租户'}), 403
+    
     if request.method == 'POST' and json_data and json_data.get('stream', False):
-        return make_proxy_stream_request(request.method, '/' + path, headers, json_data)
+        return make_proxy_stream_request(request.method, '/' + path, headers, json_data, timer=timer, tenant=tenant)
     else:
-        return make_proxy_request(request.method, '/' + path, headers, json_data) 
\ No newline at end of file
+        return make_proxy_request(request.method, '/' + path, headers, json_data, timer=timer, tenant=tenant) 
\ No newline at end of file
@@ -0,0 +1,62 @@
+import json
+import math
+
+# 相对误差约 2% 的对数分桶，分桶可直接相加合并（DDSketch/HDR 类思路）
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+# 小于该值（秒）的样本统一计入零桶
+MIN_VALUE = 1e-4
+
+
+class LatencySketch:
+    """可合并的延迟分布草图，用于汇总表中按时间桶存储分位数信息"""
+
+    def __init__(self, buckets=None, zero_count=0):
+        self.buckets = buckets or {}
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def add(self, value, count=1):
+        if value is None:
+            return
+        if value < MIN_VALUE:
+            self.zero_count += count
+            return
+        index = int(math.ceil(math.log(value) / _LOG_GAMMA))
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        return self
+
+    def quantile(self, q):
+        """返回第 q 分位（0~1）的近似值，没有样本时返回 None"""
+        total = self.count
+        if total == 0:
+            return None
+        rank = q * (total - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                return round(2 * GAMMA ** index / (1 + GAMMA), 6)
+        return round(2 * GAMMA ** max(self.buckets) / (1 + GAMMA), 6)
+
+    def dumps(self):
+        return json.dumps({'z': self.zero_count, 'b': {str(k): v for k, v in self.buckets.items()}},
+                          separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, text):
+        if not text:
+            return cls()
+        data = json.loads(text)
+        return cls({int(k): v for k, v in data.get('b', {}).items()}, data.get('z', 0))
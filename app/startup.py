@@ -0,0 +1,40 @@
+import time
+import threading
+
+
+class Startup:
+    """
+    应用的一次性初始化步骤（建表、升级表结构、默认管理员、加载配置等）
+    导入模块和 create_app 时不做任何 I/O；在首个请求或命令行命令之前按注册顺序各执行一次，并打印每步耗时
+    使用 gunicorn 预加载时在 master 中执行，fork 出的 worker 直接继承初始化结果
+    """
+
+    def __init__(self):
+        self._steps = []
+        self._lock = threading.Lock()
+
+    def step(self, name):
+        """注册初始化步骤，可作为装饰器使用，函数接收 app 参数并在应用上下文中执行"""
+        def register(func):
+            self._steps.append((name, func))
+            return func
+        return register
+
+    def ensure(self, app):
+        """执行尚未完成的初始化，已完成时只有一次属性判断的开销"""
+        if app.extensions.get('startup_done'):
+            return
+        with self._lock:
+            if app.extensions.get('startup_done'):
+                return
+            began = time.perf_counter()
+            with app.app_context():
+                for name, func in self._steps:
+                    step_began = time.perf_counter()
+                    func(app)
+                    print(f"启动步骤 {name}: {(time.perf_counter() - step_began) * 1000:.1f} ms")
+            app.extensions['startup_done'] = True
+            print(f"启动初始化完成: {(time.perf_counter() - began) * 1000:.1f} ms")
+
+
+startup = Startup()
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import itertools
+import threading
+
+from app.capture_policy import CapturePolicy, DISABLED as CAPTURE_DISABLED
+
+# 租户路由表，文件不存在时所有请求使用全局设置
+TENANTS_FILE = os.environ.get('AI_HOOK_TENANTS_FILE') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tenants.json')
+# 最多每秒检查一次文件修改时间
+CHECK_INTERVAL = 1.0
+MODEL_REPLACE_MODES = ('force', 'missing')
+
+
+class Tenant:
+    """一个租户的上游配置，未设置的项沿用全局设置"""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.base_url = (config.get('base_url') or '').rstrip('/') or None
+        self.api_keys = [key for key in config.get('api_keys') or [] if key]
+        self.default_model = config.get('default_model') or None
+        self.model_replace_mode = config.get('model_replace_mode') or 'force'
+        if self.model_replace_mode not in MODEL_REPLACE_MODES:
+            raise ValueError(f'租户 {name} 的 model_replace_mode 只支持: {", ".join(MODEL_REPLACE_MODES)}')
+        self.model_map = dict(config.get('model_map') or {})
+        # 租户自己的捕获策略，未设置时使用全局策略；capture 为 false 时不保存任何捕获记录
+        if config.get('capture_policy') is not None:
+            self.capture_policy = CapturePolicy(config['capture_policy'])
+        else:
+            self.capture_policy = None if config.get('capture', True) else CAPTURE_DISABLED
+        # 上游 Key 池轮流使用；itertools.cycle 的 next() 在 CPython 中是原子操作
+        self._keys = itertools.cycle(self.api_keys) if self.api_keys else None
+
+    def next_api_key(self):
+        return next(self._keys) if self._keys is not None else None
+
+    def map_model(self, model):
+        """按租户的模型映射表改写模型名，不在表中时返回 None"""
+        return self.model_map.get(model) if isinstance(model, str) else None
+
+
+def _client_key(headers_lower):
+    """从请求头中取出客户端使用的 Key（Authorization 的 Bearer 值或 X-Api-Key）"""
+    auth = headers_lower.get('authorization')
+    if auth:
+        return auth[7:].strip() if auth[:7].lower() == 'bearer ' else auth.strip()
+    return headers_lower.get('x-api-key')
+
+
+class TenantRegistry:
+    """
+    租户路由表：把客户端 Key 或指定请求头的值编译为字典，每个请求只做一次字典查找
+    路由表文件修改后自动重新加载，加载失败时保留上一版
+    文件格式：
+      {
+        "tenant_header": "X-Tenant",       可选，按该请求头的值匹配租户
+        "reject_unknown": false,           为 true 时拒绝未匹配任何租户的请求
+        "tenants": {
+          "team-a": {"client_keys": [...], "header_values": [...], "base_url": "...", "api_keys": [...],
+                     "default_model": "...", "model_replace_mode": "force", "model_map": {...}, "capture": true,
+                     "capture_policy": {...}}
+        }
+      }
+    """
+
+    def __init__(self, path=TENANTS_FILE):
+        self.path = path
+        self.tenant_header = None
+        self.reject_unknown = False
+        self.tenants = {}
+        self._by_key = {}
+        self._by_header = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.tenants)
+
+    @property
+    def internal_headers(self):
+        """只用于匹配租户、不转发给上游的请求头（小写）"""
+        return (self.tenant_header,) if self.tenant_header else ()
+
+    def load(self, config):
+        """编译路由表，配置无效时抛出 ValueError，不影响当前生效的路由表"""
+        tenants = {}
+        by_key = {}
+        by_header = {}
+        for name, tenant_config in (config.get('tenants') or {}).items():
+            tenant = tenants[name] = Tenant(name, tenant_config)
+            for key in tenant_config.get('client_keys') or []:
+                if key in by_key:
+                    raise ValueError(f'客户端 Key 同时属于租户 {by_key[key].name} 和 {name}')
+                by_key[key] = tenant
+            for value in tenant_config.get('header_values') or []:
+                if value in by_header:
+                    raise ValueError(f'请求头值 {value} 同时属于租户 {by_header[value].name} 和 {name}')
+                by_header[value] = tenant
+        # 一次性替换，请求线程不会看到更新到一半的路由表
+        self.tenant_header = (config.get('tenant_header') or '').lower() or None
+        self.reject_unknown = bool(config.get('reject_unknown'))
+        self.tenants, self._by_key, self._by_header = tenants, by_key, by_header
+
+    def reload_if_changed(self):
+        now = time.time()
+        if now - self._checked_at < CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            if mtime is None:
+                self.load({})
+                print(f"租户路由表已移除: {self.path}")
+                return
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.load(json.load(f))
+                print(f"已加载租户路由表: {len(self.tenants)} 个租户")
+            except (OSError, ValueError) as e:
+                print(f"加载租户路由表失败，继续使用上一版: {str(e)}")
+
+    def resolve(self, headers):
+        """
+        按请求头匹配租户，先匹配 tenant_header 的值，再匹配客户端 Key
+        :return: (租户或 None, 是否拒绝该请求)
+        """
+        self.reload_if_changed()
+        if not self.tenants:
+            return None, False
+        headers_lower = {k.lower(): v for k, v in headers.items()}
+        tenant = None
+        if self.tenant_header and self.tenant_header in headers_lower:
+            tenant = self._by_header.get(headers_lower[self.tenant_header])
+        if tenant is None:
+            tenant = self._by_key.get(_client_key(headers_lower))
+        return tenant, tenant is None and self.reject_unknown
+
+
+registry = TenantRegistry()
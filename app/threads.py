@@ -0,0 +1,151 @@
+import json
+import hashlib
+from datetime import datetime, time as dt_time, timedelta
+
+from sqlalchemy import select
+
+from app import db
+from app.models import Request as RequestModel, Response as ResponseModel
+from app.partitions import store as partition_store
+
+# 查找上一轮请求时最多比较的前缀数（从最长的开始）
+MAX_PREFIX_CANDIDATES = 200
+
+
+def _without_cache_control(value):
+    if isinstance(value, list):
+        return [_without_cache_control(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _without_cache_control(item) for key, item in value.items() if key != 'cache_control'}
+    return value
+
+
+def _hash_json(value, separators=None):
+    """
+    计算摘要用的 JSON 文本，忽略提示缓存的 cache_control 标记
+    客户端每轮把缓存断点放在不同的消息上，不影响同一对话的前缀匹配
+    """
+    text = json.dumps(value, sort_keys=True, ensure_ascii=False, separators=separators)
+    if '"cache_control"' in text:
+        text = json.dumps(_without_cache_control(value), sort_keys=True, ensure_ascii=False, separators=separators)
+    return text
+
+
+def prefix_hashes(body):
+    """
+    计算 messages 每个前缀的滚动摘要，第 i 项是前 i+1 条消息的摘要
+    system 字段（Anthropic 格式）作为初始值参与计算，不同系统提示的对话不会被连到一起
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('messages'), list):
+        return []
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(_hash_json(body.get('system')).encode('utf-8'))
+    state = digest.digest()
+    hashes = []
+    for message in body['messages']:
+        step = hashlib.blake2b(state, digest_size=16)
+        step.update(_hash_json(message, separators=(',', ':')).encode('utf-8'))
+        state = step.digest()
+        hashes.append(step.hexdigest())
+    return hashes
+
+
+def link_request(db_request, body):
+    """
+    为请求记录填写前缀摘要，并通过前缀摘要索引找到同一对话的上一轮请求
+    上一轮请求的完整 messages 摘要等于本次某个更短前缀的摘要，取消息最多、最近的一条
+    """
+    hashes = prefix_hashes(body)
+    if not hashes:
+        return
+    db_request.prefix_hash = hashes[-1]
+    db_request.message_count = len(hashes)
+    candidates = hashes[:-1][-MAX_PREFIX_CANDIDATES:]
+    if not candidates:
+        return
+    query = (select(RequestModel.id, RequestModel.thread_id, RequestModel.message_count)
+             .where(RequestModel.prefix_hash.in_(candidates))
+             .order_by(RequestModel.message_count.desc(), RequestModel.id.desc())
+             .limit(1))
+    if not partition_store.enabled:
+        parent = db.session.execute(query).first()
+        if parent is not None:
+            db_request.parent_id = parent.id
+            db_request.thread_id = parent.thread_id or parent.id
+        return
+
+    # 分区模式下只在当前和上一个分区中查找上一轮，id 换算为全局 id
+    best = None
+    current = partition_store.key_for(db_request.timestamp)
+    for key in (current, partition_store.key_for(datetime.combine(current, dt_time()) - timedelta(days=1))):
+        capture_session = partition_store.session(key, create=False)
+        if capture_session is None:
+            continue
+        with capture_session:
+            parent = capture_session.execute(query).first()
+        if parent is not None and (best is None or (parent.message_count or 0) > (best[2] or 0)):
+            best = (partition_store.global_id(key, parent.id), parent.thread_id, parent.message_count)
+    if best is not None:
+        db_request.parent_id = best[0]
+        db_request.thread_id = best[1] or best[0]
+
+
+def get_thread(thread_id):
+    """一次索引查询取出整个对话的所有轮次，附带每轮的延迟和相对上一轮的 token 增量"""
+    if partition_store.enabled:
+        return _build_turns(_thread_rows_partitioned(thread_id))
+    rows = db.session.execute(
+        select(RequestModel.id, RequestModel.timestamp, RequestModel.parent_id, RequestModel.message_count,
+               RequestModel.model, ResponseModel.status_code, ResponseModel.time_taken, ResponseModel.timing,
+               ResponseModel.prompt_tokens, ResponseModel.completion_tokens, ResponseModel.cost)
+        .outerjoin(ResponseModel, ResponseModel.request_id == RequestModel.id)
+        .where(RequestModel.thread_id == thread_id)
+        .order_by(RequestModel.id)
+    ).all()
+    return _build_turns(rows)
+
+
+def _thread_rows_partitioned(thread_id):
+    """分区模式下从对话第一轮所在的分区起，ATTACH 之后的所有分区一起查询"""
+    key, _ = partition_store.split_id(thread_id)
+    if key is None:
+        return []
+    rows = partition_store.union_query(
+        partition_store.existing(start=datetime.combine(key, dt_time())),
+        'SELECT {base} + q.id, q.timestamp, q.parent_id, q.message_count, q.model, r.status_code, r.time_taken, '
+        'r.timing, r.prompt_tokens, r.completion_tokens, r.cost '
+        'FROM {db}.request q LEFT JOIN {db}.response r ON r.request_id = q.id WHERE q.thread_id = ?',
+        params=(thread_id,), tail_sql=' ORDER BY 1')
+    return [(row[0], datetime.fromisoformat(row[1]) if row[1] else None) + tuple(row[2:]) for row in rows]
+
+
+def _build_turns(rows):
+    turns = []
+    by_id = {}
+    for (row_id, timestamp, parent_id, message_count, model, status_code, time_taken, timing,
+         prompt_tokens, completion_tokens, cost) in rows:
+        timing = json.loads(timing) if timing else {}
+        parent = by_id.get(parent_id)
+        turn = {
+            'id': row_id,
+            'timestamp': timestamp.isoformat() if timestamp else None,
+            'parent_id': parent_id,
+            'model': model,
+            'message_count': message_count,
+            'status_code': status_code,
+            'time_taken': time_taken,
+            'ttft': timing.get('ttft'),
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cost': cost,
+            'new_messages': None,
+            'prompt_tokens_delta': None,
+        }
+        if parent is not None:
+            if message_count is not None and parent['message_count'] is not None:
+                turn['new_messages'] = message_count - parent['message_count']
+            if prompt_tokens is not None and parent['prompt_tokens'] is not None:
+                turn['prompt_tokens_delta'] = prompt_tokens - parent['prompt_tokens']
+        by_id[row_id] = turn
+        turns.append(turn)
+    return turns
@@ -0,0 +1,216 @@
+import time
+import json
+import struct
+import threading
+from array import array
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# chunk 间隔的存储格式：首字节为格式版本，之后是小端 uint32 微秒数组
+# 旧版本没有版本字节，直接保存本机字节序的毫秒数组（长度是 4 的倍数）
+GAPS_FORMAT_US = 1
+MAX_GAP_US = 0xFFFFFFFF
+
+# 每个线程记录本次上游请求建立连接的耗时（复用连接时为0）
+_connect_local = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_local.elapsed = getattr(_connect_local, 'elapsed', 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_local.elapsed = getattr(_connect_local, 'elapsed', 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+_TIMED_POOL_CLASSES = {
+    'http': _TimedHTTPConnectionPool,
+    'https': _TimedHTTPSConnectionPool,
+}
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    记录TCP/TLS建连耗时的适配器
+    经 HTTP(S)_PROXY 转发时同样计时（包含与代理建连及 CONNECT 隧道耗时）；
+    SOCKS 代理使用 urllib3 自带的连接池，不计时，upstream_connect 记为0
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(_TIMED_POOL_CLASSES)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        is_new = proxy not in self.proxy_manager
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if is_new and not proxy.lower().startswith('socks'):
+            manager.pool_classes_by_scheme = dict(_TIMED_POOL_CLASSES)
+        return manager
+
+
+def create_upstream_session():
+    """
+    创建转发上游用的共享Session：复用连接池，并记录建连耗时
+    代理不应在不同客户端之间共享上游Cookie，因此禁用Cookie
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = TimedHTTPAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def reset_connect_time():
+    _connect_local.elapsed = 0.0
+
+
+def pop_connect_time():
+    elapsed = getattr(_connect_local, 'elapsed', 0.0)
+    _connect_local.elapsed = 0.0
+    return elapsed
+
+
+def pack_gaps(gaps):
+    """把相邻chunk间隔（整数微秒）打包为带版本字节的小端字节串，与机器字节序无关"""
+    if not gaps:
+        return None
+    return bytes((GAPS_FORMAT_US,)) + struct.pack(f'<{len(gaps)}I', *gaps)
+
+
+def gaps_from_ms(gaps):
+    """把导出文件中的毫秒间隔列表换算为 pack_gaps 使用的整数微秒"""
+    return [min(max(int(round(gap * 1000)), 0), MAX_GAP_US) for gap in gaps if isinstance(gap, (int, float))]
+
+
+def unpack_gaps(data):
+    """将打包的chunk间隔还原为毫秒列表（精确到微秒），兼容旧版本的整数毫秒格式"""
+    if not data:
+        return []
+    if len(data) % 4 == 1 and data[0] == GAPS_FORMAT_US:
+        return [gap / 1000 for gap in struct.unpack(f'<{(len(data) - 1) // 4}I', data[1:])]
+    return list(struct.unpack(f'<{len(data) // 4}I', data))
+
+
+class CallTimer:
+    """
+    记录一次代理调用的阶段耗时，所有时间点均为 perf_counter 值
+    阶段说明（单位秒）：
+      proxy_overhead  收到请求 -> 开始转发（含改写和请求记录落库）
+      capture_write   请求记录落库耗时（位于转发之前的关键路径上）
+      capture_write_response 响应记录及用量汇总写入耗时（不含最终提交，提交耗时见 /metrics 的写库直方图）
+      upstream_connect 建立上游连接耗时，复用连接时为0
+      ttfb            开始转发 -> 收到上游响应头
+      first_chunk     开始转发 -> 收到第一个响应体chunk
+      ttft            开始转发 -> 收到第一个SSE内容token（仅流式）
+      stream_duration 收到响应头 -> 最后一个chunk
+      total           收到请求 -> 响应体全部转发完成（或客户端断开、读取上游失败）
+    incomplete 为 True 表示响应体没有完整转发（客户端提前断开或读取上游失败），保存的是已转发的部分
+    """
+
+    def __init__(self, received_at=None):
+        self.received_at = received_at if received_at is not None else time.perf_counter()
+        self.marks = {'received': self.received_at}
+        self.durations = {}
+        self.gaps = array('I')
+        self.chunk_count = 0
+        self.incomplete = False
+        self._last_chunk_at = None
+        self._sse_pending = b''
+        self._token_seen = False
+
+    def mark(self, name):
+        self.marks[name] = time.perf_counter()
+
+    def add_duration(self, name, seconds):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def on_chunk(self, chunk, sse=False):
+        """每转发一个响应体chunk调用一次，记录间隔，流式时检测首个内容token"""
+        now = time.perf_counter()
+        if self._last_chunk_at is None:
+            self.marks['first_chunk'] = now
+        else:
+            self.gaps.append(min(int((now - self._last_chunk_at) * 1000000), MAX_GAP_US))
+        self._last_chunk_at = now
+        self.marks['last_chunk'] = now
+        self.chunk_count += 1
+
+        if sse and not self._token_seen:
+            self._scan_sse(chunk, now)
+
+    def _scan_sse(self, chunk, now):
+        # 只解析到第一个内容token为止，之后不再有解析开销
+        data = self._sse_pending + chunk
+        lines = data.split(b'\n')
+        self._sse_pending = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line.startswith(b'data:'):
+                continue
+            payload = line[5:].strip()
+            if not payload or payload == b'[DONE]':
+                continue
+            try:
+                event = json.loads(payload)
+            except ValueError:
+                continue
+            if _event_has_content(event):
+                self._token_seen = True
+                self._sse_pending = b''
+                self.marks['first_token'] = now
+                return
+
+    def _since(self, start, end):
+        if start not in self.marks or end not in self.marks:
+            return None
+        return round(self.marks[end] - self.marks[start], 6)
+
+    def to_dict(self):
+        """导出阶段耗时字典，用于保存到响应记录"""
+        return {
+            'proxy_overhead': self._since('received', 'forward'),
+            'capture_write': round(self.durations['capture_write'], 6) if 'capture_write' in self.durations else None,
+            'capture_write_response': round(self.durations['capture_write_response'], 6) if 'capture_write_response' in self.durations else None,
+            'upstream_connect': round(self.durations['upstream_connect'], 6) if 'upstream_connect' in self.durations else None,
+            'ttfb': self._since('forward', 'headers'),
+            'first_chunk': self._since('forward', 'first_chunk'),
+            'ttft': self._since('forward', 'first_token'),
+            'stream_duration': self._since('headers', 'last_chunk'),
+            'total': self._since('received', 'done'),
+            'chunk_count': self.chunk_count,
+            'incomplete': self.incomplete,
+        }
+
+
+def _event_has_content(event):
+    """判断一个SSE事件是否携带了实际输出内容"""
+    if not isinstance(event, dict):
+        return False
+    for choice in event.get('choices') or []:
+        if not isinstance(choice, dict):
+            continue
+        delta = choice.get('delta') or {}
+        if isinstance(delta, dict) and (delta.get('content') or delta.get('reasoning') or delta.get('tool_calls')):
+            return True
+        if choice.get('text'):
+            return True
+    return False
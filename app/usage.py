@@ -0,0 +1,60 @@
+import json
+
+
+def _normalize_usage(usage):
+    """把不同服务商的 usage 字段统一成 prompt/completion/total/cached 四项"""
+    if not isinstance(usage, dict):
+        return None
+    prompt_tokens = usage.get('prompt_tokens', usage.get('input_tokens')) or 0
+    completion_tokens = usage.get('completion_tokens', usage.get('output_tokens')) or 0
+    total_tokens = usage.get('total_tokens') or (prompt_tokens + completion_tokens)
+    details = usage.get('prompt_tokens_details') or {}
+    cached_tokens = (details.get('cached_tokens') if isinstance(details, dict) else None) \
+        or usage.get('cache_read_input_tokens') or 0
+    return {
+        'prompt_tokens': int(prompt_tokens),
+        'completion_tokens': int(completion_tokens),
+        'total_tokens': int(total_tokens),
+        'cached_tokens': int(cached_tokens),
+    }
+
+
+def extract_usage(body, is_stream=False):
+    """
+    从响应体中解析 token 用量
+    :param body: 响应体文本（非流式为JSON，流式为SSE文本）
+    :param is_stream: 是否为流式响应
+    :return: 统一格式的用量字典，没有 usage 时返回 None
+    """
+    if not body:
+        return None
+
+    if not is_stream:
+        if '"usage"' not in body:
+            return None
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        return _normalize_usage(data.get('usage')) if isinstance(data, dict) else None
+
+    # 流式响应的 usage 一般在最后一个事件中，从尾部向前查找即可
+    end = len(body)
+    while True:
+        pos = body.rfind('"usage"', 0, end)
+        if pos < 0:
+            return None
+        line_start = body.rfind('\n', 0, pos) + 1
+        line_end = body.find('\n', pos)
+        line = body[line_start:line_end if line_end >= 0 else len(body)].strip()
+        end = line_start
+        if not line.startswith('data:'):
+            continue
+        try:
+            event = json.loads(line[5:].strip())
+        except ValueError:
+            continue
+        if isinstance(event, dict):
+            usage = _normalize_usage(event.get('usage'))
+            if usage:
+                return usage
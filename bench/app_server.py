@@ -0,0 +1,38 @@
+"""
+基准测试用的应用进程：使用临时数据库，把上游指向模拟服务，以多线程非调试模式运行
+由 bench/run_bench.py 启动，一般不需要手动运行
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', required=True, help='临时数据库文件路径')
+    parser.add_argument('--upstream', required=True, help='模拟上游的 base URL')
+    parser.add_argument('--port', type=int, required=True)
+    args = parser.parse_args()
+
+    from app import create_app
+    import app.routes as routes
+    from app.startup import startup
+
+    application = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(args.db)})
+    # 先完成初始化（其中会加载 config.json），再覆盖上游设置
+    startup.ensure(application)
+    # 只修改进程内的设置，不写回 config.json
+    routes.OPENROUTER_BASE_URL = args.upstream
+    routes.API_KEY = routes.API_KEY or 'sk-bench-0000'
+
+    server = make_server('127.0.0.1', args.port, application, threaded=True)
+    print('BENCH_APP_READY', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+本地模拟的 LLM 上游，实现 OpenAI/OpenRouter 兼容的 chat completions 和 models 接口
+可单独运行：python bench/mock_upstream.py --port 18080 --latency 50 --chunks 50
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockSettings:
+    def __init__(self, latency_ms=50, chunk_interval_ms=20, chunks=50, chunk_size=16, response_bytes=2048):
+        self.latency_ms = latency_ms  # 收到请求到返回响应头的延迟
+        self.chunk_interval_ms = chunk_interval_ms  # 流式响应相邻 chunk 的间隔
+        self.chunks = chunks  # 流式响应的内容 chunk 数
+        self.chunk_size = chunk_size  # 每个 chunk 的内容字符数
+        self.response_bytes = response_bytes  # 非流式响应内容的大小
+
+
+def make_handler(settings):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _write_chunk(self, data):
+            self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/models'):
+                self._send_json({'data': [{
+                    'id': 'mock/model', 'context_length': 128000,
+                    'pricing': {'prompt': '0.000001', 'completion': '0.000002'}
+                }]})
+            else:
+                self._send_json({'error': 'not found'}, status=404)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                payload = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                payload = {}
+            model = payload.get('model') or 'mock/model'
+            time.sleep(settings.latency_ms / 1000.0)
+
+            if payload.get('stream'):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                piece = 'x' * settings.chunk_size
+                for _ in range(settings.chunks):
+                    event = {'id': 'mock', 'model': model, 'choices': [{'index': 0, 'delta': {'content': piece}}]}
+                    self._write_chunk(b'data: ' + json.dumps(event).encode('utf-8') + b'\n\n')
+                    time.sleep(settings.chunk_interval_ms / 1000.0)
+                final = {'id': 'mock', 'model': model, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}],
+                         'usage': {'prompt_tokens': 100, 'completion_tokens': settings.chunks,
+                                   'total_tokens': 100 + settings.chunks}}
+                self._write_chunk(b'data: ' + json.dumps(final).encode('utf-8') + b'\n\n')
+                self._write_chunk(b'data: [DONE]\n\n')
+                self._write_chunk(b'')
+            else:
+                self._send_json({
+                    'id': 'mock', 'object': 'chat.completion', 'model': model,
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': 'x' * settings.response_bytes}}],
+                    'usage': {'prompt_tokens': 100, 'completion_tokens': settings.response_bytes // 4,
+                              'total_tokens': 100 + settings.response_bytes // 4}
+                })
+
+    return MockHandler
+
+
+def start_mock_upstream(settings, host='127.0.0.1', port=0):
+    """在后台线程启动模拟上游，返回 (server, base_url)"""
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-upstream', daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地模拟 LLM 上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--latency', type=float, default=50, help='响应头延迟（毫秒）')
+    parser.add_argument('--chunk-interval', type=float, default=20, help='流式 chunk 间隔（毫秒）')
+    parser.add_argument('--chunks', type=int, default=50, help='流式内容 chunk 数')
+    parser.add_argument('--chunk-size', type=int, default=16, help='每个 chunk 的内容字符数')
+    parser.add_argument('--response-bytes', type=int, default=2048, help='非流式响应内容大小')
+    args = parser.parse_args()
+
+    mock_settings = MockSettings(args.latency, args.chunk_interval, args.chunks, args.chunk_size, args.response_bytes)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock_settings))
+    print(f"模拟上游已启动: http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,331 @@
+"""
+代理基准测试：启动本地模拟上游和使用临时数据库的应用进程，
+先直连上游、再经代理回放同一批流量，统计代理额外引入的延迟
+
+用法示例：
+  python bench/run_bench.py --requests 500 --concurrency 16 --output bench/result.json
+  python bench/run_bench.py --replay-db data.db --compare bench/baseline.json
+"""
+import argparse
+import gzip
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from mock_upstream import MockSettings, start_mock_upstream
+
+# 与基线对比时，这些指标变大视为性能回退（吞吐量变小视为回退）
+REGRESSION_KEYS = ('added_latency_p50', 'added_latency_p99', 'ttft_overhead_p50', 'memory_per_stream_kb', 'db_bytes_per_request')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt', encoding='utf-8') if path.endswith('.gz') else open(path, 'r', encoding='utf-8')
+
+
+def _body_from_capture(body):
+    """捕获记录的请求体可能是 {'original':..., 'modified':...} 结构，回放时取原始请求"""
+    if isinstance(body, dict) and isinstance(body.get('original'), dict):
+        return body['original']
+    return body if isinstance(body, dict) else None
+
+
+def load_traffic(args):
+    """
+    加载回放流量，返回 [(path, body), ...]
+    支持 NDJSON 文件（每行为请求体，或包含 request.path/request.body 的导出记录）和已有的 data.db
+    """
+    traffic = []
+    if args.replay_jsonl:
+        with _open_text(args.replay_jsonl) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                req = record.get('request') if isinstance(record.get('request'), dict) else record
+                body = _body_from_capture(req.get('body') if 'body' in req else req)
+                if body and isinstance(body.get('messages'), list):
+                    traffic.append((req.get('path') or '/chat/completions', body))
+    elif args.replay_db:
+        conn = sqlite3.connect(f'file:{args.replay_db}?mode=ro', uri=True)
+        try:
+            for path, body in conn.execute(
+                    "SELECT path, body FROM request WHERE method = 'POST' ORDER BY id DESC LIMIT ?", (args.requests,)):
+                try:
+                    body = _body_from_capture(json.loads(body)) if body else None
+                except ValueError:
+                    continue
+                if body and isinstance(body.get('messages'), list):
+                    traffic.append((path or '/chat/completions', body))
+        finally:
+            conn.close()
+
+    if not traffic:
+        for i in range(args.requests):
+            traffic.append(('/chat/completions', {
+                'model': 'mock/model',
+                'messages': [{'role': 'user', 'content': f'benchmark request {i} ' + 'x' * args.prompt_bytes}],
+                'stream': (i % 10) * 10 < args.stream_ratio,
+            }))
+
+    # 按需要的请求数循环补齐
+    return [traffic[i % len(traffic)] for i in range(args.requests)]
+
+
+def run_one(session, base_url, path, body):
+    """发送一次请求，返回 (总耗时, 首个内容chunk耗时, 是否成功)"""
+    start = time.perf_counter()
+    ttft = None
+    try:
+        resp = session.post(f'{base_url}{path}', json=body, headers={'Authorization': 'Bearer sk-bench'},
+                            stream=bool(body.get('stream')), timeout=300)
+        if body.get('stream'):
+            for chunk in resp.iter_content(chunk_size=None):
+                if ttft is None and b'"content"' in chunk:
+                    ttft = time.perf_counter() - start
+        else:
+            resp.content
+        return time.perf_counter() - start, ttft, resp.status_code < 400
+    except requests.RequestException:
+        return time.perf_counter() - start, ttft, False
+
+
+def run_phase(base_url, traffic, concurrency):
+    local = threading.local()
+
+    def task(item):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return run_one(local.session, base_url, *item)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(task, traffic))
+    return results, time.perf_counter() - start
+
+
+def read_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    """定期采样应用进程的常驻内存，记录峰值"""
+
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, read_rss_kb(self.pid) or 0)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def db_size(db_path):
+    """
+    先把 WAL 合并回主文件再统计数据库大小（含 WAL 文件）
+    WAL 文件会预分配并被循环复用，直接比较前后文件大小会把预热阶段的 WAL 计入本轮写入量
+    """
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        conn.close()
+    size = os.path.getsize(db_path)
+    if os.path.exists(db_path + '-wal'):
+        size += os.path.getsize(db_path + '-wal')
+    return size
+
+
+def start_app(upstream_url, db_path):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'bench', 'app_server.py'),
+         '--db', db_path, '--upstream', upstream_url, '--port', str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{base_url}/metrics', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('应用进程启动超时')
+
+
+def summarize(direct, proxied, elapsed, concurrency, traffic, rss_idle, rss_peak, db_bytes):
+    direct_latency = [r[0] for r in direct]
+    proxied_latency = [r[0] for r in proxied]
+    added = [p[0] - d[0] for p, d in zip(proxied, direct)]
+    ttft_overhead = [p[1] - d[1] for p, d in zip(proxied, direct) if p[1] is not None and d[1] is not None]
+    streams = sum(1 for _, body in traffic if body.get('stream'))
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'requests': len(proxied),
+        'stream_requests': streams,
+        'concurrency': concurrency,
+        'errors': sum(1 for r in proxied if not r[2]),
+        'throughput_rps': round(len(proxied) / elapsed, 2) if elapsed else None,
+        'direct_latency_p50': ms(percentile(direct_latency, 0.5)),
+        'proxied_latency_p50': ms(percentile(proxied_latency, 0.5)),
+        'proxied_latency_p99': ms(percentile(proxied_latency, 0.99)),
+        'added_latency_p50': ms(percentile(added, 0.5)),
+        'added_latency_p99': ms(percentile(added, 0.99)),
+        'ttft_overhead_p50': ms(percentile(ttft_overhead, 0.5)),
+        'ttft_overhead_p99': ms(percentile(ttft_overhead, 0.99)),
+        'rss_idle_kb': rss_idle,
+        'rss_peak_kb': rss_peak,
+        'memory_per_stream_kb': round((rss_peak - rss_idle) / max(min(concurrency, streams), 1), 1)
+        if rss_idle and rss_peak else None,
+        'db_bytes': db_bytes,
+        'db_bytes_per_request': round(db_bytes / len(proxied), 1) if proxied else None,
+    }
+
+
+def compare(result, baseline_path, threshold, min_delta):
+    """与基线结果对比，返回是否出现回退"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n与基线对比 ({baseline.get('commit')} -> {result.get('commit')}):")
+    regressed = False
+    for key, value in result['metrics'].items():
+        old = baseline.get('metrics', {}).get(key)
+        if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+            continue
+        change = (value - old) / abs(old) * 100 if old else 0.0
+        flag = ''
+        if abs(value - old) < min_delta:
+            pass
+        elif key in REGRESSION_KEYS and old and change > threshold:
+            flag = '  <-- 回退'
+            regressed = True
+        elif key == 'throughput_rps' and old and change < -threshold:
+            flag = '  <-- 回退'
+            regressed = True
+        print(f"  {key:24s} {old:>12} -> {value:>12} ({change:+.1f}%){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='代理基准测试')
+    parser.add_argument('--requests', type=int, default=200, help='请求总数')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发数')
+    parser.add_argument('--stream-ratio', type=int, default=50, help='合成流量中流式请求的百分比')
+    parser.add_argument('--prompt-bytes', type=int, default=2000, help='合成流量的提示词大小')
+    parser.add_argument('--replay-jsonl', help='从 NDJSON 文件回放流量（支持 .gz）')
+    parser.add_argument('--replay-db', help='从已有 data.db 回放最近的请求')
+    parser.add_argument('--latency', type=float, default=50, help='模拟上游响应头延迟（毫秒）')
+    parser.add_argument('--chunk-interval', type=float, default=10, help='模拟上游流式 chunk 间隔（毫秒）')
+    parser.add_argument('--chunks', type=int, default=30, help='模拟上游流式 chunk 数')
+    parser.add_argument('--chunk-size', type=int, default=16, help='模拟上游每个 chunk 的内容字符数')
+    parser.add_argument('--response-bytes', type=int, default=2048, help='模拟上游非流式响应大小')
+    parser.add_argument('--output', help='把结果写入 JSON 文件')
+    parser.add_argument('--compare', help='与之前保存的结果对比')
+    parser.add_argument('--threshold', type=float, default=10.0, help='判定回退的百分比阈值')
+    parser.add_argument('--min-delta', type=float, default=2.0, help='判定回退时要求的最小绝对差值，过滤小样本噪声')
+    args = parser.parse_args()
+
+    settings = MockSettings(args.latency, args.chunk_interval, args.chunks, args.chunk_size, args.response_bytes)
+    mock_server, upstream_url = start_mock_upstream(settings)
+    traffic = load_traffic(args)
+    print(f"回放 {len(traffic)} 个请求，并发 {args.concurrency}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'bench.db')
+        process, app_url = start_app(upstream_url, db_path)
+        try:
+            # 预热连接和数据库
+            run_phase(f'{app_url}/api/v1', traffic[:min(len(traffic), args.concurrency)], args.concurrency)
+            db_size_before = db_size(db_path)
+            rss_idle = read_rss_kb(process.pid)
+
+            print("直连模拟上游...")
+            direct, _ = run_phase(upstream_url, traffic, args.concurrency)
+
+            print("经代理转发...")
+            sampler = RssSampler(process.pid)
+            sampler.start()
+            proxied, elapsed = run_phase(f'{app_url}/api/v1', traffic, args.concurrency)
+            sampler.stop()
+            # 等待流式请求的捕获写入完成
+            time.sleep(0.5)
+            db_bytes = db_size(db_path) - db_size_before
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            mock_server.shutdown()
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'metrics': summarize(direct, proxied, elapsed, args.concurrency, traffic, rss_idle, sampler.peak, db_bytes),
+    }
+    print(json.dumps(result['metrics'], indent=2, ensure_ascii=False))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"结果已保存到: {args.output}")
+
+    if args.compare and compare(result, args.compare, args.threshold, args.min_delta):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
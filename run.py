@@ -3,5 +3,7 @@ from app import create_app
 app = create_app()
 
 if __name__ == '__main__':
+    from app.startup import startup
+    startup.ensure(app)
     # 已修复 chunked 编码重复问题
     app.run(debug=True, host='0.0.0.0', port=8876) 
\ No newline at end of file
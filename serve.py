@@ -0,0 +1,133 @@
+"""
+生产环境启动入口
+
+安装 gunicorn 时使用预分叉的多 worker 模式（每个 worker 多线程），否则退回单进程多线程模式。
+两种模式都支持优雅退出：收到 SIGTERM/SIGINT 后停止接收新请求，等待进行中的流式响应转发完毕，
+再写入未落库的捕获记录后退出。
+
+示例：
+  python serve.py --workers 4 --threads 16
+  kill -HUP <master pid>   # gunicorn 平滑重启 worker（配合 --no-preload 可加载新代码）
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='AI 请求 HOOKER 生产环境启动入口')
+    parser.add_argument('--host', default=os.environ.get('AI_HOOK_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('AI_HOOK_PORT', 8876)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('AI_HOOK_WORKERS', 2)), help='worker 进程数')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('AI_HOOK_THREADS', 16)), help='每个 worker 的线程数')
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.environ.get('AI_HOOK_GRACEFUL_TIMEOUT', 300)),
+                        help='优雅退出时等待进行中请求（含流式响应）的最长秒数')
+    parser.add_argument('--no-preload', action='store_true',
+                        help='不在 master 中预加载应用；此时 kill -HUP 可以让 worker 加载新代码')
+    return parser.parse_args()
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    # 多 worker 时指标需要跨进程汇总
+    if args.workers > 1 and not os.environ.get('AI_HOOK_METRICS_DIR'):
+        os.environ['AI_HOOK_METRICS_DIR'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.metrics')
+    # 多 worker 时每个进程只能看到自己的捕获，不启用最近捕获缓存
+    if args.workers > 1:
+        os.environ['AI_HOOK_MULTIPROCESS'] = '1'
+
+    def post_fork(server, worker):
+        # 预加载时 master 已经打开过数据库连接，fork 后丢弃继承来的连接池，避免多个进程共用同一个 SQLite 连接
+        from app import db
+        application = server.app.wsgi()
+        with application.app_context():
+            db.engine.dispose(close=False)
+        from app.partitions import store
+        store.dispose(close=False)
+
+    def worker_exit(server, worker):
+        from app.lifecycle import run_shutdown_hooks
+        run_shutdown_hooks()
+
+    class ProxyApplication(BaseApplication):
+        def load_config(self):
+            options = {
+                'bind': f'{args.host}:{args.port}',
+                'workers': args.workers,
+                'threads': args.threads,
+                'worker_class': 'gthread',
+                'preload_app': not args.no_preload,
+                'graceful_timeout': args.graceful_timeout,
+                # 流式响应可能持续很久，gthread worker 的心跳不受单个请求阻塞
+                'timeout': 120,
+                'keepalive': 5,
+                'post_fork': post_fork,
+                'worker_exit': worker_exit,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # 预加载时在 master 中完成初始化，fork 出的 worker 无需重复执行
+            from run import app
+            from app.startup import startup
+            startup.ensure(app)
+            return app
+
+    print(f"以 gunicorn 模式启动: {args.workers} 个 worker x {args.threads} 个线程, 监听 {args.host}:{args.port}")
+    ProxyApplication().run()
+
+
+def run_threaded(args):
+    from werkzeug.serving import make_server
+    from run import app
+    from app.startup import startup
+    from app.lifecycle import run_shutdown_hooks
+
+    startup.ensure(app)
+
+    if args.workers > 1:
+        print("未安装 gunicorn，忽略 --workers，以单进程多线程模式运行（pip install gunicorn 可启用多 worker）")
+
+    server = make_server(args.host, args.port, app, threaded=True)
+    stopping = threading.Event()
+
+    def handle_signal(signum, frame):
+        if stopping.is_set():
+            return
+        stopping.set()
+        print(f"收到退出信号，停止接收新请求，等待进行中的请求完成（最长 {args.graceful_timeout} 秒）")
+        # shutdown 会等待 serve_forever 退出，不能在主线程的信号处理函数里直接调用
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    print(f"以单进程多线程模式启动, 监听 {args.host}:{args.port}")
+    server.serve_forever()
+
+    if not app.inflight.wait_idle(args.graceful_timeout):
+        print(f"等待超时，仍有 {app.inflight.count} 个请求未完成")
+    run_shutdown_hooks()
+    server.server_close()
+    print("服务已退出")
+
+
+def main():
+    args = parse_args()
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        run_threaded(args)
+        return
+    if sys.platform == 'win32':
+        run_threaded(args)
+        return
+    run_gunicorn(args)
+
+
+if __name__ == '__main__':
+    main()